@@ -2,27 +2,83 @@
 
 """
 The API starts the CherryPy webserver and exposes the needed endpoints on the
-localhost.
+localhost, over TCP or a Unix domain socket.
 """
 
 import cherrypy
-from endpoints import RootEndpoint, AuthEndpoint, ContactsEndpoint, MessagesEndpoint, EndpointHelper
+import os
+from metrics import REGISTRY
+from profiler import SamplingProfiler
+from endpoints import RootEndpoint, MetricsEndpoint, ProfilerEndpoint, CaptureTool, EndpointHelper, JSONSerializer
 
 __all__ = ["API"]
 
 class API(object):
-    def __init__(self, controller):
+    def __init__(self, controller, startup):
+        """
+        Configures the webserver and mounts the endpoints which are served
+        while the daemon starts, see `mount` for the others.
+
+        __Parameters__
+
+        - controller: the MVC controller instance
+        - startup: StartupTimer of the daemon
+        """
         self._controller = controller
+        self._socket_file = None # configured path of the Unix domain socket, see `_tune_server`
 
         cherrypy.config.update({
             "global": {
                 "server.socket_host": "127.0.0.1",
                 "server.socket_port": 3000,
+                "server.socket_file": None, # path of a Unix domain socket, replaces the TCP listener
+                "server.socket_mode": 0o600, # permissions of the Unix domain socket
+                "server.socket_queue_size": 128, # connections waiting in the listen backlog
+                "server.thread_pool": 16, # worker threads of the webserver
+                "server.accepted_queue_size": 256, # accepted connections waiting for a worker thread, -1 unbounded
+                "server.socket_timeout": 10, # seconds an idle keep-alive connection stays open
+                "server.keep_alive_connections": 64, # idle keep-alive connections, 0 closes every connection
+                "stream.max_subscribers": 4, # concurrent event streams and long-polls, each one holds a worker thread
+                "model.single_user": False, # requests without a token use the session when only one user is logged in
+                "model.members.workers": 8, # concurrent joined members requests
+                "model.members.timeout": 10, # seconds a contacts request waits for the members
+                "model.send.workers": 8, # concurrent messages of a broadcast
+                "model.join.workers": 4, # concurrent joins of a bulk import
+                "history.room_events": 500, # messages buffered per room
+                "history.max_bytes": 64 * 1024 * 1024, # memory budget of the buffered messages of all the rooms
+                "media.cache_size": 512 * 1024 * 1024, # bytes of media kept on the disk
+                "media.workers": 2, # concurrent thumbnail prefetches
+                "json.backend": "auto", # orjson if installed, the standard library otherwise
+                "tools.compress.on": True, # gzip/deflate JSON responses
+                "tools.metrics.on": True, # request counts and latencies for /metrics
+                "tools.profile.on": True, # cProfile requests with a X-Profile header or profile parameter
+                "tools.capture.on": False, # records the sanitized requests for benchmarks/replay.py
+                "capture.path": "~/.transponder-matrix/capture.jsonl", # JSONL file of the recorded requests
+                "tools.deadline.seconds": 10, # budget of the homeserver calls of a request, see the mounts
+                "homeserver.timeout": 60, # seconds a call without request deadline waits, above the 30 s sync long-poll
+                "homeserver.retries": 2, # retries of a failed read
+                "homeserver.retry_backoff": 0.1, # seconds before the first retry, doubled on every retry
+                "homeserver.breaker_failures": 5, # consecutive failures which open the circuit breaker
+                "homeserver.breaker_reset": 30, # seconds before a call probes an open circuit breaker
+                "profiling.enabled": False, # allows profiling requests and /profiler
+                "profiling.directory": "~/.transponder-matrix/profiles", # pstats files of the profiled requests
             }
         })
+        EndpointHelper.serializer = JSONSerializer(self._controller.setting("json.backend", "auto"))
+        REGISTRY.gauge("transponder_pool_queue_depth", "Tasks waiting for a thread of a pool.", ("pool",)).track(
+            lambda: cherrypy.server.httpserver.requests.qsize, pool="http")
+        cherrypy.engine.subscribe("start", self._tune_server, priority=70) # before the webserver (75)
+        cherrypy.engine.subscribe("start", self._protect_socket, priority=76)
 
-        cherrypy.tree.mount(RootEndpoint())
-        cherrypy.tree.mount(AuthEndpoint(self._controller), "/auth",
+        cherrypy.tree.mount(RootEndpoint(startup))
+        cherrypy.tree.mount(MetricsEndpoint(self._controller), "/metrics",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher()
+                }
+            }
+        )
+        cherrypy.tree.mount(ProfilerEndpoint(self._controller, SamplingProfiler()), "/profiler",
             {"/":
                 {
                     "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
@@ -30,14 +86,130 @@ class API(object):
                 }
             }
         )
+
+    def mount(self):
+        """
+        Mounts the endpoints which need the Model, their modules and the
+        Matrix.org SDK are imported now. Until then, their requests are
+        answered with HTTP 503 by the RootEndpoint.
+        """
+        from endpoints import AuthEndpoint, ContactsEndpoint, StreamEndpoint, BroadcastEndpoint, OutboxEndpoint, MediaEndpoint, \
+            SearchEndpoint, SyncEndpoint
+
+        cherrypy.tree.mount(AuthEndpoint(self._controller), "/auth",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True,
+                    "tools.deadline.seconds": 60 # the login runs the initial sync
+                }
+            }
+        )
         cherrypy.tree.mount(ContactsEndpoint(self._controller), "/contacts",
             {"/":
                 {
                     "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
-                    "error_page.default": EndpointHelper.json_error_page
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True
+                }
+            }
+        )
+        cherrypy.tree.mount(StreamEndpoint(self._controller), "/stream",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True
+                }
+            }
+        )
+        cherrypy.tree.mount(BroadcastEndpoint(self._controller), "/broadcast",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True
+                }
+            }
+        )
+        cherrypy.tree.mount(OutboxEndpoint(self._controller), "/outbox",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True
+                }
+            }
+        )
+        cherrypy.tree.mount(SyncEndpoint(self._controller), "/sync",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True
                 }
             }
         )
+        cherrypy.tree.mount(SearchEndpoint(self._controller), "/search",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True
+                }
+            }
+        )
+        cherrypy.tree.mount(MediaEndpoint(self._controller), "/media",
+            {"/":
+                {
+                    "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+                    "error_page.default": EndpointHelper.json_error_page,
+                    "tools.access_token.on": True,
+                    "tools.deadline.on": True,
+                    "tools.deadline.seconds": 30 # downloads of large media
+                }
+            }
+        )
+
+    def _tune_server(self):
+        """
+        Creates the webserver to apply the settings CherryPy doesn't forward
+        to it. A Unix domain socket is bound in a private directory, see
+        `_protect_socket`.
+        """
+        server = cherrypy.server
+        if not server.httpserver:
+            if server.socket_file:
+                self._socket_file = server.socket_file
+                directory = os.path.join(os.path.dirname(os.path.abspath(server.socket_file)),
+                                         ".{0}.d".format(os.path.basename(server.socket_file)))
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+                os.chmod(directory, 0o700) # fails if another user created it
+                server.socket_file = os.path.join(directory, "socket")
+            server.httpserver, server.bind_addr = server.httpserver_from_self()
+        server.httpserver.keep_alive_conn_limit = self._controller.setting("server.keep_alive_connections", 64)
+
+    def _protect_socket(self):
+        """
+        Restricts the access to the Unix domain socket and moves it to its
+        configured path. The webserver creates it world-writable, until then
+        only the daemon can reach it through the private directory.
+        """
+        if self._socket_file is not None:
+            os.chmod(cherrypy.server.socket_file, self._controller.setting("server.socket_mode", 0o600))
+            os.replace(cherrypy.server.socket_file, self._socket_file)
 
+    def start(self):
+        """
+        Starts the webserver and blocks until the engine stops.
+        """
         cherrypy.engine.start()
         cherrypy.engine.block()
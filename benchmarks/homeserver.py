@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+
+"""
+The FakeHomeserver is a local stand-in for a Matrix homeserver, built on the
+standard library HTTP server. It implements the client-server API calls the
+Matrix.org SDK makes for the daemon and serves a synthetic data set of rooms
+and events which are generated on demand, millions of events cost no memory.
+
+Run it standalone with `python3 benchmarks/homeserver.py --help`.
+"""
+
+import argparse
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+__all__ = ["FakeHomeserver"]
+
+API_PREFIX = "/_matrix/client/r0"
+SERVER_NAME = "bench"
+
+class FakeHomeserver(object):
+    """
+    Synthetic homeserver, every user sees the same rooms.
+
+    Room `i` is `!room{i}:bench`, it has `members` joined users and `events`
+    generated text messages. Messages sent through the API are appended to
+    the generated ones and delivered by the sync long-poll. Pagination tokens
+    `p{n}` point after the `n` first events of a room.
+    """
+    def __init__(self, rooms=100, events=10000, members=5, latency=0, host="127.0.0.1", port=0):
+        """
+        __Parameters__
+
+        - rooms: number of rooms
+        - events: total number of generated events, spread evenly over the rooms
+        - members: joined users per room
+        - latency: milliseconds added to every response
+        - host: interface to listen on
+        - port: port to listen on, `0` picks a free port
+        """
+        self.rooms = rooms
+        self.events_per_room = events // max(rooms, 1)
+        self.members = members
+        self.latency = latency / 1000.0
+        self._condition = threading.Condition()
+        self._sent = {}       # room_id: list of sent events
+        self._stream = []     # (room_id, event) in sending order, the sync position is its length
+        self._txns = {}       # (token, txn_id): event_id
+        self._created = []    # room IDs created through the API
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    def start(self):
+        """
+        Serves the requests in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeHomeserver")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def room_ids(self):
+        return ["!room{0}:{1}".format(index, SERVER_NAME) for index in range(self.rooms)] + list(self._created)
+
+    # Matrix API
+
+    def login(self, request, body):
+        username = body.get("user") or body.get("username") or (body.get("identifier") or {}).get("user", "user")
+        return 200, {
+            "user_id": "@{0}:{1}".format(username, SERVER_NAME),
+            "access_token": "token_{0}_{1}".format(username, time.monotonic_ns()),
+            "home_server": SERVER_NAME,
+            "device_id": "BENCH"
+        }
+
+    def sync(self, request, body):
+        since = request.query.get("since")
+        timeout = int(request.query.get("timeout", "30000")) / 1000.0
+        limit = 10
+        try:
+            limit = json.loads(request.query.get("filter", "{}"))["room"]["timeline"]["limit"]
+        except (ValueError, KeyError, TypeError):
+            pass
+
+        rooms = {}
+        if since is None:
+            with self._condition:
+                position = len(self._stream)
+            for room_id in self.room_ids():
+                count = self._count(room_id)
+                low = max(0, count - limit)
+                rooms[room_id] = self._sync_room(room_id, self._events(room_id, low, count), low, True)
+        else:
+            position = int(since[1:])
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._stream) > position, timeout)
+                new, position = self._stream[position:], len(self._stream)
+            for room_id, event in new:
+                rooms.setdefault(room_id, self._sync_room(room_id, [], None, False))["timeline"]["events"].append(event)
+            for room_id, sync_room in rooms.items():
+                sync_room["timeline"]["prev_batch"] = "p{0}".format(self._count(room_id) - len(sync_room["timeline"]["events"]))
+
+        return 200, {
+            "next_batch": "s{0}".format(position),
+            "presence": {"events": []},
+            "rooms": {"join": rooms, "invite": {}, "leave": {}}
+        }
+
+    def messages(self, request, body, room_id):
+        if not self._known(room_id):
+            return 403, {"errcode": "M_FORBIDDEN", "error": "Not in room"}
+        count = self._count(room_id)
+        position = self._position(room_id, request.query.get("from", "p{0}".format(count)))
+        limit = int(request.query.get("limit", "10"))
+        if request.query.get("dir", "b") == "b":
+            low = max(0, position - limit)
+            chunk = list(reversed(self._events(room_id, low, position)))
+            end = low
+        else:
+            end = min(count, position + limit)
+            chunk = self._events(room_id, position, end)
+        return 200, {"chunk": chunk, "start": "p{0}".format(position), "end": "p{0}".format(end)}
+
+    def members(self, request, body, room_id):
+        if not self._known(room_id):
+            return 403, {"errcode": "M_FORBIDDEN", "error": "Not in room"}
+        return 200, {"chunk": self._member_events(room_id)}
+
+    def joined_members(self, request, body, room_id):
+        if not self._known(room_id):
+            return 403, {"errcode": "M_FORBIDDEN", "error": "Not in room"}
+        return 200, {"joined": {event["state_key"]: {"display_name": event["content"]["displayname"]}
+                                for event in self._member_events(room_id)}}
+
+    def state(self, request, body, room_id):
+        if not self._known(room_id):
+            return 403, {"errcode": "M_FORBIDDEN", "error": "Not in room"}
+        return 200, self._state_events(room_id)
+
+    def send(self, request, body, room_id, event_type, txn_id):
+        if not self._known(room_id):
+            return 403, {"errcode": "M_FORBIDDEN", "error": "Not in room"}
+        key = (request.query.get("access_token") or request.headers.get("Authorization"), txn_id)
+        with self._condition:
+            event_id = self._txns.get(key)
+            if event_id is None:
+                sent = self._sent.setdefault(room_id, [])
+                event_id = "$sent{0}:{1}".format(len(self._stream), SERVER_NAME)
+                event = {
+                    "type": event_type,
+                    "event_id": event_id,
+                    "sender": "@bench:{0}".format(SERVER_NAME),
+                    "origin_server_ts": int(time.time() * 1000),
+                    "content": body
+                }
+                sent.append(event)
+                self._stream.append((room_id, event))
+                self._txns[key] = event_id
+                self._condition.notify_all()
+        return 200, {"event_id": event_id}
+
+    def join(self, request, body, room_id):
+        if not self._known(room_id):
+            return 404, {"errcode": "M_NOT_FOUND", "error": "Unknown room"}
+        return 200, {"room_id": room_id}
+
+    def create_room(self, request, body):
+        room_id = "!created{0}:{1}".format(len(self._created), SERVER_NAME)
+        self._created.append(room_id)
+        return 200, {"room_id": room_id}
+
+    def leave(self, request, body, room_id):
+        return 200, {}
+
+    def set_state(self, request, body, room_id, event_type, state_key=""):
+        return 200, {"event_id": "$state:{0}".format(SERVER_NAME)}
+
+    # Synthetic data
+
+    def _known(self, room_id):
+        match = re.match(r"^!room(\d+):", room_id)
+        return (match is not None and int(match.group(1)) < self.rooms) or room_id in self._created
+
+    def _count(self, room_id):
+        generated = self.events_per_room if room_id.startswith("!room") else 0
+        return generated + len(self._sent.get(room_id, ()))
+
+    def _position(self, room_id, token):
+        """
+        Converts a pagination token or a sync token to a position in a room.
+        """
+        if token.startswith("s"):
+            # A sync token points after the events of the room sent until then
+            with self._condition:
+                sent = sum(1 for sent_room_id, _ in self._stream[:int(token[1:])] if sent_room_id == room_id)
+            return self._count(room_id) - len(self._sent.get(room_id, ())) + sent
+        return int(token[1:])
+
+    def _events(self, room_id, low, high):
+        """
+        Events `low` to `high` of a room in chronological order.
+        """
+        generated = self.events_per_room if room_id.startswith("!room") else 0
+        events = [self._generated(room_id, index) for index in range(low, min(high, generated))]
+        if high > generated:
+            events.extend(self._sent.get(room_id, [])[max(0, low - generated):high - generated])
+        return events
+
+    def _generated(self, room_id, index):
+        return {
+            "type": "m.room.message",
+            "event_id": "${0}e{1}".format(room_id[1:].split(":")[0], index),
+            "sender": "@user{0}:{1}".format(index % max(self.members, 1), SERVER_NAME),
+            "origin_server_ts": 1500000000000 + index * 1000,
+            "content": {"msgtype": "m.text", "body": "Message {0} of {1}".format(index, room_id)}
+        }
+
+    def _member_events(self, room_id):
+        return [{
+            "type": "m.room.member",
+            "event_id": "${0}m{1}".format(room_id[1:].split(":")[0], index),
+            "sender": "@user{0}:{1}".format(index, SERVER_NAME),
+            "state_key": "@user{0}:{1}".format(index, SERVER_NAME),
+            "content": {"membership": "join", "displayname": "User {0}".format(index)}
+        } for index in range(self.members)]
+
+    def _state_events(self, room_id):
+        name = {
+            "type": "m.room.name",
+            "event_id": "${0}n".format(room_id[1:].split(":")[0]),
+            "sender": "@user0:{0}".format(SERVER_NAME),
+            "state_key": "",
+            "content": {"name": "Room {0}".format(room_id[1:].split(":")[0])}
+        }
+        return [name] + self._member_events(room_id)
+
+    def _sync_room(self, room_id, events, low, initial):
+        return {
+            "timeline": {"events": events, "limited": bool(low), "prev_batch": "p{0}".format(low or 0)},
+            "state": {"events": self._state_events(room_id) if initial else []},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []}
+        }
+
+    def _handler(self):
+        homeserver = self
+        room = r"/rooms/(?P<room_id>[^/]+)"
+        routes = [
+            ("POST", r"/login", homeserver.login),
+            ("POST", r"/register", homeserver.login),
+            ("GET", r"/sync", homeserver.sync),
+            ("POST", r"/createRoom", homeserver.create_room),
+            ("POST", r"/join/(?P<room_id>[^/]+)", homeserver.join),
+            ("GET", room + r"/messages", homeserver.messages),
+            ("GET", room + r"/members", homeserver.members),
+            ("GET", room + r"/joined_members", homeserver.joined_members),
+            ("GET", room + r"/state", homeserver.state),
+            ("PUT", room + r"/send/(?P<event_type>[^/]+)/(?P<txn_id>[^/]+)", homeserver.send),
+            ("PUT", room + r"/state/(?P<event_type>[^/]+)(?:/(?P<state_key>[^/]*))?", homeserver.set_state),
+            ("POST", room + r"/leave", homeserver.leave)
+        ]
+        routes = [(method, re.compile("^" + API_PREFIX + pattern + "$"), call) for method, pattern, call in routes]
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, like a real homeserver
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def do_PUT(self):
+                self._dispatch("PUT")
+
+            def log_message(self, *args):
+                pass
+
+            def _dispatch(self, method):
+                url = urllib.parse.urlsplit(self.path)
+                self.query = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                body = json.loads(raw.decode("utf-8")) if raw else {}
+
+                status, payload = 404, {"errcode": "M_UNRECOGNIZED", "error": "Unrecognized request"}
+                for route_method, pattern, call in routes:
+                    match = pattern.match(url.path)
+                    if match and route_method == method:
+                        arguments = {key: urllib.parse.unquote(value)
+                                     for key, value in match.groupdict().items() if value is not None}
+                        status, payload = call(self, body, **arguments)
+                        break
+
+                if homeserver.latency:
+                    time.sleep(homeserver.latency)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic Matrix homeserver for benchmarks")
+    parser.add_argument("--rooms", type=int, default=100, help="number of rooms")
+    parser.add_argument("--events", type=int, default=10000, help="total number of generated events")
+    parser.add_argument("--members", type=int, default=5, help="joined users per room")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every response")
+    parser.add_argument("--port", type=int, default=8008)
+    arguments = parser.parse_args()
+
+    homeserver = FakeHomeserver(arguments.rooms, arguments.events, arguments.members, arguments.latency,
+                                port=arguments.port)
+    print("Fake homeserver listening on {0}".format(homeserver.url))
+    homeserver._server.serve_forever()
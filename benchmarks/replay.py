@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+"""
+Replays the requests recorded by the capture tool (`tools.capture.on`)
+against a daemon and reports the latency percentiles of every route. The
+requests are sent at the recorded pace, `--speed` times faster, or as fast as
+`--concurrency` clients allow with `--speed 0`. The pseudonymous rooms of the
+capture are mapped to the rooms of the replaying account.
+
+    python3 benchmarks/replay.py capture.jsonl --speed 4
+"""
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homeserver import FakeHomeserver
+from run import Benchmark, _percentile, start_daemon
+
+__all__ = ["Replay", "load"]
+
+PSEUDONYM = re.compile(r"!room(\d+):capture")
+
+def load(path):
+    """
+    Reads a capture file, the requests are returned in the order they
+    started.
+    """
+    entries = []
+    with open(path, encoding="utf-8") as capture:
+        for line in capture:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries
+
+class Replay(object):
+    """
+    Plays a capture back against a running daemon.
+    """
+    SKIPPED = (("DELETE", "/auth"),) # the logout would end the session of the replay
+
+    def __init__(self, benchmark, entries, speed=1.0, concurrency=32, timeout=60):
+        """
+        __Parameters__
+
+        - benchmark: logged in Benchmark providing the connections
+        - entries: captured requests, see `load`
+        - speed: pace of the replay, `2` is twice as fast as recorded, `0`
+        sends the requests as fast as possible
+        - concurrency: maximum number of requests in flight
+        - timeout: seconds a request may take
+        """
+        self._benchmark = benchmark
+        self._entries = [entry for entry in entries if (entry["method"], entry["route"]) not in self.SKIPPED]
+        self._speed = speed
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._rooms = []
+
+    def run(self):
+        """
+        Sends all the requests and returns the results per route.
+
+        __Returns__
+
+        - results: list of dictionaries sorted by route, with the latency
+        percentiles in milliseconds and the recorded median for comparison
+        - lag: percentiles in milliseconds of the delay between the scheduled
+        and the actual start of the requests, a large lag means the replay
+        couldn't keep the pace
+        """
+        self._rooms = self._joined_rooms()
+        lock = threading.Lock()
+        samples = {} # (method, route): [latencies, recorded durations, errors]
+        lags = []
+        pending = queue.Queue(maxsize=self._concurrency * 4)
+
+        def client():
+            connection = None
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                entry, scheduled = item
+                if connection is None:
+                    connection = self._benchmark.connect()
+                    connection.timeout = self._timeout
+                start = time.monotonic()
+                try:
+                    status, _ = self._send(connection, entry)
+                    ok = status < 500
+                except (OSError, http.client.HTTPException):
+                    ok = False
+                    connection.close()
+                    connection = None
+                latency = time.monotonic() - start
+                with lock:
+                    sample = samples.setdefault((entry["method"], entry["route"]), ([], [], []))
+                    sample[0].append(latency)
+                    sample[1].append(entry["duration"])
+                    if not ok:
+                        sample[2].append(latency)
+                    if scheduled is not None:
+                        lags.append(max(0, start - scheduled))
+            if connection is not None:
+                connection.close()
+
+        clients = [threading.Thread(target=client) for _ in range(self._concurrency)]
+        for thread in clients:
+            thread.start()
+
+        origin = time.monotonic()
+        first = self._entries[0]["ts"] if self._entries else 0
+        for entry in self._entries:
+            scheduled = None
+            if self._speed > 0:
+                scheduled = origin + (entry["ts"] - first) / self._speed
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            pending.put((entry, scheduled))
+        for _ in clients:
+            pending.put(None)
+        for thread in clients:
+            thread.join()
+        duration = time.monotonic() - origin
+
+        results = []
+        for (method, route), (latencies, recorded, errors) in sorted(samples.items(), key=lambda item: item[0][::-1]):
+            latencies.sort()
+            recorded.sort()
+            results.append({
+                "route": route,
+                "method": method,
+                "requests": len(latencies),
+                "errors": len(errors),
+                "rps": round(len(latencies) / duration, 1) if duration else 0,
+                "p50": _percentile(latencies, 50),
+                "p90": _percentile(latencies, 90),
+                "p99": _percentile(latencies, 99),
+                "max": _percentile(latencies, 100),
+                "recorded_p50": _percentile(recorded, 50)
+            })
+        lags.sort()
+        lag = {"p50": _percentile(lags, 50), "p99": _percentile(lags, 99), "max": _percentile(lags, 100)}
+        return results, lag
+
+    def _joined_rooms(self):
+        connection = self._benchmark.connect()
+        try:
+            status, body = self._benchmark.request(connection, "GET", "/contacts")
+        finally:
+            connection.close()
+        if status != 200:
+            raise RuntimeError("Reading the contacts failed with HTTP {0}".format(status))
+        return [contact["id"] for contact in json.loads(body.decode("utf-8"))["contacts"]]
+
+    def _room(self, match):
+        if not self._rooms:
+            return match.group(0) # answered with HTTP 404 like a room which was left
+        return self._rooms[int(match.group(1)) % len(self._rooms)]
+
+    def _send(self, connection, entry):
+        path = "/".join(urllib.parse.quote(PSEUDONYM.sub(self._room, segment), safe="")
+                        for segment in entry["path"].split("/"))
+        query = [(key, PSEUDONYM.sub(self._room, value)) for key, value in entry["query"]]
+        if query:
+            path += "?" + urllib.parse.urlencode(query)
+        body = entry["body"]
+        if body is not None:
+            body = json.loads(PSEUDONYM.sub(self._room, json.dumps(body)))
+            if entry["route"] == "/auth" and isinstance(body, dict):
+                body.update({
+                    "username": self._benchmark.username, "password": self._benchmark.password,
+                    "server": self._benchmark.homeserver
+                })
+        return self._benchmark.request(connection, entry["method"], path, body)
+
+def report(results, lag):
+    columns = ("method", "route", "requests", "errors", "rps", "p50", "p90", "p99", "max", "recorded_p50")
+    row = "{0:<7} {1:<36} {2:>8} {3:>7} {4:>9} {5:>9} {6:>9} {7:>9} {8:>9} {9:>12}"
+    lines = [row.format(*columns), row.format("", "", "", "", "req/s", "ms", "ms", "ms", "ms", "ms")]
+    for result in results:
+        lines.append(row.format(*("-" if result[column] is None else result[column] for column in columns)))
+    lines.append("")
+    lines.append("lag: p50 {0} ms, p99 {1} ms, max {2} ms".format(
+        *("-" if lag[key] is None else lag[key] for key in ("p50", "p99", "max"))))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays captured requests against the daemon")
+    parser.add_argument("capture", help="JSONL file recorded with tools.capture.on")
+    parser.add_argument("--speed", type=float, default=1.0, help="pace of the replay, 0 sends as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=32, help="maximum number of requests in flight")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds a request may take")
+    parser.add_argument("--username", default="bench", help="user the requests are replayed as")
+    parser.add_argument("--password", default="bench", help="password of the user")
+    parser.add_argument("--rooms", type=int, default=100, help="number of rooms of the fake homeserver")
+    parser.add_argument("--events", type=int, default=10000, help="total number of events of the fake homeserver")
+    parser.add_argument("--members", type=int, default=5, help="joined users per room of the fake homeserver")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every fake homeserver response")
+    parser.add_argument("--daemon", help="URL of a running daemon (unix:{path} for a Unix domain socket), started in this process when omitted")
+    parser.add_argument("--homeserver", help="URL of the homeserver the daemon uses, a fake homeserver is started when omitted")
+    parser.add_argument("--port", type=int, default=3100, help="port of the daemon started in this process")
+    parser.add_argument("--socket", help="Unix domain socket of the daemon started in this process, replaces the port")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    arguments = parser.parse_args()
+    if arguments.speed < 0:
+        parser.error("the speed can't be negative")
+
+    entries = load(arguments.capture)
+    if arguments.homeserver is None:
+        fake = FakeHomeserver(arguments.rooms, arguments.events, arguments.members, arguments.latency)
+        fake.start()
+    homeserver = arguments.homeserver or fake.url
+    daemon = arguments.daemon or start_daemon(arguments.port, arguments.socket)
+
+    benchmark = Benchmark(daemon, homeserver, [])
+    benchmark.login(arguments.username, arguments.password)
+    results, lag = Replay(benchmark, entries, arguments.speed, arguments.concurrency, arguments.timeout).run()
+
+    if arguments.json:
+        print(json.dumps({"settings": vars(arguments), "results": results, "lag": lag}, indent=2))
+    else:
+        print(report(results, lag))
+
+    if arguments.daemon is None:
+        import cherrypy
+        cherrypy.engine.exit()
+    os._exit(0) # the sync threads of the sessions never end on their own
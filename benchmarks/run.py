@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+"""
+Benchmark suite of the daemon. A FakeHomeserver serves a synthetic data set,
+the daemon runs in this process (or elsewhere with `--daemon`) and every
+scenario drives one endpoint concurrently. Latency percentiles and the
+throughput of each scenario are reported.
+
+    python3 benchmarks/run.py --rooms 1000 --events 1000000 --latency 20
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import socket
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homeserver import FakeHomeserver
+
+__all__ = ["Benchmark", "SCENARIOS"]
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix domain socket.
+    """
+    def __init__(self, path):
+        super().__init__("localhost")
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+class Benchmark(object):
+    """
+    Drives the scenarios against a running daemon.
+    """
+    def __init__(self, daemon, homeserver, room_ids, concurrency=8, requests=500, depth=20):
+        """
+        __Parameters__
+
+        - daemon: URL of the daemon, `unix:{path}` for a Unix domain socket
+        - homeserver: URL of the homeserver the daemon logs in on
+        - room_ids: rooms of the synthetic data set
+        - concurrency: number of concurrent clients
+        - requests: number of requests per scenario
+        - depth: pages read back in time by the `history` scenario
+        """
+        url = urllib.parse.urlsplit(daemon)
+        self._socket = url.path if url.scheme == "unix" else None
+        self._host, self._port = url.hostname, url.port or 80
+        self.homeserver = homeserver
+        self.room_ids = room_ids
+        self.concurrency = concurrency
+        self.requests = requests
+        self.depth = depth
+        self.token = None
+        self.username = None
+        self.password = None
+
+    def login(self, username="bench", password="bench"):
+        """
+        Authenticates the user of the scenarios, the daemon runs the initial
+        sync of all the rooms.
+        """
+        self.username, self.password = username, password
+        connection = self.connect()
+        status, body = self.request(connection, "POST", "/auth", {
+            "username": username, "password": password, "server": self.homeserver, "new": False
+        }, token=False)
+        if status != 200:
+            raise RuntimeError("Login failed with HTTP {0}: {1}".format(status, body[:200]))
+        self.token = json.loads(body.decode("utf-8"))["token"]
+
+    def connect(self):
+        """
+        Opens a keep-alive connection to the daemon.
+        """
+        if self._socket is not None:
+            return UnixHTTPConnection(self._socket)
+        return http.client.HTTPConnection(self._host, self._port)
+
+    def request(self, connection, method, path, body=None, token=True):
+        headers = {"Accept": "application/json"}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        if token and self.token is not None:
+            headers["Authorization"] = "Bearer {0}".format(self.token)
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def run(self, name, call, requests=None):
+        """
+        Runs a scenario with `concurrency` clients until `requests` requests
+        were sent.
+
+        __Parameters__
+
+        - name: name of the scenario
+        - call: `call(benchmark, connection, index, record)` sends one or more
+        requests, `record(seconds, ok)` records each of them
+        - requests: overrides the number of requests of the benchmark
+
+        __Returns__
+
+        - result: dictionary with the latency percentiles in milliseconds
+        """
+        requests = self.requests if requests is None else requests
+        counter = itertools.count()
+        lock = threading.Lock()
+        latencies = []
+        errors = []
+
+        def record(seconds, ok):
+            with lock:
+                latencies.append(seconds)
+                if not ok:
+                    errors.append(seconds)
+
+        def client():
+            connection = self.connect()
+            try:
+                while True:
+                    index = next(counter)
+                    if index >= requests:
+                        return
+                    try:
+                        call(self, connection, index, record)
+                    except (OSError, http.client.HTTPException):
+                        record(0, False)
+                        connection.close()
+                        connection = self.connect()
+            finally:
+                connection.close()
+
+        start = time.monotonic()
+        clients = [threading.Thread(target=client) for _ in range(self.concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        duration = time.monotonic() - start
+
+        latencies.sort()
+        return {
+            "scenario": name,
+            "requests": len(latencies),
+            "errors": len(errors),
+            "rps": round(len(latencies) / duration, 1) if duration else 0,
+            "p50": _percentile(latencies, 50),
+            "p90": _percentile(latencies, 90),
+            "p99": _percentile(latencies, 99),
+            "max": _percentile(latencies, 100)
+        }
+
+    def timed(self, connection, record, method, path, body=None, token=True, expected=(200,)):
+        start = time.monotonic()
+        status, response = self.request(connection, method, path, body, token)
+        record(time.monotonic() - start, status in expected)
+        return status, response
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values))) - 1))
+    return round(values[index] * 1000, 2)
+
+def _room_path(room_id):
+    return "/contacts/{0}/messages".format(urllib.parse.quote(room_id, safe=""))
+
+# Scenarios
+
+def auth(benchmark, connection, index, record):
+    benchmark.timed(connection, record, "POST", "/auth", {
+        "username": "bench{0}".format(index), "password": "bench", "server": benchmark.homeserver, "new": False
+    }, token=False)
+
+def contacts(benchmark, connection, index, record):
+    benchmark.timed(connection, record, "GET", "/contacts")
+
+def messages(benchmark, connection, index, record):
+    room_id = random.choice(benchmark.room_ids)
+    benchmark.timed(connection, record, "GET", _room_path(room_id) + "?limit=20")
+
+def history(benchmark, connection, index, record):
+    # Pages back in time, every page is recorded as a request
+    room_id = random.choice(benchmark.room_ids)
+    cursor = None
+    for _ in range(benchmark.depth):
+        query = {"limit": 50}
+        if cursor is not None:
+            query["from"] = cursor
+        status, body = benchmark.timed(connection, record, "GET", _room_path(room_id) + "?" + urllib.parse.urlencode(query))
+        cursor = json.loads(body.decode("utf-8")).get("end") if status == 200 else None
+        if cursor is None:
+            break
+
+def send(benchmark, connection, index, record):
+    room_id = random.choice(benchmark.room_ids)
+    benchmark.timed(connection, record, "POST", _room_path(room_id),
+                    {"content": "Benchmark message {0}".format(index)}, expected=(200, 202))
+
+SCENARIOS = {
+    "auth": auth,
+    "contacts": contacts,
+    "messages": messages,
+    "history": history,
+    "send": send
+}
+
+def start_daemon(port, socket_file=None):
+    """
+    Starts the daemon in this process with its state in a temporary directory.
+    The daemon listens on `socket_file` instead of the TCP port when given.
+    """
+    import cherrypy
+    from controller import Controller
+    from model import Model
+
+    directory = tempfile.mkdtemp(prefix="transponder-bench-")
+    Model.STATE_PATH = os.path.join(directory, "state.sqlite3")
+    Model.MEDIA_PATH = os.path.join(directory, "media")
+
+    controller = Controller(os.path.join(directory, "daemon.pid"))
+    controller.setup({
+        "environment": "production",
+        "server.socket_port": port,
+        "server.socket_file": socket_file,
+        "server.thread_pool": 32
+    })
+    cherrypy.engine.start()
+    if socket_file is not None:
+        return "unix:{0}".format(socket_file)
+    return "http://127.0.0.1:{0}".format(port)
+
+def report(results):
+    columns = ("scenario", "requests", "errors", "rps", "p50", "p90", "p99", "max")
+    lines = ["{0:<10} {1:>8} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}".format(*columns),
+             "{0:<10} {1:>8} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}".format("", "", "", "req/s", "ms", "ms", "ms", "ms")]
+    for result in results:
+        lines.append("{0:<10} {1:>8} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}".format(
+            *("-" if result[column] is None else result[column] for column in columns)))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the daemon against a synthetic homeserver")
+    parser.add_argument("--rooms", type=int, default=100, help="number of rooms (10-5000)")
+    parser.add_argument("--events", type=int, default=10000, help="total number of events (1e3-1e6)")
+    parser.add_argument("--members", type=int, default=5, help="joined users per room")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every homeserver response")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--auth-requests", type=int, default=10, help="requests of the auth scenario, each one starts a session")
+    parser.add_argument("--depth", type=int, default=20, help="pages read back in time by the history scenario")
+    parser.add_argument("--scenarios", default=",".join(sorted(SCENARIOS)), help="comma separated scenarios")
+    parser.add_argument("--daemon", help="URL of a running daemon (unix:{path} for a Unix domain socket), started in this process when omitted")
+    parser.add_argument("--homeserver", help="URL of the homeserver the daemon uses, a fake homeserver is started when omitted")
+    parser.add_argument("--port", type=int, default=3100, help="port of the daemon started in this process")
+    parser.add_argument("--socket", help="Unix domain socket of the daemon started in this process, replaces the port")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    arguments = parser.parse_args()
+
+    scenarios = [name.strip() for name in arguments.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenarios: {0}".format(", ".join(unknown)))
+
+    fake = FakeHomeserver(arguments.rooms, arguments.events, arguments.members, arguments.latency)
+    if arguments.homeserver is None:
+        fake.start()
+    homeserver = arguments.homeserver or fake.url
+    daemon = arguments.daemon or start_daemon(arguments.port, arguments.socket)
+
+    benchmark = Benchmark(daemon, homeserver, fake.room_ids(), arguments.concurrency, arguments.requests, arguments.depth)
+    start = time.monotonic()
+    benchmark.login()
+    results = [{"scenario": "login", "requests": 1, "errors": 0, "rps": None, "p50": None, "p90": None,
+                "p99": None, "max": round((time.monotonic() - start) * 1000, 2)}]
+    for name in scenarios:
+        requests = arguments.auth_requests if name == "auth" else None
+        results.append(benchmark.run(name, SCENARIOS[name], requests))
+
+    if arguments.json:
+        print(json.dumps({"settings": vars(arguments), "results": results}, indent=2))
+    else:
+        print(report(results))
+
+    if arguments.daemon is None:
+        import cherrypy
+        cherrypy.engine.exit()
+    os._exit(0) # the sync threads of the sessions never end on their own
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+"""
+The bundle script packs the daemon and the Matrix.org SDK into a zip file of
+precompiled bytecode. The zip is added to `sys.path` like `Matrix.zip` and
+zipimport loads the `.pyc` files straight away, the sources are never
+compiled when the daemon starts. A bundle only works with the Python version
+which built it.
+
+    python3 bundle.py --output Matrix.zip
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import zipfile
+
+__all__ = ["build"]
+
+PACKAGES = ("matrix_client",) # dependencies bundled with the daemon
+EXCLUDED = ("benchmarks", "bundle.py")
+
+def build(output, packages=PACKAGES, optimize=-1):
+    """
+    Writes the bundle.
+
+    __Parameters__
+
+    - output: path of the zip file
+    - packages: installed packages bundled with the daemon
+    - optimize: optimization level of the bytecode, `-1` is the level of the
+    running interpreter, `2` also strips the docstrings
+
+    __Raises__
+
+    - ImportError: a package isn't installed
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with zipfile.PyZipFile(output, "w", compression=zipfile.ZIP_DEFLATED, optimize=optimize) as bundle:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name in EXCLUDED:
+                continue
+            if name.endswith(".py") or os.path.isfile(os.path.join(path, "__init__.py")):
+                bundle.writepy(path)
+
+        for package in packages:
+            spec = importlib.util.find_spec(package)
+            if spec is None or spec.origin is None:
+                raise ImportError("{0} isn't installed".format(package))
+            # Packages are added with their directory, modules with their file
+            bundle.writepy(os.path.dirname(spec.origin) if spec.submodule_search_locations else spec.origin)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Packs the daemon into a zip file of precompiled bytecode")
+    parser.add_argument("--output", default="Matrix.zip", help="path of the zip file")
+    parser.add_argument("--package", action="append", dest="packages", default=list(PACKAGES),
+                        help="installed package bundled with the daemon, repeatable")
+    parser.add_argument("--optimize", type=int, choices=(-1, 0, 1, 2), default=-1,
+                        help="bytecode optimization level, 2 strips the docstrings")
+    arguments = parser.parse_args()
+
+    build(arguments.output, arguments.packages, arguments.optimize)
+    sys.stdout.write("Bundle written to {0}\n".format(arguments.output))
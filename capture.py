@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+"""
+The TrafficRecorder appends sanitized API requests with their timing and
+response size to a JSONL file, `benchmarks/replay.py` plays such a file back
+against a daemon to reproduce the load of real clients.
+"""
+
+import json
+import os
+import re
+import threading
+import urllib.parse
+
+__all__ = ["TrafficRecorder"]
+
+ROOM_ID = re.compile(r"^[!#][^:/]+:[^/]+$") # room ID or alias
+USER_ID = re.compile(r"^@[^:/]+:[^/]+$")
+ROUTE_WORDS = frozenset(("auth", "contacts", "messages", "stream", "broadcast", "outbox", "sync", "search", "media",
+                         "metrics", "profiler", "startup")) # static segments of the routes
+
+class TrafficRecorder(object):
+    """
+    Thread-safe JSONL writer of captured requests.
+
+    Every line is a JSON object:
+
+    ```json
+        {
+            "ts": number, UNIX time of the start of the request
+            "method": string
+            "route": string, path with its IDs replaced by placeholders
+            "path": string, decoded path with pseudonymous IDs
+            "query": [[string, string], ...]
+            "body": JSON body or `null`
+            "status": number
+            "duration": number, seconds until the response was sent
+            "bytes": number, size of the response body
+        }
+    ```
+
+    Nothing identifying leaves the daemon: the credentials and tokens are
+    redacted, the texts are replaced by `x` characters of the same length and
+    each room ID becomes a pseudonym `!room{n}:capture` which stays the same
+    while the daemon runs, the replay maps the pseudonyms to the rooms of its
+    own account. User IDs become `@user{n}:capture`. Every query value but the
+    paging parameters and every path segment but the static words of the
+    routes are texts, for example room names.
+    """
+    SECRET_KEYS = frozenset(("username", "password", "token", "access_token", "server"))
+    TEXT_KEYS = frozenset(("content", "body", "formatted_body", "q", "name", "displayname", "rooms"))
+    PLAIN_PARAMS = frozenset(("limit", "direction", "from", "since", "timeout", "thumbnail")) # numbers and cursors
+    DROPPED_PARAMS = frozenset(("access_token", "profile"))
+    REDACTED = "<redacted>"
+
+    def __init__(self, path):
+        """
+        __Parameters__
+
+        - path: JSONL file the requests are appended to, created with its
+        directory when missing
+        """
+        self._path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pseudonyms = {} # room or user ID: pseudonym
+
+    @property
+    def path(self):
+        return self._path
+
+    def record(self, start, method, path, query_string, body, status, duration, size):
+        """
+        Sanitizes a request and appends it to the file.
+
+        __Parameters__
+
+        - start: UNIX time of the start of the request
+        - method: HTTP method
+        - path: decoded path of the request
+        - query_string: raw query string
+        - body: decoded JSON body, `None` without JSON body
+        - status: HTTP status code of the response
+        - duration: seconds until the response was sent
+        - size: bytes of the response body
+        """
+        segments = [segment if not segment or segment in ROUTE_WORDS else self._text(segment)
+                    for segment in path.split("/")]
+        query = [[key, value if key in self.PLAIN_PARAMS else self._text(value)]
+                 for key, value in urllib.parse.parse_qsl(query_string, keep_blank_values=True)
+                 if key not in self.DROPPED_PARAMS]
+        entry = {
+            "ts": round(start, 6),
+            "method": method,
+            "route": "/".join(self._placeholder(segment) for segment in path.split("/")),
+            "path": "/".join(segments),
+            "query": query,
+            "body": None if body is None else self._sanitize(body),
+            "status": status,
+            "duration": round(duration, 6),
+            "bytes": size
+        }
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self._path)
+                if directory:
+                    os.makedirs(directory, mode=0o700, exist_ok=True)
+                self._file = open(self._path, "a", encoding="utf-8", buffering=1) # line buffered
+            self._file.write(line)
+
+    def close(self):
+        """
+        Closes the file, the next `record` reopens it.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _sanitize(self, value, key=None):
+        if isinstance(value, dict):
+            return {name: self._sanitize(item, name) for name, item in value.items()}
+        if isinstance(value, list):
+            return [self._sanitize(item, key) for item in value]
+        if not isinstance(value, str):
+            return value
+        if key in self.SECRET_KEYS:
+            return self.REDACTED
+        if key in self.TEXT_KEYS:
+            return self._text(value)
+        if ROOM_ID.match(value) or USER_ID.match(value):
+            return self._pseudonym(value)
+        return value
+
+    def _text(self, value):
+        # Room and user IDs keep their pseudonyms, other texts keep the size of the payload
+        if ROOM_ID.match(value) or USER_ID.match(value):
+            return self._pseudonym(value)
+        return "x" * len(value)
+
+    def _pseudonym(self, matrix_id):
+        with self._lock:
+            pseudonym = self._pseudonyms.get(matrix_id)
+            if pseudonym is None:
+                kind = "!room" if ROOM_ID.match(matrix_id) else "@user"
+                pseudonym = self._pseudonyms[matrix_id] = "{0}{1}:capture".format(kind, len(self._pseudonyms))
+            return pseudonym
+
+    def _placeholder(self, segment):
+        if not segment or segment in ROUTE_WORDS:
+            return segment
+        return "{room_id}" if ROOM_ID.match(segment) else "{id}"
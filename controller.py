@@ -5,38 +5,120 @@ The Controller starts the Matrix.org Python daemon and maintains control.
 This script initialize the needed modules before it runs the daemon.
 """
 
+from startup import StartupTimer # first, the startup timer includes the other imports
 import cherrypy
-import matrix_client
 import sys
 from daemonator import Daemon
-from model import Model
 from api import API
 
 __all__ = ["Controller"]
 
 class Controller(Daemon):
     def run(self):
+        self.setup()
+        self._api.start()
+
+    def setup(self, settings=None):
+        """
+        Configures the API without starting the webserver. When the engine
+        starts, the webserver listens and serves `/` first, then the Model is
+        built and the other endpoints are mounted.
+
+        __Parameters__
+
+        - settings: dictionary overriding the default configuration of the API
+        """
+        self._startup = StartupTimer()
+        self._startup.mark("imports")
+        self._api = API(self, self._startup) # applies the configuration
+        if settings:
+            cherrypy.config.update(settings)
+        self._startup.mark("configuration")
+        cherrypy.engine.subscribe("start", self._bootstrap, priority=80) # after the webserver (75)
+
+    def _bootstrap(self):
+        """
+        Loads the Matrix.org SDK, restores the sessions and mounts the
+        endpoints which need them.
+        """
+        self._startup.mark("webserver")
+        from model import Model # imports the Matrix.org SDK
         self._model = Model(self)
-        self._api = API(self)
+        self._startup.mark("model")
+        self._api.mount()
+        self._startup.mark("endpoints")
+        self._startup.done()
+        report = self._startup.report()
+        cherrypy.log("Startup finished in {0} ms: {1}".format(
+            report["total"], ", ".join("{phase} {duration} ms".format(**phase) for phase in report["phases"])
+        ))
+
+    def setting(self, key, default=None):
+        return cherrypy.config.get(key, default)
 
     def auth(self, username, password, server, new):
         return self._model.auth(username, password, server, new)
 
-    def add_room(self, room_id):
-        return self._model.add_room(room_id)
+    def is_auth(self, token=None):
+        return self._model.session(token) is not None
 
-    def remove_room(self, room_id):
-        return self._model.remove_room(room_id)
+    def add_room(self, room_id, token=None):
+        return self._session(token).add_room(room_id)
 
-    def messages(self, room_id):
-        return self._model.messages(room_id)
+    def add_rooms(self, room_ids, token=None):
+        return self._model.add_rooms(self._session(token), room_ids)
 
-    def send_text(self, room_id, text):
-        return self._model.send_text(room_id, text)
+    def remove_room(self, room_id, token=None):
+        return self._session(token).remove_room(room_id)
 
-    @property
-    def is_auth(self):
-        return self._model.token is not None
+    def messages(self, room_id, start=None, limit=10, direction="b", token=None):
+        return self._session(token).messages(room_id, start, limit, direction)
+
+    def mark_read(self, room_id, event_id=None, token=None):
+        return self._session(token).mark_read(room_id, event_id)
+
+    def search(self, query, room_id=None, limit=20, start=None, token=None):
+        return self._session(token).search(query, room_id, limit, start)
+
+    def queue_text(self, room_id, text, token=None):
+        return self._model.queue_text(self._session(token), room_id, text)
+
+    def delivery(self, message_id=None, token=None):
+        return self._model.delivery(self._session(token), message_id)
+
+    def media(self, server_name, media_id, thumbnail=False, token=None):
+        return self._model.media(self._session(token), server_name, media_id, thumbnail)
+
+    def broadcast(self, messages, token=None):
+        return self._model.broadcast(self._session(token), messages)
+
+    def sync(self, since=None, token=None):
+        return self._session(token).sync(since)
+
+    def wait_events(self, cursor, room_id=None, timeout=30, token=None):
+        return self._session(token).wait_events(cursor, room_id, timeout)
+
+    def events_cursor(self, token=None):
+        return self._session(token).events_cursor
+
+    def contacts(self, token=None):
+        return self._session(token).rooms
+
+    def contacts_etag(self, token=None):
+        return self._session(token).contacts_etag
+
+    def find_contacts(self, member=None, name_prefix=None, token=None):
+        return self._session(token).find_rooms(member, name_prefix)
+
+    def _session(self, token):
+        """
+        Returns the session of the request, the session may have been evicted
+        since the endpoint checked `is_auth`.
+        """
+        session = self._model.session(token)
+        if session is None:
+            raise cherrypy.HTTPError(401, "The session of the user is closed")
+        return session
 
     @property
     def version(self):
@@ -46,10 +128,6 @@ class Controller(Daemon):
     def service(self):
         return self._model.service
 
-    @property
-    def contacts(self):
-        return self._model.rooms
-
 if __name__ == "__main__":
     # Define a PIDFile location (typically located in /tmp or /var/run)
     daemon = Controller("/tmp/transponder_matrix_daemon.pid")
@@ -3,10 +3,44 @@
 """
 The endpoints submodule contains all the exposed HTTP REST endpoints code.
 All endpoints are inheritted from the RestAPIEndpoint abstract base class.
+The submodules are imported on first use, most of them import the Matrix.org
+SDK which isn't needed before the daemon serves its first request.
 """
 
-from .root import RootEndpoint
-from .auth import AuthEndpoint
-from .contacts import ContactsEndpoint
-from .messages import MessagesEndpoint
-from .endpoint import EndpointHelper
+import importlib
+
+__all__ = [
+    "RootEndpoint", "AuthEndpoint", "ContactsEndpoint", "MessagesEndpoint", "StreamEndpoint",
+    "BroadcastEndpoint", "OutboxEndpoint", "MediaEndpoint", "MetricsEndpoint", "ProfilerEndpoint", "SearchEndpoint",
+    "SyncEndpoint",
+    "CaptureTool", "EndpointHelper", "JSONSerializer"
+]
+
+# Exported name: submodule defining it
+_SUBMODULES = {
+    "RootEndpoint": "root",
+    "AuthEndpoint": "auth",
+    "ContactsEndpoint": "contacts",
+    "MessagesEndpoint": "messages",
+    "StreamEndpoint": "stream",
+    "BroadcastEndpoint": "broadcast",
+    "OutboxEndpoint": "outbox",
+    "MediaEndpoint": "media",
+    "MetricsEndpoint": "metrics",
+    "ProfilerEndpoint": "profiler",
+    "SearchEndpoint": "search",
+    "SyncEndpoint": "sync",
+    "CaptureTool": "capture",
+    "EndpointHelper": "endpoint",
+    "JSONSerializer": "serializer"
+}
+
+def __getattr__(name):
+    if name not in _SUBMODULES:
+        raise AttributeError("module {0} has no attribute {1}".format(__name__, name))
+    value = getattr(importlib.import_module("." + _SUBMODULES[name], __name__), name)
+    globals()[name] = value # the next lookups don't go through __getattr__
+    return value
+
+def __dir__():
+    return __all__
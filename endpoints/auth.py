@@ -18,12 +18,17 @@ class AuthEndpoint(RestAPIEndpoint):
         super().__init__(controller)
 
     @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
     def POST(self):
         """
         Authenticates the user on the given server, if the `new` property is
         set to `true` then a new account is created for the user, otherwise the
-        user is logged in on the given server.
+        user is logged in on the given server. Every authentication creates a
+        new session, the returned token selects the session in the other
+        requests with an `Authorization: Bearer <token>` header or an
+        `access_token` query parameter. Requests without a token are refused
+        like unauthenticated requests, unless `model.single_user` is set and
+        only one user is logged in.
 
         __Parameters__
 
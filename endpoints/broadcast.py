@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import cherrypy
+import uuid
+from .endpoint import RestAPIEndpoint, EndpointHelper
+
+__all__ = ["BroadcastEndpoint"]
+
+MAX_MESSAGES = 200 # maximum number of messages per request, not a class attribute: the MethodDispatcher would list it as HTTP method
+
+class BroadcastEndpoint(RestAPIEndpoint):
+    """
+    __/broadcast__ sends messages to many contacts with a single request.
+
+    Implemented HTTP REST methods:
+
+    - __POST__: Sends the messages concurrently and reports the result of each one
+    """
+    def __init__(self, controller):
+        super().__init__(controller)
+
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def POST(self):
+        """
+        Sends the same text to a list of rooms or a text per room:
+
+        ```json
+            {"rooms": [string, ...], "content": string, "txn_id": string}
+            {"messages": [{"room_id": string, "content": string, "txn_id": string}, ...]}
+        ```
+
+        The transaction ID of a message defaults to `{txn_id}.{index}` where
+        the request `txn_id` is generated when omitted. The transaction IDs are
+        returned with the results, a client retries failed messages with the
+        same transaction IDs without sending any message twice.
+
+        __Returns__
+
+        - results: one result per message in the order of the request, a
+        failed message doesn't fail the other messages
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first or the messages are invalid
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
+            raise cherrypy.HTTPError(400, "User isn't logged in!")
+
+        # Retrieve the JSON data
+        data = cherrypy.request.json
+        if not isinstance(data, dict):
+            raise cherrypy.HTTPError(400, "Expected a JSON object")
+
+        if "rooms" in data:
+            if not isinstance(data["rooms"], list):
+                raise cherrypy.HTTPError(400, "rooms must be a list of room IDs")
+            items = [{"room_id": room_id, "content": data.get("content")} for room_id in data["rooms"]]
+        elif "messages" in data and isinstance(data["messages"], list):
+            items = data["messages"]
+        else:
+            raise cherrypy.HTTPError(400, "Expected a list of rooms or messages")
+
+        if not items or len(items) > MAX_MESSAGES:
+            raise cherrypy.HTTPError(400, "Between 1 and {0} messages are allowed".format(MAX_MESSAGES))
+
+        prefix = str(data.get("txn_id") or uuid.uuid4().hex)
+        messages = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not isinstance(item.get("room_id"), str) \
+                    or not isinstance(item.get("content"), str):
+                raise cherrypy.HTTPError(400, "Message {0} needs a room_id and a text content".format(index))
+            txn_id = str(item.get("txn_id") or "{0}.{1}".format(prefix, index))
+            messages.append((item["room_id"], item["content"], txn_id))
+
+        payload = {
+            "results": self._controller.broadcast(messages, token)
+        }
+        return EndpointHelper.prepare_payload(self._controller, payload)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+import cherrypy
+import threading
+import time
+
+__all__ = ["CaptureTool"]
+
+class CaptureTool(cherrypy.Tool):
+    """
+    CherryPy tool which records every request with its timing and response
+    size to the `capture.path` JSONL file, see TrafficRecorder. The streamed
+    responses are recorded once they were sent completely.
+    """
+    def __init__(self):
+        super().__init__("on_start_resource", self._start)
+        self._recorder = None
+        self._lock = threading.Lock()
+
+    def _setup(self):
+        super()._setup()
+        hooks = cherrypy.serving.request.hooks
+        hooks.attach("before_finalize", self._count, priority=95) # after the compression (90)
+        hooks.attach("on_end_request", self._record)
+
+    def _start(self):
+        request = cherrypy.serving.request
+        request.capture_start = (time.time(), time.monotonic())
+        request.capture_bytes = 0
+
+    def _count(self):
+        response = cherrypy.serving.response
+        if response.stream and response.body is not None:
+            response.body = self._counted(response.body, cherrypy.serving.request)
+
+    @staticmethod
+    def _counted(body, request):
+        for chunk in body:
+            request.capture_bytes += len(chunk)
+            yield chunk
+
+    def _record(self):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        start = getattr(request, "capture_start", None)
+        if start is None:
+            return
+
+        size = request.capture_bytes
+        if not response.stream:
+            size = int(response.headers.get("Content-Length") or 0)
+        status = int(str(response.status or "500").split(" ")[0])
+
+        self.recorder().record(start[0], request.method, request.script_name + request.path_info,
+                               request.query_string, getattr(request, "json", None), status,
+                               time.monotonic() - start[1], size)
+
+    def recorder(self):
+        """
+        Returns the TrafficRecorder of `capture.path`, created on first use.
+        """
+        with self._lock:
+            if self._recorder is None:
+                from capture import TrafficRecorder # only imported when capturing
+                self._recorder = TrafficRecorder(cherrypy.config.get("capture.path", "~/.transponder-matrix/capture.jsonl"))
+                cherrypy.engine.subscribe("stop", self._recorder.close)
+            return self._recorder
+
+cherrypy.tools.capture = CaptureTool()
@@ -7,6 +7,8 @@ from matrix_client.errors import MatrixRequestError
 
 __all__ = ["ContactsEndpoint"]
 
+MAX_ROOMS = 500 # maximum number of rooms per bulk import, not a class attribute: the MethodDispatcher would list it as HTTP method
+
 @cherrypy.popargs("room_id") # /contacts/{room_id} global available for subendpoints as /contacts/{room_id}/messages
 class ContactsEndpoint(RestAPIEndpoint):
     """
@@ -15,7 +17,7 @@ class ContactsEndpoint(RestAPIEndpoint):
     Implemented HTTP REST methods:
 
     - __GET__: Reads all the rooms of the user
-    - __POST__: Adds a new rooms of the user
+    - __POST__: Adds a new rooms of the user, or many rooms at once
     - __PUT__: Modifies a rooms of the user
     - __DELETE__: Deletes a rooms of the user
     """
@@ -24,59 +26,117 @@ class ContactsEndpoint(RestAPIEndpoint):
         super().__init__(controller)
         self.messages = MessagesEndpoint(self._controller)
 
-    @cherrypy.tools.json_out()
-    def GET(self, room_id=None):
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def GET(self, room_id=None, member=None, name_prefix=None):
         """
         Reads all the rooms of the user and returns them.
+        The response carries an ETag, polls with a matching `If-None-Match`
+        header are answered with HTTP 304 without rebuilding the rooms.
+
+        __Parameters__
+
+        - member: only return the rooms where this Matrix user ID is joined
+        - name_prefix: only return the rooms whose name starts with this prefix
 
         __Raises__
 
+        - HTTP 304: the rooms didn't change since the given ETag
         - HTTP 400: the user must be authenticated first
         """
-        if not self._controller.is_auth:
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
             raise cherrypy.HTTPError(400, "User isn't logged in!")
 
+        # Filtered queries are answered from the room registry
+        if member is not None or name_prefix is not None:
+            payload = {
+                "contacts": self._controller.find_contacts(member, name_prefix, token)
+            }
+            return EndpointHelper.prepare_payload(self._controller, payload)
+
+        EndpointHelper.validate_etag(self._controller.contacts_etag(token))
+
         payload = {
-            "contacts": self._controller.contacts
+            "contacts": self._controller.contacts(token)
         }
 
+        EndpointHelper.set_etag(self._controller.contacts_etag(token))
         return EndpointHelper.prepare_payload(self._controller, payload)
 
     @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out()
-    def POST(self, room_id):
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def POST(self, room_id=None):
         """
         Adds a new room to the user address book and returns all the rooms.
         Automatically handles the difference between a new room and joining an
         existing room. When the room doesn't exist, the room is created.
 
+        Without `room_id`, many rooms are imported at once:
+
+        ```json
+            {"rooms": [string, ...]}
+        ```
+
+        The rooms are joined or created concurrently, the response contains
+        one result per room in the order of the request, a failed room doesn't
+        fail the other rooms. The contacts are only rebuilt once, after all
+        the rooms were added.
+
         __Raises__
 
-        - HTTP 400: the user must be authenticated first
+        - HTTP 400: the user must be authenticated first or the rooms are invalid
         - HTTP 500: internal server error with traceback
         """
-        if not self._controller.is_auth:
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
             raise cherrypy.HTTPError(400, "User isn't logged in!")
 
+        if room_id is None:
+            return self._import(token)
+
         # Retrieve the room_id
         room_id = EndpointHelper.decode(room_id) # URL decoding
 
         # Raise HTTP 400 when adding a room fails
         try:
-            self._controller.add_room(room_id)
+            self._controller.add_room(room_id, token)
         except MatrixRequestError as e:
-            cherrypy.HTTPError(e.code, e.content)
+            raise cherrypy.HTTPError(e.code, e.content)
+        except cherrypy.HTTPError:
+            raise
         except Exception as e:
-            cherrypy.HTTPError(500, str(e))
+            raise cherrypy.HTTPError(500, str(e))
 
         payload = {
-            "contacts": self._controller.contacts
+            "contacts": self._controller.contacts(token)
         }
 
         return EndpointHelper.prepare_payload(self._controller, payload)
 
+    def _import(self, token):
+        """
+        Bulk import of the POST body, see `POST`.
+        """
+        # Retrieve the JSON data
+        data = cherrypy.request.json
+        if not isinstance(data, dict) or not isinstance(data.get("rooms"), list):
+            raise cherrypy.HTTPError(400, "Expected a list of rooms")
+
+        room_ids = data["rooms"]
+        if not room_ids or len(room_ids) > MAX_ROOMS:
+            raise cherrypy.HTTPError(400, "Between 1 and {0} rooms are allowed".format(MAX_ROOMS))
+        for index, room_id in enumerate(room_ids):
+            if not isinstance(room_id, str) or not room_id:
+                raise cherrypy.HTTPError(400, "Room {0} must be a room ID, alias or name".format(index))
+
+        payload = {
+            "results": self._controller.add_rooms(room_ids, token),
+            "contacts": self._controller.contacts(token)
+        }
+        return EndpointHelper.prepare_payload(self._controller, payload)
+
     @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
     def DELETE(self, room_id=None):
         """
         Removes a room from the user address book and returns all the remaining
@@ -86,18 +146,21 @@ class ContactsEndpoint(RestAPIEndpoint):
 
         - HTTP 400: the user must be authenticated first
         """
-        if not self._controller.is_auth:
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
             raise cherrypy.HTTPError(400, "User isn't logged in!")
 
         try:
             room_id = EndpointHelper.decode(room_id) # URL decoding
-            self._controller.remove_room(room_id)
+            self._controller.remove_room(room_id, token)
         except MatrixRequestError as e:
             raise cherrypy.HTTPError(e.code, e.content)
+        except cherrypy.HTTPError:
+            raise
         except Exception as e:
             raise cherrypy.HTTPError(500, str(e))
 
         payload = {
-            "contacts": self._controller.contacts
+            "contacts": self._controller.contacts(token)
         }
         return EndpointHelper.prepare_payload(self._controller, payload)
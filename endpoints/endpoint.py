@@ -2,8 +2,9 @@
 
 import abc
 import cherrypy
-import json
 import urllib
+import zlib
+from .serializer import JSONSerializer
 
 __all__ = ["RestAPIEndpoint", "EndpointHelper"]
 
@@ -56,6 +57,7 @@ class EndpointHelper(object):
     EndpointHelper provides several helper functions as static methods for all
     the endpoints.
     """
+    serializer = JSONSerializer() # replaced by the API with the configured backend
 
     @staticmethod
     def prepare_payload(controller, payload):
@@ -76,6 +78,33 @@ class EndpointHelper(object):
         payload["service"] = controller.service
         return payload
 
+    @staticmethod
+    def token():
+        """
+        Returns the API token of the current request, see `extract_token`.
+
+        __Returns__
+
+        - token: Matrix auth token or `None` when the request has no token
+        """
+        return getattr(cherrypy.request, "token", None)
+
+    @staticmethod
+    def extract_token():
+        """
+        CherryPy tool which takes the API token from the `Authorization: Bearer`
+        header or the `access_token` query parameter and stores it as
+        `cherrypy.request.token`. The query parameter is removed so it doesn't
+        reach the handlers, it's only needed for clients which can't set
+        headers like `EventSource`.
+        """
+        request = cherrypy.request
+        token = request.params.pop("access_token", None)
+        authorization = request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):].strip()
+        request.token = token
+
     @staticmethod
     def decode(text):
         """
@@ -92,12 +121,133 @@ class EndpointHelper(object):
         """
         return urllib.parse.unquote(text)
 
+    @staticmethod
+    def validate_etag(etag):
+        """
+        Compares the given ETag with the `If-None-Match` header of the request.
+
+        __Parameters__
+
+        - etag: current ETag of the resource or `None` if unknown
+
+        __Raises__
+
+        - HTTP 304: the client has already the current version of the resource
+        """
+        if etag is None:
+            return
+
+        cherrypy.response.headers["ETag"] = etag
+        cherrypy.lib.cptools.validate_etags()
+
+    @staticmethod
+    def set_etag(etag):
+        """
+        Sets the ETag header of the response, nothing is set if `etag` is `None`.
+
+        __Parameters__
+
+        - etag: current ETag of the resource or `None` if unknown
+        """
+        if etag is None:
+            cherrypy.response.headers.pop("ETag", None)
+        else:
+            cherrypy.response.headers["ETag"] = etag
+
+    @staticmethod
+    def json_handler(*args, **kwargs):
+        """
+        CherryPy `json_out` handler which encodes the payload with the
+        configured serializer. Payloads with iterators or long lists are
+        streamed in chunks while they're encoded.
+        """
+        value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+        if EndpointHelper.serializer.is_lazy(value):
+            cherrypy.serving.response.stream = True
+            return EndpointHelper.serializer.iterencode(value)
+        return EndpointHelper.serializer.dumps(value)
+
+    @staticmethod
+    def compress(mime_types=("application/json",), min_size=1024, level=6):
+        """
+        CherryPy tool which compresses the response body with gzip or deflate,
+        depending on the `Accept-Encoding` header of the request. Streamed
+        bodies are compressed chunk by chunk.
+
+        __Parameters__
+
+        - mime_types: content types to compress
+        - min_size: smaller bodies aren't compressed, streamed bodies are
+        always compressed
+        - level: zlib compression level
+        """
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        cherrypy.lib.set_vary_header(response, "Accept-Encoding")
+
+        if not response.body or "Content-Encoding" in response.headers:
+            return
+        if response.headers.get("Content-Type", "").split(";")[0].strip() not in mime_types:
+            return
+
+        # Pick the accepted encoding with the highest quality, gzip wins ties
+        encodings = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+        accepted = [element for element in request.headers.elements("Accept-Encoding")
+                    if element.value in encodings and element.qvalue > 0]
+        if not accepted:
+            return
+        encoding = max(accepted, key=lambda element: (element.qvalue, element.value == "gzip")).value
+
+        if not response.stream:
+            body = b"".join(response.body)
+            if len(body) < min_size:
+                response.body = body
+                return
+            response.body = [body]
+
+        compressor = zlib.compressobj(level, zlib.DEFLATED, encodings[encoding])
+        response.body = EndpointHelper._compressed(response.body, compressor)
+        response.headers["Content-Encoding"] = encoding
+        response.headers.pop("Content-Length", None)
+
+    @staticmethod
+    def _compressed(body, compressor):
+        for chunk in body:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
     @staticmethod
     def json_error_page(status, message, traceback, version):
         response = cherrypy.response
         response.headers["Content-Type"] = "application/json"
-        return json.dumps({
+        return EndpointHelper.serializer.dumps({
             "status": status,
             "message": message,
             "traceback": traceback
         })
+
+class DeadlineTool(cherrypy.Tool):
+    """
+    CherryPy tool which gives the request a deadline budget of `seconds`, the
+    homeserver calls of the request fail with HTTP 504 once it's spent.
+    """
+    def __init__(self):
+        super().__init__("on_start_resource", self._start)
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.serving.request.hooks.attach("on_end_request", self._clear)
+
+    def _start(self, seconds=10):
+        from resilience import set_deadline # enabled on the endpoints mounted with the Model
+        set_deadline(seconds)
+
+    def _clear(self):
+        from resilience import clear_deadline
+        clear_deadline()
+
+cherrypy.tools.access_token = cherrypy.Tool("before_handler", EndpointHelper.extract_token)
+cherrypy.tools.deadline = DeadlineTool()
+cherrypy.tools.compress = cherrypy.Tool("before_finalize", EndpointHelper.compress, priority=90)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+import cherrypy
+import cherrypy.lib.static
+from .endpoint import RestAPIEndpoint, EndpointHelper
+from matrix_client.errors import MatrixRequestError
+
+__all__ = ["MediaEndpoint"]
+
+# Content types rendered inline, the senders choose the content type: anything else could run scripts on our origin
+INLINE_TYPES = frozenset((
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/bmp",
+    "audio/mpeg", "audio/ogg", "audio/wav", "audio/webm", "audio/aac", "audio/flac", "audio/mp4",
+    "video/mp4", "video/webm", "video/ogg", "video/quicktime"
+))
+
+@cherrypy.popargs("server_name", "media_id") # /media/{server_name}/{media_id}
+class MediaEndpoint(RestAPIEndpoint):
+    """
+    __/media/{server_name}/{media_id}__ serves the images of the messages from
+    the local media cache.
+
+    Implemented HTTP REST methods:
+
+    - __GET__: Reads a media or its thumbnail
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+
+    def GET(self, server_name=None, media_id=None, thumbnail=None):
+        """
+        Reads a media, it's downloaded once from the homeserver of the user.
+        Partial requests with a `Range` header are supported. Browsers can pass
+        the API token as `access_token` parameter. The media is sandboxed, only
+        images, audio and video are displayed inline, other media are
+        downloaded as attachment.
+
+        __Parameters__
+
+        - thumbnail: any value returns the thumbnail of the media instead
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first or the media ID is invalid
+        - HTTP 404: the media doesn't exist
+        - HTTP 502: the homeserver can't be reached
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
+            raise cherrypy.HTTPError(400, "User isn't logged in!")
+
+        if server_name is None or media_id is None:
+            raise cherrypy.HTTPError(404, "Media ID missing")
+
+        try:
+            path, content_type = self._controller.media(server_name, media_id, thumbnail is not None, token)
+        except MatrixRequestError as e:
+            raise cherrypy.HTTPError(e.code, e.content)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
+        # Media content never changes
+        cherrypy.response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+        cherrypy.response.headers["X-Content-Type-Options"] = "nosniff"
+        cherrypy.response.headers["Content-Security-Policy"] = "sandbox"
+        if content_type.split(";")[0].strip().lower() in INLINE_TYPES:
+            return cherrypy.lib.static.serve_file(path, content_type)
+        return cherrypy.lib.static.serve_file(path, content_type, "attachment", media_id)
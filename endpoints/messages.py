@@ -2,6 +2,8 @@
 
 import cherrypy
 from .endpoint import RestAPIEndpoint, EndpointHelper
+from .stream import StreamEndpoint
+from matrix_client.errors import MatrixRequestError
 
 __all__ = ["MessagesEndpoint"]
 
@@ -12,42 +14,146 @@ class MessagesEndpoint(RestAPIEndpoint):
 
     Implemented HTTP REST methods:
 
-    - __GET__: Reads all the messages of the contact
-    - __POST__: Sends a new message to the contact
-    - __PUT__: Modifies a message (already sent)
+    - __GET__: Reads a page of messages of the contact
+    - __POST__: Queues a new message for the contact
+    - __PUT__: Moves the read marker of the contact
     - __DELETE__: Deletes a message (already sent)
     """
     def __init__(self, controller):
         super().__init__(controller)
+        self.stream = StreamEndpoint(self._controller)
 
-    @cherrypy.tools.json_out()
-    def GET(self, room_id): # remembers room_id from /contacts/{room_id}
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def GET(self, room_id, limit="10", direction="b", q=None, **params): # remembers room_id from /contacts/{room_id}
         """
+        Reads a page of messages in chronological order. The `end` cursor of
+        the response is passed as `from` to retrieve the next page.
+        With `q`, the messages of the contact matching the query are searched
+        instead, see __/search__.
+
+        __Parameters__
+
+        - from: cursor of a previous page, the latest messages are returned
+        when omitted
+        - limit: maximum number of messages (1-100), 10 by default
+        - direction: `b` pages back in time (default), `f` pages forward
+        - q: words to search
+
         __Raises__
 
-        - HTTP 400: the user must be authenticated first
+        - HTTP 400: the user must be authenticated first or the parameters are invalid
+        - HTTP 404: the room isn't joined
         """
-        if not self._controller.is_auth:
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
             raise cherrypy.HTTPError(400, "User isn't logged in!")
 
         room_id = EndpointHelper.decode(room_id)
 
-        payload = {
-            "messages": self._controller.messages(room_id)
-        }
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "limit must be a number")
+        if limit < 1 or limit > 100:
+            raise cherrypy.HTTPError(400, "limit must be between 1 and 100")
+        if direction not in ("b", "f"):
+            raise cherrypy.HTTPError(400, "direction must be 'b' or 'f'")
+
+        try:
+            if q is not None:
+                payload = self._controller.search(q, room_id, limit, params.get("from"), token)
+            else:
+                payload = self._controller.messages(room_id, params.get("from"), limit, direction, token)
+        except MatrixRequestError as e:
+            raise cherrypy.HTTPError(e.code, e.content)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
         return EndpointHelper.prepare_payload(self._controller, payload)
 
     @cherrypy.tools.json_in()
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
     def POST(self, room_id): # remembers room_id from /contacts/{room_id}
-        if not self._controller.is_auth:
+        """
+        Queues a text message, it's sent in the background. The response
+        is sent before the homeserver is contacted, the delivery status is
+        available at the `Location` of the response.
+
+        __Returns__
+
+        - HTTP 202: the message is queued
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first or the content is missing
+        - HTTP 404: the room isn't joined
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
             raise cherrypy.HTTPError(400, "User isn't logged in!")
 
         # Retrieve the JSON data
         data = cherrypy.request.json
+        if not isinstance(data, dict) or not isinstance(data.get("content"), str):
+            raise cherrypy.HTTPError(400, "content must be a text")
 
         room_id = EndpointHelper.decode(room_id)
+        try:
+            message_id = self._controller.queue_text(room_id, data["content"], token)
+        except MatrixRequestError as e:
+            raise cherrypy.HTTPError(e.code, e.content)
+
+        cherrypy.response.status = 202
+        cherrypy.response.headers["Location"] = "/outbox/{0}".format(message_id)
         payload = {
-            "send": self._controller.send_text(room_id, data["content"])
+            "id": message_id,
+            "status": "queued"
         }
         return EndpointHelper.prepare_payload(self._controller, payload)
+
+    @cherrypy.tools.json_in(force=False)
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def PUT(self, room_id): # remembers room_id from /contacts/{room_id}
+        """
+        Marks the messages of the contact as read up to the given event and
+        sends the read receipt to the homeserver. Without a body, all the
+        messages are marked as read.
+
+        ```json
+            {
+                "event_id": string, last read event, optional
+            }
+        ```
+
+        __Returns__
+
+        ```json
+            {
+                "id": string
+                "unread": number
+                "last_message": message
+                "last_seen": number
+            }
+        ```
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first or the event ID is invalid
+        - HTTP 404: the room isn't joined
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
+            raise cherrypy.HTTPError(400, "User isn't logged in!")
+
+        # Retrieve the JSON data, the body is optional
+        data = getattr(cherrypy.request, "json", None) or {}
+        if not isinstance(data, dict) or not isinstance(data.get("event_id", ""), str):
+            raise cherrypy.HTTPError(400, "event_id must be a text")
+
+        room_id = EndpointHelper.decode(room_id)
+        try:
+            payload = self._controller.mark_read(room_id, data.get("event_id"), token)
+        except MatrixRequestError as e:
+            raise cherrypy.HTTPError(e.code, e.content)
+
+        return EndpointHelper.prepare_payload(self._controller, payload)
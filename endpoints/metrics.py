@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import cherrypy
+import time
+from .endpoint import RestAPIEndpoint
+from metrics import REGISTRY
+
+__all__ = ["MetricsEndpoint", "MetricsTool"]
+
+REQUEST_DURATION = REGISTRY.histogram("transponder_http_request_duration_seconds",
+    "Duration of the HTTP requests by endpoint and method, streamed responses included.", ("endpoint", "method"))
+
+REQUESTS = REGISTRY.counter("transponder_http_requests_total",
+    "HTTP requests by endpoint, method and status code.", ("endpoint", "method", "status"))
+
+class MetricsEndpoint(RestAPIEndpoint):
+    """
+    __/metrics__ exposes the metrics of the daemon in the Prometheus text
+    format.
+
+    Implemented HTTP REST methods:
+
+    - __GET__: Reads all the metrics
+    """
+    def __init__(self, controller):
+        super().__init__(controller)
+
+    def GET(self):
+        """
+        Reads the request counts and latencies of the endpoints, the latencies
+        and errors of the Matrix.org SDK calls, the cache hits and misses and
+        the queue depth of the thread pools.
+        """
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return REGISTRY.render().encode("utf-8")
+
+class MetricsTool(cherrypy.Tool):
+    """
+    CherryPy tool which counts and times every request. The endpoint label is
+    the class of the endpoint handling the request, room IDs in the URL don't
+    create new series.
+    """
+    def __init__(self):
+        super().__init__("on_start_resource", self._start)
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.serving.request.hooks.attach("on_end_request", self._record)
+
+    def _start(self):
+        cherrypy.serving.request.metrics_start = time.monotonic()
+
+    def _record(self):
+        request = cherrypy.serving.request
+        start = getattr(request, "metrics_start", None)
+        if start is None:
+            return
+
+        # json_out replaces the handler with its own wrapper
+        handler = getattr(request, "_json_inner_handler", None) or request.handler
+        endpoint = getattr(getattr(handler, "callable", None), "__self__", None)
+        endpoint = "unmatched" if endpoint is None else type(endpoint).__name__
+        status = str(cherrypy.serving.response.status or "500").split(" ")[0]
+
+        REQUEST_DURATION.observe(time.monotonic() - start, endpoint=endpoint, method=request.method)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+
+cherrypy.tools.metrics = MetricsTool()
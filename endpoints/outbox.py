@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+import cherrypy
+from .endpoint import RestAPIEndpoint, EndpointHelper
+
+__all__ = ["OutboxEndpoint"]
+
+@cherrypy.popargs("message_id") # /outbox/{message_id}
+class OutboxEndpoint(RestAPIEndpoint):
+    """
+    __/outbox__ contains the delivery status of the messages queued with
+    __POST /contacts/{contact_id}/messages__.
+
+    Implemented HTTP REST methods:
+
+    - __GET__: Reads the status of a message or of all the undelivered messages
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def GET(self, message_id=None):
+        """
+        Reads the delivery status of a queued message. Without a message ID,
+        the queued and failed messages of the user are returned. Delivered
+        messages are forgotten after a day.
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first
+        - HTTP 404: the message is unknown
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
+            raise cherrypy.HTTPError(400, "User isn't logged in!")
+
+        if message_id is None:
+            payload = {
+                "messages": self._controller.delivery(token=token)
+            }
+            return EndpointHelper.prepare_payload(self._controller, payload)
+
+        status = self._controller.delivery(message_id, token)
+        if status is None:
+            raise cherrypy.HTTPError(404, "Unknown message {0}".format(message_id))
+
+        payload = {
+            "message": status
+        }
+        return EndpointHelper.prepare_payload(self._controller, payload)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import cProfile
+import cherrypy
+import os
+import re
+import time
+import uuid
+from .endpoint import RestAPIEndpoint, EndpointHelper
+
+__all__ = ["ProfilerEndpoint", "ProfileTool"]
+
+class ProfilerEndpoint(RestAPIEndpoint):
+    """
+    __/profiler__ controls the process-wide sampling profiler, only available
+    when `profiling.enabled` is set in the configuration.
+
+    Implemented HTTP REST methods:
+
+    - __GET__: Reads the hottest functions sampled so far
+    - __POST__: Starts sampling
+    - __DELETE__: Stops sampling and reads the hottest functions
+    """
+    def __init__(self, controller, profiler):
+        super().__init__(controller)
+        self._profiler = profiler
+
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def GET(self, limit="25"):
+        """
+        Reads the functions with the most samples of the current or last run.
+
+        __Parameters__
+
+        - limit: maximum number of functions (1-500)
+
+        __Raises__
+
+        - HTTP 400: the limit is invalid
+        - HTTP 403: profiling is disabled
+        """
+        self._check_enabled()
+        return EndpointHelper.prepare_payload(self._controller, self._profiler.report(self._limit(limit)))
+
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def POST(self):
+        """
+        Starts sampling the stacks of all the threads, the results of the
+        previous run are discarded.
+
+        __Parameters__
+
+        - interval: milliseconds between two samples (1-1000), 5 by default
+
+        __Raises__
+
+        - HTTP 400: the interval is invalid
+        - HTTP 403: profiling is disabled
+        - HTTP 409: the profiler is already running
+        """
+        self._check_enabled()
+        data = cherrypy.request.json
+        interval = data.get("interval", 5) if isinstance(data, dict) else None
+        if not isinstance(interval, (int, float)) or interval < 1 or interval > 1000:
+            raise cherrypy.HTTPError(400, "interval must be between 1 and 1000 milliseconds")
+
+        try:
+            self._profiler.start(interval / 1000.0)
+        except RuntimeError as e:
+            raise cherrypy.HTTPError(409, str(e))
+        return EndpointHelper.prepare_payload(self._controller, {"running": True})
+
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def DELETE(self, limit="25"):
+        """
+        Stops sampling and reads the functions with the most samples, see GET.
+
+        __Raises__
+
+        - HTTP 400: the limit is invalid
+        - HTTP 403: profiling is disabled
+        """
+        self._check_enabled()
+        limit = self._limit(limit)
+        self._profiler.stop()
+        return EndpointHelper.prepare_payload(self._controller, self._profiler.report(limit))
+
+    def _check_enabled(self):
+        if not self._controller.setting("profiling.enabled", False):
+            raise cherrypy.HTTPError(403, "Profiling is disabled")
+
+    def _limit(self, limit):
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "limit must be a number")
+        if limit < 1 or limit > 500:
+            raise cherrypy.HTTPError(400, "limit must be between 1 and 500")
+        return limit
+
+class ProfileTool(cherrypy.Tool):
+    """
+    CherryPy tool which runs the handler of a request under cProfile when the
+    request has a `X-Profile` header or a `profile` query parameter and
+    `profiling.enabled` is set in the configuration. The statistics are
+    written in the pstats format to `profiling.directory`, the file name is
+    returned in the `X-Profile-File` header.
+    """
+    def __init__(self):
+        super().__init__("before_handler", self._wrap, priority=90) # wraps the json_out handler as well
+
+    def _wrap(self):
+        request = cherrypy.serving.request
+        flag = request.params.pop("profile", None) # never reaches the handlers
+        if flag is None and "X-Profile" not in request.headers:
+            return
+        if not cherrypy.config.get("profiling.enabled", False) or request.handler is None:
+            return
+
+        handler = request.handler
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(handler, *args, **kwargs)
+            finally:
+                cherrypy.serving.response.headers["X-Profile-File"] = self._dump(profile, request)
+        request.handler = profiled
+
+    def _dump(self, profile, request):
+        directory = os.path.expanduser(cherrypy.config.get("profiling.directory", "~/.transponder-matrix/profiles"))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        route = re.sub(r"[^A-Za-z0-9]+", "_", request.script_name + request.path_info).strip("_")[:60] or "root"
+        name = "{0}-{1}-{2}-{3}.pstats".format(time.strftime("%Y%m%dT%H%M%S"), request.method, route, uuid.uuid4().hex[:6])
+        profile.dump_stats(os.path.join(directory, name))
+        return name
+
+cherrypy.tools.profile = ProfileTool()
@@ -1,10 +1,37 @@
 #!/usr/bin/python3
 
 import cherrypy
+from .endpoint import EndpointHelper
 
-__all__ = ["Root"]
+__all__ = ["RootEndpoint"]
 
 class RootEndpoint(object):
+    """
+    __/__ answers as soon as the webserver listens, it's the health check of
+    the daemon. The other endpoints are mounted once the daemon has started,
+    their requests are answered with HTTP 503 until then.
+    """
+    def __init__(self, startup):
+        self._startup = startup
+
     @cherrypy.expose
     def index(self):
         return "Hello world"
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def startup(self):
+        """
+        Reads the duration of the startup phases, see `StartupTimer.report`.
+        """
+        return self._startup.report()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def default(self, *args, **kwargs):
+        if self._startup.ready:
+            raise cherrypy.NotFound()
+        # Not raised as HTTPError, CherryPy removes the Retry-After header of errors
+        cherrypy.response.status = 503
+        cherrypy.response.headers["Retry-After"] = "1"
+        return {"status": "503 Service Unavailable", "message": "The daemon is starting"}
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+import cherrypy
+from .endpoint import RestAPIEndpoint, EndpointHelper
+from matrix_client.errors import MatrixRequestError
+
+__all__ = ["SearchEndpoint"]
+
+class SearchEndpoint(RestAPIEndpoint):
+    """
+    __/search__ finds the messages of all the contacts matching a query.
+
+    Implemented HTTP REST methods:
+
+    - __GET__: Reads a page of matching messages, the most relevant first
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def GET(self, q=None, limit="20", contact_id=None, **params):
+        """
+        Searches the text messages received by the daemon and the messages
+        read from the history of the contacts. All the words of the query
+        must match, the last word matches as a prefix. The `end` cursor of
+        the response is passed as `from` to retrieve the next page.
+
+        __Parameters__
+
+        - q: words to search
+        - limit: maximum number of results (1-100), 20 by default
+        - contact_id: only search the messages of this contact
+        - from: cursor of a previous page
+
+        __Returns__
+
+        ```json
+            {
+                "results": [
+                    {
+                        "room_id": string
+                        "event_id": string
+                        "snippet": string, matched words between brackets
+                        "rank": number, lower is more relevant
+                        "message": message
+                    },
+                    ...
+                ]
+                "start": string
+                "end": string, `null` after the last page
+            }
+        ```
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first or the parameters are invalid
+        - HTTP 404: the contact isn't joined
+        - HTTP 501: the SQLite library doesn't support full-text search
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
+            raise cherrypy.HTTPError(400, "User isn't logged in!")
+
+        if q is None or not q.strip():
+            raise cherrypy.HTTPError(400, "q must contain the words to search")
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "limit must be a number")
+        if limit < 1 or limit > 100:
+            raise cherrypy.HTTPError(400, "limit must be between 1 and 100")
+        if contact_id is not None:
+            contact_id = EndpointHelper.decode(contact_id)
+
+        try:
+            payload = self._controller.search(q, contact_id, limit, params.get("from"), token)
+        except MatrixRequestError as e:
+            raise cherrypy.HTTPError(e.code, e.content)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
+        return EndpointHelper.prepare_payload(self._controller, payload)
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+import functools
+import json
+
+try:
+    import orjson # optional, several times faster than the standard library
+except ImportError:
+    orjson = None
+
+__all__ = ["JSONSerializer"]
+
+class JSONSerializer(object):
+    """
+    JSONSerializer encodes the payloads of the endpoints with the fastest
+    available backend: `orjson` when it's installed, the standard library
+    otherwise.
+
+    Large payloads are encoded incrementally: iterators and long lists are
+    encoded item by item so the complete JSON document never has to be held in
+    memory. Objects with a `to_json` method, like the normalized messages, are
+    encoded as the value it returns.
+    """
+    BACKENDS = ("auto", "orjson", "json")
+    CHUNK_SIZE = 16 * 1024 # bytes collected before a chunk is yielded
+    STREAM_ITEMS = 100 # lists with more items are encoded incrementally
+
+    def __init__(self, backend="auto"):
+        """
+        __Parameters__
+
+        - backend: `auto` picks the fastest installed backend, `orjson` or
+        `json` force a backend
+
+        __Raises__
+
+        - ValueError: the backend is unknown or not installed
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown JSON backend {0}, expected one of {1}".format(backend, ", ".join(self.BACKENDS)))
+        if backend == "orjson" and orjson is None:
+            raise ValueError("The orjson JSON backend isn't installed")
+
+        if orjson is not None and backend != "json":
+            self.backend = "orjson"
+            self._dumps = functools.partial(orjson.dumps, default=_to_json)
+        else:
+            self.backend = "json"
+            encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_to_json)
+            self._dumps = lambda value: encoder.encode(value).encode("utf-8")
+
+    def dumps(self, value):
+        """
+        Encodes a value at once.
+
+        __Parameters__
+
+        - value: JSON serializable value, iterators are encoded as lists
+
+        __Returns__
+
+        - json: UTF-8 encoded JSON document
+        """
+        if self.is_lazy(value):
+            return b"".join(self.iterencode(value))
+        return self._dumps(value)
+
+    def is_lazy(self, value):
+        """
+        Checks if a payload should be encoded incrementally: it contains an
+        iterator or a long list at its top level.
+
+        __Parameters__
+
+        - value: JSON serializable value
+
+        __Returns__
+
+        - lazy: `True` if `iterencode` should be used
+        """
+        if isinstance(value, dict):
+            return any(self._is_lazy_item(item) for item in value.values())
+        return self._is_lazy_item(value)
+
+    def iterencode(self, value):
+        """
+        Encodes a value incrementally.
+
+        __Parameters__
+
+        - value: JSON serializable value, iterators are consumed while encoding
+
+        __Returns__
+
+        - chunks: generator of UTF-8 encoded JSON chunks
+        """
+        chunk = []
+        size = 0
+        for part in self._encode(value):
+            chunk.append(part)
+            size += len(part)
+            if size >= self.CHUNK_SIZE:
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b"".join(chunk)
+
+    def _is_lazy_item(self, value):
+        if isinstance(value, (list, tuple)):
+            return len(value) > self.STREAM_ITEMS
+        return not isinstance(value, (dict, str, bytes)) and hasattr(value, "__iter__")
+
+    def _encode(self, value):
+        if isinstance(value, dict) and self.is_lazy(value):
+            yield b"{"
+            for index, (key, item) in enumerate(value.items()):
+                yield (b"," if index else b"") + self._dumps(str(key)) + b":"
+                yield from self._encode(item)
+            yield b"}"
+        elif self._is_lazy_item(value):
+            yield b"["
+            for index, item in enumerate(value):
+                yield (b"," if index else b"") + self._dumps(item)
+            yield b"]"
+        else:
+            yield self._dumps(value)
+
+def _to_json(value):
+    if not hasattr(value, "to_json"):
+        raise TypeError("Object of type {0} is not JSON serializable".format(type(value).__name__))
+    return value.to_json()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import cherrypy
+import threading
+import time
+from .endpoint import RestAPIEndpoint, EndpointHelper
+
+__all__ = ["StreamEndpoint"]
+
+class StreamEndpoint(RestAPIEndpoint):
+    """
+    __/stream__ and __/{contact_id}/messages/stream__ push new messages of all
+    the contacts or a single contact the moment the sync listener receives them.
+
+    Implemented HTTP REST methods:
+
+    - __GET__: Streams new messages as Server-Sent Events or long-polls them
+    """
+    KEEPALIVE = 15 # seconds between keep-alive comments of an idle event stream
+    MAX_DURATION = 300 # seconds before an event stream is closed, clients reconnect with Last-Event-ID
+    _subscribers = None # semaphore shared by all the stream endpoints, every subscriber holds a worker thread
+
+    def __init__(self, controller):
+        super().__init__(controller)
+        if StreamEndpoint._subscribers is None:
+            StreamEndpoint._subscribers = threading.BoundedSemaphore(
+                controller.setting("stream.max_subscribers", 4))
+
+    def GET(self, room_id=None, since=None, timeout="30"): # remembers room_id from /contacts/{room_id}
+        """
+        Clients which accept `text/event-stream` receive a Server-Sent Events
+        stream, the `id` of each event is its cursor. Other clients long-poll:
+        the request blocks until new messages arrive or the timeout expires.
+
+        __Parameters__
+
+        - since: cursor of the last received message, the `Last-Event-ID`
+        header is used for event streams. Only new messages are returned when
+        omitted.
+        - timeout: maximum number of seconds a long-poll waits (1-60)
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first or the parameters are invalid
+        - HTTP 503: too many clients are streaming, retry later
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
+            raise cherrypy.HTTPError(400, "User isn't logged in!")
+
+        if room_id is not None:
+            room_id = EndpointHelper.decode(room_id)
+
+        since = cherrypy.request.headers.get("Last-Event-ID", since)
+        try:
+            cursor = self._controller.events_cursor(token) if since is None else int(since)
+            timeout = int(timeout)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "since and timeout must be numbers")
+        if timeout < 1 or timeout > 60:
+            raise cherrypy.HTTPError(400, "timeout must be between 1 and 60")
+
+        # Idle subscribers would take all the worker threads of the webserver
+        if not self._subscribers.acquire(blocking=False):
+            # Not raised as HTTPError, CherryPy removes the Retry-After header of errors
+            cherrypy.response.status = 503
+            cherrypy.response.headers["Retry-After"] = str(self.KEEPALIVE)
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return EndpointHelper.serializer.dumps({
+                "status": "503 Service Unavailable",
+                "message": "Too many streaming clients"
+            })
+        # Released once the response is sent, after the last event of a stream
+        cherrypy.request.hooks.attach("on_end_request", self._subscribers.release)
+
+        if "text/event-stream" in cherrypy.request.headers.get("Accept", ""):
+            cherrypy.response.headers["Content-Type"] = "text/event-stream"
+            cherrypy.response.headers["Cache-Control"] = "no-cache"
+            cherrypy.response.stream = True
+            return self._event_stream(room_id, cursor, token)
+
+        events, cursor = self._controller.wait_events(cursor, room_id, timeout, token)
+        payload = {
+            "events": events,
+            "cursor": cursor
+        }
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        return EndpointHelper.serializer.dumps(EndpointHelper.prepare_payload(self._controller, payload))
+
+    def _event_stream(self, room_id, cursor, token):
+        """
+        Generator of the Server-Sent Events, runs until the maximum duration is
+        reached, the engine stops or the client disconnects.
+        """
+        deadline = time.monotonic() + self.MAX_DURATION
+        while time.monotonic() < deadline and cherrypy.engine.state == cherrypy.engine.states.STARTED:
+            try:
+                events, cursor = self._controller.wait_events(cursor, room_id, self.KEEPALIVE, token)
+            except cherrypy.HTTPError:
+                return # the session was closed, the headers are sent already
+            if not events:
+                yield b": keep-alive\n\n"
+                continue
+
+            for event in events:
+                yield "id: {0}\nevent: message\ndata: ".format(event["cursor"]).encode("utf-8") \
+                    + EndpointHelper.serializer.dumps(event) + b"\n\n"
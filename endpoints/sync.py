@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+import cherrypy
+from .endpoint import RestAPIEndpoint, EndpointHelper
+
+__all__ = ["SyncEndpoint"]
+
+class SyncEndpoint(RestAPIEndpoint):
+    """
+    __/sync__ returns the contacts and the messages which changed since the
+    previous refresh of the client, in a single response.
+
+    Implemented HTTP REST methods:
+
+    - __GET__: Reads the changes since a cursor
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+
+    @cherrypy.tools.json_out(handler=EndpointHelper.json_handler)
+    def GET(self, since=None):
+        """
+        Without `since`, all the contacts are returned with the cursor of the
+        next call. With `since`, only the new and changed contacts, the IDs of
+        the removed contacts and the new messages are returned. When the
+        changes can't be computed anymore, `full` is `true` and all the
+        contacts are returned like on the first call.
+
+        __Parameters__
+
+        - since: `cursor` of the previous response
+
+        __Returns__
+
+        ```json
+            {
+                "cursor": string
+                "full": boolean
+                "contacts": [contact, ...]
+                "removed": [string, ...]
+                "messages": [
+                    {
+                        "cursor": number
+                        "room_id": string
+                        "message": message
+                    },
+                    ...
+                ]
+            }
+        ```
+
+        __Raises__
+
+        - HTTP 400: the user must be authenticated first or the cursor is invalid
+        """
+        token = EndpointHelper.token()
+        if not self._controller.is_auth(token):
+            raise cherrypy.HTTPError(400, "User isn't logged in!")
+
+        try:
+            payload = self._controller.sync(since, token)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
+        return EndpointHelper.prepare_payload(self._controller, payload)
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+"""
+The EventStore bounds the memory of the buffered messages of all the room
+histories. Messages are kept in compact EventBuffers: senders and message
+types are interned, timestamps and interned IDs live in typed arrays.
+"""
+
+import array
+import collections
+import sys
+import threading
+from normalizer import Message
+
+__all__ = ["EventStore", "EventBuffer", "Entry"]
+
+# A buffered message, `token` is a Matrix pagination token located after the event
+Entry = collections.namedtuple("Entry", ["event_id", "token", "message"])
+
+NO_TIMESTAMP = -1
+
+class Interner(object):
+    """
+    Two-way table of strings and their numeric IDs, a string repeated in
+    every message is stored once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._strings = []
+
+    def id(self, string):
+        index = self._ids.get(string)
+        if index is None:
+            with self._lock:
+                index = self._ids.get(string)
+                if index is None:
+                    index = self._ids[string] = len(self._strings)
+                    self._strings.append(sys.intern(string) if type(string) is str else string)
+        return index
+
+    def string(self, index):
+        return self._strings[index]
+
+    def __len__(self):
+        return len(self._strings)
+
+class EventBuffer(object):
+    """
+    Bounded ring buffer of messages stored column by column. It implements
+    the part of the `collections.deque` interface the RoomHistory needs and
+    grows its columns on demand up to `maxlen` messages. Not thread-safe, the
+    RoomHistory holds its lock.
+    """
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, maxlen, senders, types):
+        """
+        __Parameters__
+
+        - maxlen: maximum number of messages, the oldest message is dropped
+        when a message is appended to a full buffer
+        - senders: Interner of the sender IDs
+        - types: Interner of the message types
+        """
+        self.maxlen = maxlen
+        self._senders = senders
+        self._types = types
+        self.clear()
+
+    def __len__(self):
+        return self._length
+
+    def clear(self):
+        self._start = 0   # physical index of the oldest message
+        self._length = 0
+        self._capacity = 0
+        self._bytes = 0   # size of the strings owned by the buffer
+        self._event_ids = []
+        self._tokens = []
+        self._contents = []
+        self._sender_ids = array.array("I")
+        self._type_ids = array.array("H")
+        self._timestamps = array.array("q")
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("EventBuffer index out of range")
+        return self._entry((self._start + index) % self._capacity)
+
+    @property
+    def nbytes(self):
+        """
+        Estimated memory used by the buffer in bytes.
+        """
+        columns = (self._event_ids, self._tokens, self._contents)
+        arrays = (self._sender_ids, self._type_ids, self._timestamps)
+        return self._bytes + sum(sys.getsizeof(column) for column in columns) \
+            + sum(column.itemsize * len(column) for column in arrays)
+
+    def append(self, entry):
+        if self.maxlen == 0:
+            return
+        if self._length == self.maxlen:
+            self._release(self._start)
+            self._start = (self._start + 1) % self._capacity
+            self._length -= 1
+        elif self._length == self._capacity:
+            self._grow()
+        self._store((self._start + self._length) % self._capacity, entry)
+        self._length += 1
+
+    def appendleft(self, entry):
+        if self._length == self.maxlen:
+            raise IndexError("EventBuffer is full")
+        if self._length == self._capacity:
+            self._grow()
+        self._start = (self._start - 1) % self._capacity
+        self._store(self._start, entry)
+        self._length += 1
+
+    def __setitem__(self, index, entry):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("EventBuffer index out of range")
+        position = (self._start + index) % self._capacity
+        self._release(position)
+        self._store(position, entry)
+
+    def find(self, event_id):
+        """
+        Returns the index of the message of an event, `None` if it isn't
+        buffered.
+        """
+        for index in range(self._length):
+            if self._event_ids[(self._start + index) % self._capacity] == event_id:
+                return index
+        return None
+
+    def slice(self, low, high):
+        """
+        Returns the entries `low` to `high` (excluded) in chronological order.
+        """
+        return [self._entry((self._start + index) % self._capacity)
+                for index in range(max(low, 0), min(high, self._length))]
+
+    def _entry(self, position):
+        timestamp = self._timestamps[position]
+        return Entry(self._event_ids[position], self._tokens[position], Message(
+            self._types.string(self._type_ids[position]),
+            self._senders.string(self._sender_ids[position]),
+            self._contents[position],
+            None if timestamp == NO_TIMESTAMP else timestamp
+        ))
+
+    def _store(self, position, entry):
+        message = entry.message
+        self._event_ids[position] = entry.event_id
+        self._tokens[position] = entry.token
+        self._contents[position] = message.content
+        self._sender_ids[position] = self._senders.id(message.sender)
+        self._type_ids[position] = self._types.id(message.type)
+        self._timestamps[position] = NO_TIMESTAMP if message.timestamp is None else message.timestamp
+        self._bytes += sys.getsizeof(entry.event_id) + sys.getsizeof(message.content)
+
+    def _release(self, position):
+        self._bytes -= sys.getsizeof(self._event_ids[position]) + sys.getsizeof(self._contents[position])
+        self._event_ids[position] = self._tokens[position] = self._contents[position] = None
+
+    def _grow(self):
+        # Unrolls the ring into columns of twice the size, the oldest message first
+        capacity = min(self.maxlen, max(self.INITIAL_CAPACITY, self._capacity * 2))
+        order = [(self._start + index) % self._capacity for index in range(self._length)]
+        padding = capacity - self._length
+        for name in ("_event_ids", "_tokens", "_contents"):
+            column = getattr(self, name)
+            setattr(self, name, [column[index] for index in order] + [None] * padding)
+        for name in ("_sender_ids", "_type_ids", "_timestamps"):
+            column = getattr(self, name)
+            setattr(self, name, array.array(column.typecode, [column[index] for index in order] + [0] * padding))
+        self._start = 0
+        self._capacity = capacity
+
+class EventStore(object):
+    """
+    Memory budget of the buffered messages of all the sessions.
+
+    Every RoomHistory reports the size of its buffer after a change. When the
+    total exceeds `max_bytes`, the buffers of the least recently used rooms
+    are evicted until the total is back under the budget, their messages are
+    read from the homeserver again when they're requested.
+    """
+    def __init__(self, room_events=500, max_bytes=64 * 1024 * 1024):
+        """
+        __Parameters__
+
+        - room_events: maximum number of buffered messages per room
+        - max_bytes: memory budget of all the buffers in bytes
+        """
+        self.room_events = room_events
+        self.max_bytes = max_bytes
+        self.senders = Interner()
+        self.types = Interner()
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._histories = collections.OrderedDict() # RoomHistory: (bytes, events), least recently used first
+        self._bytes = 0
+        self._events = 0
+
+    def buffer(self):
+        """
+        Creates the empty EventBuffer of a room.
+        """
+        return EventBuffer(self.room_events, self.senders, self.types)
+
+    def update(self, history, nbytes, events):
+        """
+        Records the size of a buffer and marks its room as recently used,
+        evicts cold rooms when the budget is exceeded. The caller must not
+        hold the lock of a RoomHistory.
+
+        __Parameters__
+
+        - history: RoomHistory of the buffer
+        - nbytes: size of the buffer in bytes
+        - events: number of buffered messages
+        """
+        victims = []
+        with self._lock:
+            previous_bytes, previous_events = self._histories.pop(history, (0, 0))
+            self._histories[history] = (nbytes, events)
+            self._bytes += nbytes - previous_bytes
+            self._events += events - previous_events
+
+            for cold, (cold_bytes, cold_events) in self._histories.items():
+                if self._bytes <= self.max_bytes or cold is history:
+                    break
+                victims.append(cold)
+                self._bytes -= cold_bytes
+                self._events -= cold_events
+            for victim in victims:
+                self._histories[victim] = (0, 0)
+                self._histories.move_to_end(victim, last=False)
+            self.evictions += len(victims)
+
+        for victim in victims:
+            victim.evict()
+
+    def touch(self, history):
+        """
+        Marks a room as recently used.
+        """
+        with self._lock:
+            if history in self._histories:
+                self._histories.move_to_end(history)
+
+    def remove(self, history):
+        """
+        Releases the buffer of a room which isn't used anymore, for example
+        after leaving it.
+        """
+        with self._lock:
+            nbytes, events = self._histories.pop(history, (0, 0))
+            self._bytes -= nbytes
+            self._events -= events
+
+    def report(self):
+        """
+        Returns the memory usage of the buffered messages.
+
+        __Returns__
+
+        - report: dictionary
+
+        ```json
+            {
+                "rooms": number, rooms with buffered messages
+                "events": number, buffered messages
+                "bytes": number, estimated memory of the buffers
+                "max_bytes": number, memory budget
+                "interned": number, interned senders and message types
+                "evictions": number, rooms evicted since the start
+            }
+        ```
+        """
+        with self._lock:
+            return {
+                "rooms": sum(1 for _, events in self._histories.values() if events),
+                "events": self._events,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "interned": len(self.senders) + len(self.types),
+                "evictions": self.evictions
+            }
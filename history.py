@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+
+"""
+The RoomHistory keeps the most recent normalized messages of a room in a
+bounded ring buffer and pages through older messages with Matrix pagination
+tokens.
+"""
+
+import threading
+from eventstore import Entry
+from metrics import CACHE_REQUESTS
+
+__all__ = ["RoomHistory"]
+
+class RoomHistory(object):
+    """
+    Bounded, cursor-paginated message history of a room.
+
+    Every buffered message gets a sequence number, a cursor `s<seq>` points
+    to the position just before that message. Pages beyond the ring buffer
+    are read through from the homeserver with `t<token>` cursors which wrap a
+    Matrix pagination token. Each page costs O(page), regardless of the size
+    of the history.
+
+    The ring buffer is an EventBuffer of the EventStore, which may evict it
+    when the memory budget of all the rooms is exceeded. The history then
+    backfills from the homeserver again.
+    """
+    MAX_BACKFILL_ROUNDS = 5 # a page may contain events we don't show
+
+    def __init__(self, fetch, normalize, token, store):
+        """
+        __Parameters__
+
+        - fetch: `fetch(token, direction, limit)` returns the raw events and
+        the next Matrix pagination token
+        - normalize: `normalize(events)` generates `(event_id, message)` for
+        the events shown to the user
+        - token: Matrix pagination token located after the latest event
+        - store: EventStore providing the ring buffer
+        """
+        self._fetch = fetch
+        self._normalize = normalize
+        self._store = store
+        self._lock = threading.Lock()
+        self._backfill_lock = threading.Lock()
+        self._entries = store.buffer()
+        self._event_ids = set()
+        self._tail = 0              # sequence number of the next live message
+        self._back_token = token    # pagination token before the oldest buffered message
+        self._complete = False      # the creation of the room has been reached
+
+    def append(self, event_id, token, message):
+        """
+        Adds a live message from the sync listener to the history.
+
+        __Parameters__
+
+        - event_id: Matrix ID of the event
+        - token: Matrix pagination token located after the event
+        - message: normalized message
+        """
+        with self._lock:
+            if event_id in self._event_ids:
+                return
+            if len(self._entries) == self._entries.maxlen:
+                # Older messages are read through from the homeserver from now on
+                self._event_ids.discard(self._entries[0].event_id)
+                self._back_token = None
+                self._complete = False
+            self._entries.append(Entry(event_id, token, message))
+            self._event_ids.add(event_id)
+            self._tail += 1
+        self._update_store()
+
+    def redact(self, event_id):
+        """
+        Replaces a buffered message by its redacted placeholder.
+
+        __Parameters__
+
+        - event_id: Matrix ID of the redacted event
+
+        __Returns__
+
+        - redacted: `True` if the message was buffered
+        """
+        with self._lock:
+            if event_id not in self._event_ids:
+                return False
+            index = self._entries.find(event_id)
+            entry = self._entries[index]
+            self._entries[index] = entry._replace(message=entry.message.redacted())
+        self._update_store()
+        return True
+
+    def evict(self):
+        """
+        Drops the buffered messages, the next pages backfill from the
+        homeserver. Called by the EventStore.
+        """
+        with self._lock:
+            if not self._entries:
+                return
+            self._back_token = self._entries[-1].token # located after the latest buffered message
+            self._complete = False
+            self._entries.clear()
+            self._event_ids.clear()
+
+    def page(self, cursor=None, limit=10, direction="b", cached=False):
+        """
+        Returns a page of messages in chronological order.
+
+        __Parameters__
+
+        - cursor: position to start from, `None` starts at the latest message
+        - limit: maximum number of messages in the page
+        - direction: `b` pages back in time, `f` pages forward
+        - cached: `True` only returns buffered messages, the homeserver isn't
+        contacted. The `end` cursor of a page past the buffer is its `start`.
+
+        __Returns__
+
+        - messages: list of messages
+        - start: cursor of the requested position
+        - end: cursor to request the next page with, `None` when the
+        beginning of the room has been reached
+
+        __Raises__
+
+        - ValueError: the cursor is invalid or points before the ring buffer
+        after it wrapped around
+        """
+        if cursor is not None and cursor.startswith("t"):
+            if cached:
+                return [], cursor, cursor
+            CACHE_REQUESTS.inc(cache="history", result="miss")
+            messages, end = self._read_through(cursor[1:], limit, direction)
+            return messages, cursor, end
+
+        with self._lock:
+            position = self._tail if cursor is None else self._parse(cursor)
+        start = "s{0}".format(position)
+        self._store.touch(self)
+
+        if direction == "f":
+            with self._lock:
+                position = max(position, self._head)
+                entries = self._slice(position, min(position + limit, self._tail))
+                CACHE_REQUESTS.inc(cache="history", result="hit")
+                return [entry.message for entry in entries], start, "s{0}".format(position + len(entries))
+
+        # Fill the ring buffer with older messages when there's room left
+        rounds = 0
+        if not cached: # a stalled backfill holds the lock
+            with self._backfill_lock:
+                while position - self._head < limit and self._can_backfill() \
+                        and rounds < self.MAX_BACKFILL_ROUNDS:
+                    self._backfill(limit)
+                    rounds += 1
+        if rounds:
+            self._update_store()
+
+        with self._lock:
+            position = min(position, self._tail)
+            if position > self._head:
+                low = max(self._head, position - limit)
+                entries = self._slice(low, position)
+                end = "s{0}".format(low)
+                if low == self._head and self._complete:
+                    end = None
+                CACHE_REQUESTS.inc(cache="history", result="miss" if rounds else "hit")
+                return [entry.message for entry in entries], start, end
+
+            # Nothing older buffered: read through from the homeserver
+            CACHE_REQUESTS.inc(cache="history", result="miss" if rounds or not self._complete else "hit")
+            if self._complete:
+                return [], start, None
+            if cached:
+                return [], start, start
+            if position < self._head:
+                # The messages before the cursor wrapped out of the buffer, reading
+                # through from the oldest buffered message would repeat newer ones
+                raise ValueError("Expired cursor: {0}".format(start))
+            back_token = self._back_token
+            oldest = self._entries[0] if self._entries else None
+
+        if back_token is not None:
+            messages, end = self._read_through(back_token, limit, "b")
+        elif oldest is None:
+            return [], start, None
+        else:
+            messages, end = self._read_through(oldest.token, limit, "b", oldest.event_id)
+        return messages, start, end
+
+    @property
+    def _head(self):
+        return self._tail - len(self._entries)
+
+    def _parse(self, cursor):
+        if not cursor.startswith("s"):
+            raise ValueError("Invalid cursor: {0}".format(cursor))
+        try:
+            return int(cursor[1:])
+        except ValueError:
+            raise ValueError("Invalid cursor: {0}".format(cursor))
+
+    def _slice(self, low, high):
+        return self._entries.slice(low - self._head, high - self._head)
+
+    def _update_store(self):
+        # Called without the lock, the EventStore may evict other histories
+        with self._lock:
+            nbytes, events = self._entries.nbytes, len(self._entries)
+        self._store.update(self, nbytes, events)
+
+    def _can_backfill(self):
+        with self._lock:
+            return not self._complete and self._back_token is not None \
+                and len(self._entries) < self._entries.maxlen
+
+    def _backfill(self, limit):
+        """
+        Prepends a chunk of older messages to the ring buffer.
+        """
+        with self._lock:
+            token = self._back_token
+        events, end = self._fetch(token, "b", limit)
+
+        with self._lock:
+            if self._back_token != token:
+                return # the buffer wrapped around while fetching
+            for event_id, message in self._normalize(events): # newest first
+                if len(self._entries) == self._entries.maxlen:
+                    self._back_token = None # read through from the oldest message
+                    return
+                if event_id in self._event_ids:
+                    continue
+                self._entries.appendleft(Entry(event_id, token, message))
+                self._event_ids.add(event_id)
+            self._back_token = end
+            if not events or end is None or end == token:
+                self._complete = True
+
+    def _read_through(self, token, limit, direction, skip_until=None):
+        """
+        Reads a page straight from the homeserver without buffering it.
+        When `skip_until` is given, the events up to and including that event
+        are skipped, they are already buffered.
+        """
+        messages = []
+        rounds = 0
+        while len(messages) < limit and rounds < self.MAX_BACKFILL_ROUNDS:
+            events, end = self._fetch(token, direction, limit - len(messages))
+            for event_id, message in self._normalize(events):
+                if skip_until is not None:
+                    if event_id == skip_until:
+                        skip_until = None
+                    continue
+                messages.append(message)
+            rounds += 1
+            if not events or end is None or end == token:
+                token = None
+                break
+            token = end
+
+        if direction == "b":
+            messages.reverse() # chronological order
+        cursor = None if token is None else "t{0}".format(token)
+        return messages, cursor
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+
+"""
+The MediaCache keeps the Matrix media (MXC) content on the local disk so every
+image is downloaded only once from the homeserver.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import requests
+from matrix_client.errors import MatrixRequestError
+from metrics import CACHE_REQUESTS
+from resilience import DeadlineAdapter, HomeserverUnavailable, remaining
+
+__all__ = ["MediaCache"]
+
+class MediaCache(object):
+    """
+    Size-bounded LRU disk cache of media content and thumbnails.
+
+    Every file is stored next to a small JSON file with its content type. The
+    least recently used files are removed once the cache exceeds its size,
+    concurrent requests of the same file share a single download. Downloads
+    are bounded by the deadline of the request and the circuit breaker of the
+    homeserver, like the SDK calls.
+    """
+    MXC_REGEX = re.compile(r"^mxc://([A-Za-z0-9.:\[\]-]+)/([A-Za-z0-9_-]+)$")
+    THUMBNAIL = {"width": 320, "height": 240, "method": "scale"} # precomputed by the homeserver
+    CHUNK_SIZE = 64 * 1024 # bytes read at once from the homeserver
+    TIMEOUT = 30 # seconds to wait for the homeserver
+
+    def __init__(self, directory, max_size, executor):
+        """
+        __Parameters__
+
+        - directory: location of the cached files, created when missing
+        - max_size: maximum number of bytes of all the cached files
+        - executor: thread pool for the thumbnails prefetched in the background
+        """
+        self._directory = directory
+        self._max_size = max_size
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key: (size, content_type), least recently used first
+        self._size = 0
+        self._downloads = {} # key: threading.Event of the running download
+        self._http = requests.Session()
+        self._http.mount("http://", DeadlineAdapter())
+        self._http.mount("https://", DeadlineAdapter())
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._load()
+
+    @classmethod
+    def local_url(cls, mxc):
+        """
+        Converts a Matrix MXC link to the URL of the media endpoint.
+
+        __Parameters__
+
+        - mxc: Matrix MXC link `mxc://{server_name}/{media_id}`
+
+        __Returns__
+
+        - url: `/media/{server_name}/{media_id}` or `None` for invalid links
+        """
+        match = cls.MXC_REGEX.match(mxc or "")
+        if match is None:
+            return None
+        return "/media/{0}/{1}".format(*match.groups())
+
+    def get(self, server, mxc, thumbnail=False, breaker=None):
+        """
+        Returns the cached file of a media, it's downloaded from the homeserver
+        when missing.
+
+        __Parameters__
+
+        - server: Matrix server URL to download the media from
+        - mxc: Matrix MXC link of the media
+        - thumbnail: `True` returns the thumbnail of the media
+        - breaker: CircuitBreaker of the homeserver, optional
+
+        __Raises__
+
+        - ValueError: the MXC link is invalid
+        - MatrixRequestError: the homeserver can't deliver the media
+
+        __Returns__
+
+        - path: location of the cached file
+        - content_type: MIME type of the media
+        """
+        match = self.MXC_REGEX.match(mxc)
+        if match is None:
+            raise ValueError("Invalid MXC link {0}".format(mxc))
+        key = "/".join(match.groups()) + ("#thumbnail" if thumbnail else "")
+        path = self._path(key)
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    break
+                download = self._downloads.get(key)
+                if download is None:
+                    download = self._downloads[key] = threading.Event()
+                    break
+            download.wait() # the other download might have failed, try again
+
+        CACHE_REQUESTS.inc(cache="media", result="miss" if entry is None else "hit")
+        if entry is not None:
+            try:
+                os.utime(path) # keeps the LRU order across restarts
+            except OSError:
+                pass
+            return path, entry[1]
+
+        try:
+            size, content_type = self._download(self._remote_url(server, match.groups(), thumbnail), key, breaker)
+        finally:
+            with self._lock:
+                self._downloads.pop(key, None)
+            download.set()
+
+        with self._lock:
+            self._entries[key] = (size, content_type)
+            self._size += size
+            self._evict()
+        return path, content_type
+
+    def prefetch(self, server, mxc, breaker=None):
+        """
+        Downloads the thumbnail of a media in the background.
+
+        __Parameters__
+
+        - server: Matrix server URL to download the thumbnail from
+        - mxc: Matrix MXC link of the media
+        - breaker: CircuitBreaker of the homeserver, optional
+        """
+        def fetch():
+            try:
+                self.get(server, mxc, True, breaker)
+            except Exception:
+                pass # downloaded again on request
+
+        self._executor.submit(fetch)
+
+    def _remote_url(self, server, groups, thumbnail):
+        if thumbnail:
+            return "{0}/_matrix/media/r0/thumbnail/{1}/{2}?width={width}&height={height}&method={method}".format(
+                server, *groups, **self.THUMBNAIL)
+        return "{0}/_matrix/media/r0/download/{1}/{2}".format(server, *groups)
+
+    def _download(self, url, key, breaker=None):
+        """
+        Streams a media into the cache directory, the file appears atomically
+        once it's complete.
+        """
+        self._check_deadline()
+        if breaker is not None and not breaker.allow():
+            raise HomeserverUnavailable()
+        try:
+            response = self._http.get(url, stream=True, timeout=self.TIMEOUT)
+        except BaseException as e:
+            if breaker is not None:
+                breaker.failure()
+            if isinstance(e, requests.RequestException):
+                raise MatrixRequestError(502, str(e))
+            raise
+        if breaker is not None:
+            if response.status_code >= 500 or response.status_code == 429:
+                breaker.failure()
+            else:
+                breaker.success() # the homeserver answered
+
+        try:
+            if response.status_code != 200:
+                raise MatrixRequestError(response.status_code, response.text)
+
+            content_type = response.headers.get("Content-Type", "application/octet-stream")
+            size = 0
+            descriptor, partial = tempfile.mkstemp(dir=self._directory, suffix=".part")
+            try:
+                with os.fdopen(descriptor, "wb") as file:
+                    for chunk in response.iter_content(self.CHUNK_SIZE):
+                        self._check_deadline()
+                        size += len(chunk)
+                        if size > self._max_size:
+                            raise MatrixRequestError(413, "The media doesn't fit in the cache")
+                        file.write(chunk)
+                with open(self._path(key) + ".json", "w") as file:
+                    json.dump({"key": key, "content_type": content_type}, file)
+                os.replace(partial, self._path(key))
+            except BaseException:
+                os.remove(partial)
+                raise
+            return size, content_type
+        finally:
+            response.close()
+
+    def _check_deadline(self):
+        budget = remaining()
+        if budget is not None and budget <= 0:
+            raise MatrixRequestError(504, "The deadline expired before the homeserver delivered the media")
+
+    def _evict(self):
+        """
+        Removes the least recently used files until the cache fits its size.
+        The newest file is never removed.
+        """
+        while self._size > self._max_size and len(self._entries) > 1:
+            key, (size, _) = self._entries.popitem(last=False)
+            self._size -= size
+            for path in (self._path(key), self._path(key) + ".json"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _load(self):
+        """
+        Indexes the files of a previous run, ordered by their modification time.
+        """
+        entries = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name.endswith(".part"):
+                os.remove(path) # interrupted download
+                continue
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(path) as file:
+                    metadata = json.load(file)
+                stat = os.stat(path[:-len(".json")])
+            except (OSError, ValueError):
+                continue
+            entries.append((stat.st_mtime, metadata["key"], stat.st_size, metadata["content_type"]))
+
+        for _, key, size, content_type in sorted(entries):
+            self._entries[key] = (size, content_type)
+            self._size += size
+        self._evict()
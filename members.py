@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+"""
+The MemberCache resolves the joined members of many rooms concurrently and
+keeps them until a membership event invalidates the room.
+"""
+
+import concurrent.futures
+import threading
+from matrix_client.user import User
+from metrics import CACHE_REQUESTS
+
+__all__ = ["MemberCache"]
+
+class MemberCache(object):
+    """
+    Per-room cache of joined members backed by a bounded thread pool.
+
+    The first resolution of a room uses the member list the Matrix.org SDK
+    collected during the sync. After a membership event the members are
+    fetched again from the homeserver, the previous members are kept to be
+    served while the homeserver is unavailable.
+    """
+    def __init__(self, executor, timeout):
+        """
+        __Parameters__
+
+        - executor: thread pool shared by all the sessions
+        - timeout: maximum number of seconds to wait for the members of a batch
+        of rooms, rooms which take longer are resolved in the background
+        """
+        self._executor = executor
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._members = {}     # room_id: list of (user_id, displayname)
+        self._pending = {}     # room_id: Future
+        self._generations = {} # room_id: number of invalidations
+        self._stale = {}       # room_id: members before the last invalidation
+
+    def invalidate(self, room_id):
+        """
+        Drops the members of a room, for example after a membership event.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        """
+        with self._lock:
+            members = self._members.pop(room_id, None)
+            if members is not None:
+                self._stale[room_id] = members
+            self._pending.pop(room_id, None)
+            self._generations[room_id] = self._generations.get(room_id, 0) + 1
+
+    def discard(self, room_id):
+        """
+        Forgets a room, for example after leaving it.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        """
+        with self._lock:
+            self._members.pop(room_id, None)
+            self._pending.pop(room_id, None)
+            self._generations.pop(room_id, None)
+            self._stale.pop(room_id, None)
+
+    def get(self, room_id, stale=False):
+        """
+        Returns the cached members of a room.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        - stale: `True` returns the members before the last invalidation when
+        the members aren't resolved yet
+
+        __Returns__
+
+        - members: list of `(user_id, displayname)` tuples or `None` if the
+        members aren't resolved yet
+        """
+        with self._lock:
+            members = self._members.get(room_id)
+            if members is None and stale:
+                members = self._stale.get(room_id)
+        CACHE_REQUESTS.inc(cache="members", result="miss" if members is None else "hit")
+        return members
+
+    def resolve(self, rooms):
+        """
+        Resolves the members of the given rooms concurrently, blocks until all
+        of them are resolved or the timeout expires.
+
+        __Parameters__
+
+        - rooms: list of Matrix.org SDK Room objects
+        """
+        futures = []
+        with self._lock:
+            for room in rooms:
+                if room.room_id in self._members:
+                    continue
+                future = self._pending.get(room.room_id)
+                if future is None:
+                    generation = self._generations.get(room.room_id, 0)
+                    future = self._executor.submit(self._fetch, room, generation)
+                    self._pending[room.room_id] = future
+                futures.append(future)
+
+        if futures:
+            concurrent.futures.wait(futures, timeout=self._timeout)
+
+    def _fetch(self, room, generation):
+        try:
+            if generation == 0:
+                # Members collected by the SDK during the sync, no request needed
+                members = [(member.user_id, member.displayname) for member in room.get_joined_members()
+                           if isinstance(member, User)] # Riot-Bot is displayed as a string
+            else:
+                response = room.client.api.get_room_members(room.room_id)
+                members = [(event["state_key"], event["content"].get("displayname"))
+                           for event in response["chunk"]
+                           if event["content"].get("membership") == "join"]
+        except Exception:
+            with self._lock:
+                if self._generations.get(room.room_id, 0) == generation:
+                    self._pending.pop(room.room_id, None) # retry on the next resolve
+            raise
+
+        with self._lock:
+            if self._generations.get(room.room_id, 0) == generation:
+                self._members[room.room_id] = members
+                self._pending.pop(room.room_id, None)
+                self._stale.pop(room.room_id, None)
+        return members
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+"""
+The metrics module collects counters, histograms and gauges of the daemon and
+renders them in the Prometheus text exposition format.
+"""
+
+import bisect
+import threading
+import time
+
+__all__ = ["Registry", "REGISTRY", "instrument_api", "CACHE_REQUESTS"]
+
+class Metric(object):
+    """
+    Base class of the metrics, every metric keeps one value per combination
+    of its label values.
+    """
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {} # tuple of label values: value
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{0} expects the labels {1}".format(self.name, ", ".join(self.labels)))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        """
+        Returns the samples of the metric, one sample per combination of label
+        values by default.
+
+        __Returns__
+
+        - samples: list of `(name, labels, value)`, `labels` is a list of
+        `(label, value)` pairs
+        """
+        with self._lock:
+            return [(self.name, list(zip(self.labels, key)), value) for key, value in sorted(self._values.items())]
+
+class Counter(Metric):
+    """
+    Monotonically increasing value, for example the number of requests.
+    """
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, for example request latencies in seconds.
+    """
+    type = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", labels + [("le", _format(bound))], cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+class Gauge(Metric):
+    """
+    Value read when the metrics are collected, for example a queue depth.
+    """
+    type = "gauge"
+
+    def track(self, callback, **labels):
+        """
+        Registers the callable returning the current value for the given
+        label values.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = callback
+
+    def samples(self):
+        with self._lock:
+            callbacks = sorted(self._values.items())
+        samples = []
+        for key, callback in callbacks:
+            try:
+                samples.append((self.name, list(zip(self.labels, key)), callback()))
+            except Exception:
+                pass # a broken gauge doesn't break the other metrics
+        return samples
+
+class Registry(object):
+    """
+    Collection of all the metrics of the daemon.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, description, labels=()):
+        return self._register(Counter, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=Histogram.BUCKETS):
+        return self._register(Histogram, name, description, labels, buckets)
+
+    def gauge(self, name, description, labels=()):
+        return self._register(Gauge, name, description, labels)
+
+    def render(self):
+        """
+        Renders all the metrics in the Prometheus text format 0.0.4.
+
+        __Returns__
+
+        - text: metrics, one sample per line
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.description.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += "{" + ",".join("{0}=\"{1}\"".format(label, _escape(label_value))
+                                           for label, label_value in labels) + "}"
+                lines.append("{0} {1}".format(name, _format(value)))
+        return "\n".join(lines) + "\n"
+
+    def _register(self, cls, name, description, labels, *args):
+        # Registering the same metric again returns the existing one
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, description, labels, *args)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError("Metric {0} is already registered differently".format(name))
+            return metric
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+REGISTRY = Registry()
+
+CACHE_REQUESTS = REGISTRY.counter("transponder_cache_requests_total",
+    "Cache lookups by cache and result (hit or miss).", ("cache", "result"))
+
+COALESCED_REQUESTS = REGISTRY.counter("transponder_coalesced_requests_total",
+    "Reads which shared the result of an identical running read.", ("call",))
+
+SDK_CALL_DURATION = REGISTRY.histogram("transponder_matrix_call_duration_seconds",
+    "Duration of the Matrix.org SDK API calls.", ("call",))
+
+SDK_CALL_ERRORS = REGISTRY.counter("transponder_matrix_call_errors_total",
+    "Failed Matrix.org SDK API calls by HTTP status code, 0 for connection errors.", ("call", "code"))
+
+NOT_INSTRUMENTED = ("get_download_url", "validate_certificate") # no homeserver request
+
+def instrument_api(api):
+    """
+    Wraps the public methods of a Matrix.org SDK MatrixHttpApi object to
+    measure their duration and count their errors. Only the given object is
+    changed.
+
+    __Parameters__
+
+    - api: MatrixHttpApi object of a client
+    """
+    for name in dir(api):
+        if name.startswith("_") or name in NOT_INSTRUMENTED:
+            continue
+        method = getattr(api, name)
+        if callable(method):
+            setattr(api, name, _timed(name, method))
+
+def _timed(name, method):
+    from matrix_client.errors import MatrixRequestError # the SDK is loaded after the webserver started
+    def call(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return method(*args, **kwargs)
+        except MatrixRequestError as e:
+            SDK_CALL_ERRORS.inc(call=name, code=e.code)
+            raise
+        except Exception:
+            SDK_CALL_ERRORS.inc(call=name, code=0)
+            raise
+        finally:
+            SDK_CALL_DURATION.observe(time.monotonic() - start, call=name)
+    call.__name__ = name
+    call.__doc__ = method.__doc__
+    return call
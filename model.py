@@ -5,25 +5,90 @@ The Model manages all the data of the Matrix.org client and returns it if the
 API asks for it.
 """
 
-import re
+import concurrent.futures
+import os
+import sqlite3
+import threading
 from matrix_client.client import MatrixClient
-from matrix_client.errors import MatrixRequestError
 from matrix_client.user import User
+from matrix_client.errors import MatrixRequestError
+from eventstore import EventStore
+from media import MediaCache
+from members import MemberCache
+from metrics import REGISTRY, instrument_api
+from outbox import Outbox
+from resilience import CircuitBreaker, protect_api
+from search import SearchIndex
+from session import Session, SessionPool
+from store import StateStore
 
 __all__ = ["Model"]
 
 class Model(object):
+    SESSION_MAX_IDLE = 24 * 60 * 60 # seconds before an unused session is evicted
+    STATE_PATH = os.path.expanduser("~/.transponder-matrix/state.sqlite3")
+    MEDIA_PATH = os.path.expanduser("~/.transponder-matrix/media")
+
     def __init__(self, controller):
         self._controller = controller
         self.version = 0.1
         self.service = "https://matrix.org"
-        self.client = None
-        self.token = None
+        self._sessions = SessionPool(self.SESSION_MAX_IDLE, single_user=controller.setting("model.single_user", False),
+                                     timeout=controller.setting("homeserver.timeout", 60))
+        self._breakers = {} # server: CircuitBreaker shared by the sessions of the homeserver
+        self._breakers_lock = threading.Lock()
+        self._members_timeout = controller.setting("model.members.timeout", 10)
+        self._members_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=controller.setting("model.members.workers", 8),
+            thread_name_prefix="members"
+        )
+        self._send_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=controller.setting("model.send.workers", 8),
+            thread_name_prefix="send"
+        )
+        self._join_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=controller.setting("model.join.workers", 4),
+            thread_name_prefix="join"
+        )
+        self._media_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=controller.setting("media.workers", 2),
+            thread_name_prefix="media"
+        )
+        self._media = MediaCache(
+            self.MEDIA_PATH,
+            controller.setting("media.cache_size", 512 * 1024 * 1024),
+            self._media_executor
+        )
+        self._events = EventStore(
+            controller.setting("history.room_events", 500),
+            controller.setting("history.max_bytes", 64 * 1024 * 1024)
+        )
+        self._store = StateStore(self.STATE_PATH)
+        try:
+            self._search = SearchIndex(self.STATE_PATH)
+        except sqlite3.OperationalError:
+            self._search = None # SQLite without FTS5, searching is disabled
+        self._restore()
+        self._outbox = Outbox(self.STATE_PATH, self._deliver)
+        self._outbox.start()
+
+        pools = REGISTRY.gauge("transponder_pool_queue_depth", "Tasks waiting for a thread of a pool.", ("pool",))
+        for pool, executor in (("members", self._members_executor), ("send", self._send_executor),
+                               ("join", self._join_executor), ("media", self._media_executor)):
+            pools.track(executor._work_queue.qsize, pool=pool) # not exposed by ThreadPoolExecutor
+        REGISTRY.gauge("transponder_sessions", "Authenticated sessions.").track(self._sessions.__len__)
+        for name, description in (("bytes", "Estimated memory of the buffered messages in bytes."),
+                                  ("events", "Buffered messages."),
+                                  ("rooms", "Rooms with buffered messages."),
+                                  ("evictions", "Rooms evicted from the event store to stay in its memory budget.")):
+            REGISTRY.gauge("transponder_event_store_" + name, description).track(
+                lambda name=name: self._events.report()[name])
 
     def auth(self, username, password, server, new):
         """
         Connects to the given Matrix server and authenticates the user.
-        On success, the auth token is returned.
+        On success, a new session is added to the session pool and its auth
+        token is returned. Sessions of other users aren't affected.
 
         __Parameters__
 
@@ -39,193 +104,188 @@ class Model(object):
         - token: Matrix auth token
         """
         # Create a Matrix.org SDK client
-        self.client = MatrixClient(server)
+        client = MatrixClient(server)
+        self._sessions.share_connections(client, server)
+        instrument_api(client.api)
+        breaker = self._protect(client, server)
 
         # Register/login the user
         if new:
             # No captcha support in the Matrix.org Python SDK, see https://github.com/matrix-org/matrix-python-sdk/issues/82
-            self.token = self.client.register_with_password(username=username, password=password)
+            token = client.register_with_password(username=username, password=password)
         else:
-            self.token = self.client.login_with_password(username=username, password=password)
+            token = client.login_with_password(username=username, password=password)
 
-        return self.token
+        self._sessions.add(Session(client, token, self._member_cache(), self._store, media=self._media,
+                                   events=self._events, search=self._search, breaker=breaker))
+        return token
 
-    @property
-    def rooms(self):
+    def session(self, token=None):
         """
-        Retrieves the rooms from the user's address book as JSON.
+        Returns the session of an authenticated user.
 
-        __Returns__
+        __Parameters__
 
-        - rooms: Python list of all rooms in dictionary format
-
-        ```json
-            {
-                "id": string
-                "name": string
-                "avatar": string
-                "last_seen": string
-                "members": [
-                    {
-                        "id": string
-                        "name": string
-                        "last_seen": string
-                        "avatar": string
-                    },
-                    ...
-                ]
-            }
-        ```
-        """
-        data = []
-
-        # Loop through each loop and retrieve it's meta data
-        for key in self.client.get_rooms():
-            room = self.client.get_rooms()[key]
-            room_data = {
-                "id": room.room_id,
-                "name": room.name,
-                "avatar": None, # unsupported by the Matrix.org Python SDK
-                "last_seen": None, # unsupported by the Matrix.org Python SDK
-                "members": []
-            }
-
-            # Add each member of the room to the members property
-            for index, member in enumerate(room.get_joined_members()):
-                if isinstance(member, User): # Riot-Bot is displayed as a string
-                    room_data["members"].append({
-                        "id": index,
-                        "name": member.displayname,
-                        "avatar": None, #member.get_avatar_url(), # Broken in the Matrix.org Python SDK
-                        "last_seen": None # unsupported by the Matrix.org Python SDK
-                    })
-
-            # Add room to our data list
-            data.append(room_data)
-
-        return data
-
-    def add_room(self, room_id):
-        """
-        Adds a room to the user address book if the `room_id` exists, if it doesn't
-        exists, the room will be created and added to the user address book.
+        - token: Matrix auth token, see `SessionPool.get` when omitted
 
-        __Raises__
+        __Returns__
 
-        - MatrixRequestError: in case something goes wrong with the Matrix API,
-        this exception will be raised.
+        - session: Session or `None` when the user isn't authenticated
         """
-        # starts with '#' or '!' and a ':' will be in the string
-        matrix_id_regex = re.compile("(^!)|(^#)|(:)")
+        return self._sessions.get(token)
 
-        # room_id is a full ID for joining
-        if matrix_id_regex.match(room_id):
-            self.client.join_room(room_id)
-        # new room since the room_id isn't a valid Matrix room ID but a room alias
-        else:
-            room = self.client.create_room(room_id)
-            room.set_room_name(room_id) # set the room name to the room alias
-
-    def remove_room(self, room_id):
+    def queue_text(self, session, room_id, text):
         """
-        Let the user leave a room in his address book.
+        Queues a text message in the outbox, the message is sent in the
+        background.
+
+        __Parameters__
+
+        - session: Session of the sender
+        - room_id: Matrix ID or alias of the room
+        - text: text to send
 
         __Raises__
 
-        - MatrixRequestError: leaving an unjoined is not possible.
+        - MatrixRequestError: 404 if the room isn't joined
+
+        __Returns__
+
+        - message_id: ID to look up the delivery status with
         """
-        success = False
-        room = self._find_room(room_id)
-        success = room.leave()
+        return self._outbox.put(session.token, session.client.api.base_url, session.resolve_room(room_id), text)
+
+    def delivery(self, session, message_id=None):
+        """
+        Returns the delivery status of a queued message, see `Outbox.get`.
+
+        __Parameters__
 
-        if not success:
-            raise MatrixRequestError(code=404, content="You can't leave a room \
-            ({0}) if you haven't joined it yet.".format(room_id))
+        - session: Session of the sender
+        - message_id: ID returned by `queue_text`, all the queued and failed
+        messages are returned when omitted
+        """
+        if message_id is None:
+            return self._outbox.pending(session.token)
+        return self._outbox.get(session.token, message_id)
 
-    def messages(self, room_id):
+    def media(self, session, server_name, media_id, thumbnail=False):
         """
-        Returns a list of messages for a specific room_id
+        Returns a media from the local media cache, it's downloaded from the
+        homeserver of the user when missing.
 
         __Parameters__
 
-        - room_id: Matrix ID of the room
+        - session: Session of the user
+        - server_name: server name of the MXC link
+        - media_id: media ID of the MXC link
+        - thumbnail: `True` returns the thumbnail of the media
+
+        __Raises__
+
+        - ValueError: the MXC link is invalid
+        - MatrixRequestError: the homeserver can't deliver the media
 
         __Returns__
 
-        - messages: List of messages
-        """
-        events = []
-        messages = []
-
-        # Get room
-        room = self._find_room(room_id)
-        room.event_history_limit += 10 # increment limit and retrieve more messages on each call
-        room.backfill_previous_messages(limit=10)
-        events = room.events
-
-        for event in events:
-            if event.get("type") == "m.room.message":
-                if event.get("content").get("msgtype") == "m.text":
-                    messages.append({
-                        "type": "text",
-                        "from": event.get("sender"),
-                        "content": event.get("content").get("body"),
-                        "timestamp": None, # Not supported by the Matrix.org Python SDK
-                        "read": None # Not supported by the Matrix.org Python SDK
-                    })
-                elif event.get("content").get("msgtype") == "m.image":
-                    messages.append({
-                        "type": "image",
-                        "from": event.get("sender"),
-                        "content": self.decode_download_link(event.get("content").get("url")),
-                        "timestamp": None, # Not supported by the Matrix.org Python SDK
-                        "read": None # Not supported by the Matrix.org Python SDK
-                    })
-            elif event.get("type") == "m.room.member":
-                messages.append({
-                    "type": "contact",
-                    "from": event.get("sender"),
-                    "content": "{0} {1} room".format(event.get("sender"), event.get("content").get("membership")),
-                    "timestamp": None, # Not supported by the Matrix.org Python SDK
-                    "read": None # Not supported by the Matrix.org Python SDK
-                })
-
-        return messages
-
-    def send_text(self, room_id, text):
-        """
-        Sends a basic text message to the given room.
+        - path: location of the cached file
+        - content_type: MIME type of the media
+        """
+        server = session.client.api.base_url
+        with self._breakers_lock:
+            breaker = self._breakers.get(server)
+        return self._media.get(server, "mxc://{0}/{1}".format(server_name, media_id), thumbnail, breaker)
+
+    def broadcast(self, session, messages):
+        """
+        Sends many text messages concurrently for an authenticated user, see
+        `Session.broadcast`.
 
         __Parameters__
 
-        - room_id: Matrix ID of the room
-        - text: ASCII text to send
+        - session: Session of the sender
+        - messages: list of `(room_id, text, txn_id)` tuples
 
-        __Raises__
+        __Returns__
 
-        - MatrixRequestError: when something goes wrong while sending the message
-        a MatrixRequestError is raised
+        - results: per-message results in the order of `messages`
+        """
+        return session.broadcast(messages, self._send_executor)
+
+    def add_rooms(self, session, room_ids):
+        """
+        Joins or creates many rooms concurrently for an authenticated user,
+        see `Session.add_rooms`.
+
+        __Parameters__
+
+        - session: Session of the user
+        - room_ids: list of Matrix room IDs, aliases or names of new rooms
 
         __Returns__
 
-        - success: `True` if message was sended to the room
+        - results: per-room results in the order of `room_ids`
         """
-        room = self._find_room(room_id)
-        if room.send_text(text):
-            return True
-        return False
+        return session.add_rooms(room_ids, self._join_executor)
 
-    def decode_download_link(self, link):
+    def _restore(self):
         """
-        Converts a Matrix MXC link to a normal HTTP link.
+        Recreates the stored sessions without a full initial sync, their sync
+        listeners resume from the stored `next_batch` token.
         """
-        return self.client.api.get_download_url(link)
+        for state in self._store.load():
+            client = MatrixClient(state["server"])
+            self._sessions.share_connections(client, state["server"])
+            instrument_api(client.api)
+            breaker = self._protect(client, state["server"])
+            client.api.token = state["token"]
+            client.token = state["token"]
+            client.user_id = state["user_id"]
+            client.sync_token = state["sync_token"]
+
+            # Rebuild the rooms the incremental sync doesn't mention
+            for room_state in state["rooms"]:
+                room = client._mkroom(room_state["room_id"])
+                room.name = room_state["name"]
+                room.canonical_alias = room_state["canonical_alias"]
+                room.aliases = room_state["aliases"]
+                room.prev_batch = room_state["prev_batch"]
+                for user_id, displayname in room_state["members"]:
+                    room._mkmembers(User(client.api, user_id, displayname))
+
+            self._sessions.add(Session(client, state["token"], self._member_cache(), self._store,
+                                       state["messages"], self._media, self._events, self._search, breaker))
+
+    def _deliver(self, token, room_id, text, txn_id):
+        """
+        Sends a message of the outbox with the session of its sender.
+        """
+        session = self._sessions.get(token)
+        if session is None:
+            raise MatrixRequestError(401, "The session of the sender is closed")
+        return session.send_text(room_id, text, txn_id)
 
-    def _find_room(self, room_id):
+    def _protect(self, client, server):
+        """
+        Bounds the SDK calls of a client by the deadline of the request and the
+        circuit breaker of its homeserver, the breaker is returned.
+        """
+        setting = self._controller.setting
+        with self._breakers_lock:
+            breaker = self._breakers.get(server)
+            if breaker is None:
+                breaker = self._breakers[server] = CircuitBreaker(
+                    setting("homeserver.breaker_failures", 5),
+                    setting("homeserver.breaker_reset", 30)
+                )
+                REGISTRY.gauge("transponder_circuit_breaker_open", "1 while the circuit breaker of a homeserver is open.",
+                               ("server",)).track(lambda: int(breaker.open), server=server)
+        protect_api(client.api, breaker, setting("homeserver.retries", 2), setting("homeserver.retry_backoff", 0.1))
+        return breaker
+
+    def _member_cache(self):
         """
-        Retrieve a Room object based on the room_id.
+        Creates the member cache of a new session, all the sessions share the
+        same thread pool.
         """
-        for key in self.client.get_rooms():
-            room = self.client.get_rooms()[key]
-            if room_id == room.room_id:
-                return room
+        return MemberCache(self._members_executor, self._members_timeout)
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+"""
+The EventNormalizer converts Matrix events into the compact Message records
+served by the API, with a table of normalizers keyed by event type and
+message type.
+"""
+
+import collections
+import threading
+
+__all__ = ["Message", "EventNormalizer"]
+
+class Message(object):
+    """
+    Normalized message. The JSON serializer encodes it with `to_json`.
+    """
+    __slots__ = ("type", "sender", "content", "timestamp", "read")
+
+    def __init__(self, type, sender, content, timestamp=None, read=None):
+        self.type = type
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp # origin_server_ts of the event, milliseconds since the epoch
+        self.read = read # read state of a served copy, the shared messages keep `None`
+
+    def to_json(self):
+        return {
+            "type": self.type,
+            "from": self.sender,
+            "content": self.content,
+            "timestamp": self.timestamp,
+            "read": self.read
+        }
+
+    def redacted(self):
+        """
+        Returns the placeholder which replaces the message once it's redacted.
+        """
+        return Message("redacted", self.sender, None, self.timestamp)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["type"], data["from"], data["content"], data.get("timestamp"), data.get("read"))
+
+    def __repr__(self):
+        return "Message({0!r}, {1!r}, {2!r})".format(self.type, self.sender, self.content)
+
+class EventNormalizer(object):
+    """
+    Table-driven event normalization.
+
+    A normalizer is registered for an event type and optionally a message type
+    (`msgtype`), the most specific one handles an event. It's called as
+    `normalizer(event, content)` and returns a Message or `None` when the
+    event isn't shown to the user. Results are memoized by event ID in a
+    bounded LRU, an event is normalized once however often it's served.
+    """
+    MEMO_SIZE = 10000 # memoized events
+
+    def __init__(self, download_link, memo_size=MEMO_SIZE):
+        """
+        __Parameters__
+
+        - download_link: `download_link(mxc, prefetch)` converts a Matrix MXC
+        link to the URL served to the user, `prefetch` asks for its thumbnail
+        - memo_size: maximum number of memoized events
+        """
+        self._download_link = download_link
+        self._memo_size = memo_size
+        self._lock = threading.Lock()
+        self._memo = collections.OrderedDict() # event ID: Message or None
+        self._normalizers = {}
+
+        self.register("m.room.message", self._text("text"), "m.text")
+        self.register("m.room.message", self._text("notice"), "m.notice")
+        self.register("m.room.message", self._text("emote"), "m.emote")
+        self.register("m.room.message", self._media("image", True), "m.image")
+        self.register("m.room.message", self._media("file", False), "m.file")
+        self.register("m.room.message", self._media("video", False), "m.video")
+        self.register("m.room.message", self._redacted)
+        self.register("m.room.member", self._member)
+
+    def register(self, event_type, normalizer, msgtype=None):
+        """
+        Adds or replaces the normalizer of an event type.
+
+        __Parameters__
+
+        - event_type: Matrix event type, for example `m.room.message`
+        - normalizer: `normalizer(event, content)` returns a Message or `None`
+        - msgtype: only handle events with this `msgtype` in their content,
+        `None` handles the events without a more specific normalizer
+        """
+        self._normalizers[(event_type, msgtype)] = normalizer
+
+    def normalize(self, event):
+        """
+        Converts a Matrix event into a message.
+
+        __Parameters__
+
+        - event: raw Matrix event
+
+        __Returns__
+
+        - message: Message or `None` if the event isn't shown to the user
+        """
+        event_id = event.get("event_id")
+        if event_id is not None:
+            with self._lock:
+                if event_id in self._memo:
+                    self._memo.move_to_end(event_id)
+                    return self._memo[event_id]
+
+        content = event.get("content") or {}
+        normalizer = self._normalizers.get((event.get("type"), content.get("msgtype"))) \
+            or self._normalizers.get((event.get("type"), None))
+        message = None if normalizer is None else normalizer(event, content)
+
+        if event_id is not None:
+            with self._lock:
+                self._memo[event_id] = message
+                if len(self._memo) > self._memo_size:
+                    self._memo.popitem(last=False)
+        return message
+
+    def messages(self, events):
+        """
+        Normalizes events lazily.
+
+        __Parameters__
+
+        - events: iterable of raw Matrix events
+
+        __Returns__
+
+        - messages: generator of `(event_id, message)` for the events shown
+        to the user
+        """
+        for event in events:
+            message = self.normalize(event)
+            if message is not None:
+                yield event.get("event_id"), message
+
+    def forget(self, event_id):
+        """
+        Drops the memoized message of an event, for example when it's redacted.
+        """
+        with self._lock:
+            self._memo.pop(event_id, None)
+
+    def _text(self, type):
+        def normalize(event, content):
+            return Message(type, event.get("sender"), content.get("body"), event.get("origin_server_ts"))
+        return normalize
+
+    def _media(self, type, prefetch):
+        def normalize(event, content):
+            return Message(type, event.get("sender"), self._download_link(content.get("url"), prefetch),
+                           event.get("origin_server_ts"))
+        return normalize
+
+    def _redacted(self, event, content):
+        # Redacted messages lose their content, unknown message types are hidden
+        if "redacted_because" in (event.get("unsigned") or {}):
+            return Message("redacted", event.get("sender"), None, event.get("origin_server_ts"))
+        return None
+
+    def _member(self, event, content):
+        return Message("contact", event.get("sender"), "{0} {1} room".format(event.get("sender"), content.get("membership")),
+                       event.get("origin_server_ts"))
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+"""
+The Outbox persists outgoing messages and delivers them in the background so
+sending a message never waits for the homeserver.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from matrix_client.errors import MatrixRequestError
+
+__all__ = ["Outbox"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT NOT NULL UNIQUE,
+    token TEXT NOT NULL,
+    server TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    event_id TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (server, status, id);
+"""
+
+QUEUED = "queued"
+SENT = "sent"
+FAILED = "failed"
+
+class Outbox(object):
+    """
+    Persistent queue of outgoing text messages.
+
+    Every homeserver gets its own scheduler thread which drains the due
+    messages in order, a rate limited or slow homeserver doesn't delay the
+    messages of other homeservers. The message ID doubles as Matrix transaction
+    ID, a message which is sent again after a crash or a retry is only
+    delivered once.
+    """
+    BATCH_SIZE = 50 # due messages read and updated per transaction
+    MAX_ATTEMPTS = 8 # attempts before a message fails on server or network errors
+    MAX_BACKOFF = 300 # seconds between two attempts of a message
+    KEEP = 24 * 60 * 60 # seconds the status of a delivered or failed message is kept
+
+    def __init__(self, path, deliver):
+        """
+        __Parameters__
+
+        - path: location of the SQLite database, shared with the StateStore
+        - deliver: callable `deliver(token, room_id, text, txn_id)` which sends
+        a message and returns its event ID or raises a MatrixError
+        """
+        self._deliver = deliver
+        self._lock = threading.Lock() # serializes the use of the connection
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._wakeups = {} # server: threading.Event of its scheduler
+
+    def start(self):
+        """
+        Starts the schedulers of the homeservers with queued messages, for
+        example after a restart.
+        """
+        with self._lock:
+            servers = [server for server, in self._connection.execute(
+                "SELECT DISTINCT server FROM outbox WHERE status = ?", (QUEUED,))]
+        for server in servers:
+            self._wake(server)
+
+    def put(self, token, server, room_id, text):
+        """
+        Queues a text message, the message is stored before returning.
+
+        __Parameters__
+
+        - token: Matrix auth token of the sender
+        - server: Matrix server URL of the sender
+        - room_id: Matrix ID of the room
+        - text: text to send
+
+        __Returns__
+
+        - message_id: ID to look up the delivery status with
+        """
+        message_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO outbox (message_id, token, server, room_id, text, status, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (message_id, token, server, room_id, text, QUEUED, now, now))
+        self._wake(server)
+        return message_id
+
+    def get(self, token, message_id):
+        """
+        Returns the delivery status of a message.
+
+        __Parameters__
+
+        - token: Matrix auth token of the sender
+        - message_id: ID returned by `put`
+
+        __Returns__
+
+        - status: dictionary or `None` when the message is unknown
+
+        ```json
+            {
+                "id": string
+                "room_id": string
+                "status": "queued" | "sent" | "failed"
+                "attempts": number
+                "event_id": string
+                "error": {"code": number, "message": string}
+            }
+        ```
+        """
+        statuses = self._select("token = ? AND message_id = ?", (token, message_id))
+        return statuses[0] if statuses else None
+
+    def pending(self, token):
+        """
+        Returns the delivery status of the queued and failed messages of a
+        sender in the order they were queued, see `get`.
+
+        __Parameters__
+
+        - token: Matrix auth token of the sender
+        """
+        return self._select("token = ? AND status != ?", (token, SENT))
+
+    def _select(self, where, params):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT message_id, room_id, status, attempts, event_id, error FROM outbox "
+                "WHERE " + where + " ORDER BY id", params).fetchall()
+        return [{
+            "id": message_id,
+            "room_id": room_id,
+            "status": status,
+            "attempts": attempts,
+            "event_id": event_id,
+            "error": json.loads(error) if error else None
+        } for message_id, room_id, status, attempts, event_id, error in rows]
+
+    def _wake(self, server):
+        """
+        Wakes up the scheduler of a homeserver, starts it if needed.
+        """
+        with self._lock:
+            wakeup = self._wakeups.get(server)
+            if wakeup is None:
+                wakeup = self._wakeups[server] = threading.Event()
+                scheduler = threading.Thread(target=self._schedule_forever, args=(server, wakeup),
+                                             name="Outbox {0}".format(server))
+                scheduler.daemon = True
+                scheduler.start()
+        wakeup.set()
+
+    def _schedule_forever(self, server, wakeup):
+        while True:
+            wakeup.clear()
+            try:
+                pause = self._drain(server)
+                if pause is None:
+                    # Sleep until the next postponed message or a new message
+                    wakeup.wait(self._idle(server))
+                elif pause > 0:
+                    time.sleep(pause) # rate limited, new messages wait as well
+            except sqlite3.Error:
+                time.sleep(5) # the database is busy, the messages stay queued
+
+    def _drain(self, server):
+        """
+        Delivers a batch of due messages of a homeserver.
+
+        __Returns__
+
+        - pause: seconds to wait before the next batch, `None` when no
+        message is due
+        """
+        now = time.time()
+        with self._lock:
+            batch = self._connection.execute(
+                "SELECT id, token, room_id, text, message_id, attempts FROM outbox "
+                "WHERE server = ? AND status = ? AND not_before <= ? ORDER BY id LIMIT ?",
+                (server, QUEUED, now, self.BATCH_SIZE)).fetchall()
+        if not batch:
+            return None
+
+        updates = []
+        deferred = set() # (token, room_id) with a postponed message, keeps the order of the room
+        pause = 0
+        for row_id, token, room_id, text, message_id, attempts in batch:
+            if (token, room_id) in deferred:
+                continue
+
+            attempts += 1
+            try:
+                event_id = self._deliver(token, room_id, text, message_id)
+            except MatrixRequestError as e:
+                if e.code == 429:
+                    # M_LIMIT_EXCEEDED, the homeserver asks the whole account to slow down
+                    pause = self._retry_after(e)
+                    updates.append(("UPDATE outbox SET attempts = ?, updated = ? WHERE id = ?",
+                                    (attempts, time.time(), row_id)))
+                    break
+                elif e.code >= 500 and attempts < self.MAX_ATTEMPTS:
+                    deferred.add((token, room_id))
+                    updates.append(self._postpone(row_id, token, room_id, attempts))
+                else:
+                    updates.append(self._fail(row_id, attempts, e.code, e.content))
+            except Exception as e:
+                # Connection errors of the homeserver, MatrixHttpLibError or a bare requests exception
+                if attempts < self.MAX_ATTEMPTS:
+                    deferred.add((token, room_id))
+                    updates.append(self._postpone(row_id, token, room_id, attempts))
+                else:
+                    updates.append(self._fail(row_id, attempts, 502, str(e)))
+            else:
+                updates.append(("UPDATE outbox SET status = ?, attempts = ?, event_id = ?, error = NULL, updated = ? "
+                                "WHERE id = ?", (SENT, attempts, event_id, time.time(), row_id)))
+
+        with self._lock, self._connection:
+            for sql, params in updates:
+                self._connection.execute(sql, params)
+        return pause
+
+    def _postpone(self, row_id, token, room_id, attempts):
+        """
+        Returns the update which postpones a message and the messages queued
+        after it in the same room with an exponential backoff.
+        """
+        not_before = time.time() + min(self.MAX_BACKOFF, 2 ** attempts)
+        return ("UPDATE outbox SET attempts = CASE WHEN id = ? THEN ? ELSE attempts END, "
+                "not_before = MAX(not_before, ?), updated = ? "
+                "WHERE token = ? AND room_id = ? AND status = ? AND id >= ?",
+                (row_id, attempts, not_before, time.time(), token, room_id, QUEUED, row_id))
+
+    def _fail(self, row_id, attempts, code, message):
+        error = json.dumps({"code": code, "message": message})
+        return ("UPDATE outbox SET status = ?, attempts = ?, error = ?, updated = ? WHERE id = ?",
+                (FAILED, attempts, error, time.time(), row_id))
+
+    def _retry_after(self, error):
+        """
+        Seconds to wait after a 429 response, from its `retry_after_ms`.
+        """
+        try:
+            return json.loads(error.content)["retry_after_ms"] / 1000
+        except (ValueError, TypeError, KeyError):
+            return 5
+
+    def _idle(self, server):
+        """
+        Removes the old statuses of a homeserver and returns the seconds until
+        its next postponed message, `None` waits for a new message.
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM outbox WHERE server = ? AND status != ? AND updated < ?",
+                                     (server, QUEUED, time.time() - self.KEEP))
+            not_before, = self._connection.execute(
+                "SELECT MIN(not_before) FROM outbox WHERE server = ? AND status = ?",
+                (server, QUEUED)).fetchone()
+        if not_before is None:
+            return None
+        return max(0, not_before - time.time())
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+"""
+The SamplingProfiler finds the hot spots of the running daemon by sampling
+the stacks of all its threads at a fixed interval.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+__all__ = ["SamplingProfiler"]
+
+class SamplingProfiler(object):
+    """
+    Process-wide statistical profiler.
+
+    A background thread reads the current frame of every thread with
+    `sys._current_frames()`. The function on top of a stack gets a `self`
+    sample, every function on the stack gets a `total` sample. Threads which
+    didn't use CPU time since the previous sample are blocked (waiting for
+    work, a lock or the network) and skipped, they would hide the busy
+    threads. Without per-thread CPU clocks, all the threads are sampled.
+    """
+    MAX_DEPTH = 128 # frames walked per stack
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = threading.Event()
+        self._reset()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=0.005):
+        """
+        Starts sampling, the previous results are discarded.
+
+        __Parameters__
+
+        - interval: seconds between two samples
+
+        __Raises__
+
+        - RuntimeError: the profiler is already running
+        """
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError("The profiler is already running")
+            self._reset()
+            self._interval = interval
+            self._started = time.monotonic()
+            self._running.set()
+            self._thread = threading.Thread(target=self._sample_forever, name="SamplingProfiler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling, the results stay available with `report`.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._running.clear()
+        if thread is not None:
+            thread.join()
+            self._stopped = time.monotonic()
+
+    def report(self, limit=25):
+        """
+        Returns the functions with the most samples.
+
+        __Parameters__
+
+        - limit: maximum number of functions
+
+        __Returns__
+
+        - report: dictionary
+
+        ```json
+            {
+                "running": boolean
+                "duration": number, seconds
+                "samples": number, sampled stacks
+                "functions": [
+                    {
+                        "function": "file:line(name)"
+                        "self": number, samples on top of the stack
+                        "total": number, samples anywhere on the stack
+                        "self_percent": number
+                        "total_percent": number
+                    },
+                    ...
+                ]
+            }
+        ```
+        """
+        with self._lock:
+            samples = self._samples
+            own = self._self.copy()
+            total = self._total.copy()
+            end = time.monotonic() if self._stopped is None else self._stopped
+            duration = 0 if self._started is None else end - self._started
+
+        functions = []
+        for code, count in sorted(total.items(), key=lambda item: (own.get(item[0], 0), item[1]), reverse=True)[:limit]:
+            functions.append({
+                "function": "{0}:{1}({2})".format(*code),
+                "self": own.get(code, 0),
+                "total": count,
+                "self_percent": round(100.0 * own.get(code, 0) / samples, 2) if samples else 0,
+                "total_percent": round(100.0 * count / samples, 2) if samples else 0
+            })
+        return {
+            "running": self.running,
+            "duration": round(duration, 3),
+            "samples": samples,
+            "functions": functions
+        }
+
+    def _cpu_time(self, thread_id):
+        """
+        Returns the CPU time used by a thread, `None` if it's unknown.
+        """
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+        except (AttributeError, OSError):
+            return None # not a Unix system or the thread has ended
+
+    def _reset(self):
+        self._samples = 0
+        self._self = collections.Counter()
+        self._total = collections.Counter()
+        self._started = None
+        self._stopped = None
+        self._interval = None
+
+    def _sample_forever(self):
+        me = threading.get_ident()
+        cpu_times = {} # thread ID: CPU time at the previous sample
+        while self._running.is_set():
+            frames = sys._current_frames()
+            stacks = []
+            previous, cpu_times = cpu_times, {}
+            for thread_id, frame in frames.items():
+                if thread_id == me:
+                    continue
+                cpu_times[thread_id] = self._cpu_time(thread_id)
+                if cpu_times[thread_id] is not None and cpu_times[thread_id] == previous.get(thread_id):
+                    continue # blocked
+                stack = []
+                depth = 0
+                while frame is not None and depth < self.MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                    depth += 1
+                stacks.append(stack)
+            del frames
+
+            with self._lock:
+                for stack in stacks:
+                    self._samples += 1
+                    self._self[stack[0]] += 1
+                    self._total.update(set(stack)) # recursive functions count once
+            time.sleep(self._interval)
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+"""
+The RoomRegistry indexes the joined rooms of the Matrix.org client by room ID,
+alias, member and name so the Model doesn't need to scan all the rooms.
+"""
+
+import bisect
+import threading
+from matrix_client.user import User
+
+__all__ = ["RoomRegistry"]
+
+class RoomRegistry(object):
+    """
+    Multi-index registry of the joined rooms.
+
+    The registry is filled when the user logs in and kept in sync by the Model
+    from the join, leave and state events delivered by the sync listener. The
+    members are indexed from the sync state of the Room, the members resolved
+    later by the MemberCache are added with `set_members`, the homeserver is
+    never called.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = {}        # room_id: Room
+        self._aliases = {}      # alias: room_id
+        self._room_aliases = {} # room_id: set of aliases
+        self._members = {}      # user_id: set of room_ids
+        self._room_members = {} # room_id: set of user_ids
+        self._names = []        # sorted list of (lowercase name, room_id)
+        self._room_names = {}   # room_id: lowercase name
+
+    def add(self, room):
+        """
+        Adds a joined room and indexes its aliases, name and members.
+
+        __Parameters__
+
+        - room: Matrix.org SDK Room object
+        """
+        aliases = set(room.aliases or [])
+        if room.canonical_alias:
+            aliases.add(room.canonical_alias)
+        # get_joined_members() fetches the members of a room without sync state
+        members = getattr(room, "_members", None) or {}
+        if isinstance(members, dict):
+            members = members.values()
+        members = [member.user_id for member in members
+                   if isinstance(member, User)] # Riot-Bot is displayed as a string
+
+        with self._lock:
+            self._rooms[room.room_id] = room
+            self._set_aliases(room.room_id, aliases)
+            self._set_name(room.room_id, room.name)
+            for user_id in members:
+                self._add_member(room.room_id, user_id)
+
+    def remove(self, room_id):
+        """
+        Removes a room from all the indexes, for example after leaving it.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        """
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._set_aliases(room_id, set())
+            self._set_name(room_id, None)
+            for user_id in self._room_members.pop(room_id, set()):
+                self._remove_member(room_id, user_id)
+
+    def set_members(self, room_id, user_ids):
+        """
+        Replaces the indexed members of a room, for example with the members
+        resolved by the MemberCache.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        - user_ids: Matrix IDs of the joined members
+        """
+        with self._lock:
+            if room_id not in self._rooms:
+                return
+            for user_id in self._room_members.pop(room_id, set()):
+                self._remove_member(room_id, user_id)
+            for user_id in user_ids:
+                self._add_member(room_id, user_id)
+
+    def update(self, event):
+        """
+        Updates the indexes with a state event of a joined room.
+
+        __Parameters__
+
+        - event: Matrix event dictionary with a `room_id` property
+        """
+        room_id = event["room_id"]
+        content = event.get("content", {})
+
+        with self._lock:
+            if room_id not in self._rooms:
+                return
+
+            if event["type"] == "m.room.member":
+                if content.get("membership") == "join":
+                    self._add_member(room_id, event["state_key"])
+                else: # leave, ban and invite
+                    self._remove_member(room_id, event["state_key"])
+            elif event["type"] == "m.room.name":
+                self._set_name(room_id, content.get("name"))
+            elif event["type"] == "m.room.canonical_alias":
+                aliases = set(self._room_aliases.get(room_id, set()))
+                if content.get("alias"):
+                    aliases.add(content.get("alias"))
+                self._set_aliases(room_id, aliases)
+            elif event["type"] == "m.room.aliases":
+                aliases = set(self._room_aliases.get(room_id, set()))
+                aliases.update(content.get("aliases", []))
+                self._set_aliases(room_id, aliases)
+
+    def get(self, room_id):
+        """
+        Returns the Room object for a room ID or alias, `None` if the room
+        isn't joined.
+
+        __Parameters__
+
+        - room_id: Matrix ID or alias of the room
+        """
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None and room_id in self._aliases:
+                room = self._rooms.get(self._aliases[room_id])
+            return room
+
+    def __contains__(self, room_id):
+        return room_id in self._rooms
+
+    def room_ids(self):
+        """
+        Returns the IDs of all the joined rooms.
+        """
+        with self._lock:
+            return list(self._rooms)
+
+    def with_member(self, user_id):
+        """
+        Returns the IDs of the rooms where the given user is joined.
+
+        __Parameters__
+
+        - user_id: Matrix ID of the user
+        """
+        with self._lock:
+            return set(self._members.get(user_id, set()))
+
+    def with_name_prefix(self, prefix):
+        """
+        Returns the IDs of the rooms whose name starts with the given prefix,
+        the comparison is case insensitive.
+
+        __Parameters__
+
+        - prefix: start of the room name
+        """
+        prefix = prefix.lower()
+        room_ids = set()
+        with self._lock:
+            index = bisect.bisect_left(self._names, (prefix, ""))
+            while index < len(self._names) and self._names[index][0].startswith(prefix):
+                room_ids.add(self._names[index][1])
+                index += 1
+        return room_ids
+
+    def _add_member(self, room_id, user_id):
+        self._members.setdefault(user_id, set()).add(room_id)
+        self._room_members.setdefault(room_id, set()).add(user_id)
+
+    def _remove_member(self, room_id, user_id):
+        self._room_members.get(room_id, set()).discard(user_id)
+        rooms = self._members.get(user_id)
+        if rooms is not None:
+            rooms.discard(room_id)
+            if not rooms:
+                del self._members[user_id]
+
+    def _set_aliases(self, room_id, aliases):
+        for alias in self._room_aliases.pop(room_id, set()):
+            self._aliases.pop(alias, None)
+        if aliases:
+            self._room_aliases[room_id] = aliases
+            for alias in aliases:
+                self._aliases[alias] = room_id
+
+    def _set_name(self, room_id, name):
+        old_name = self._room_names.pop(room_id, None)
+        if old_name is not None:
+            index = bisect.bisect_left(self._names, (old_name, room_id))
+            if index < len(self._names) and self._names[index] == (old_name, room_id):
+                del self._names[index]
+        if name:
+            self._room_names[room_id] = name.lower()
+            bisect.insort(self._names, (name.lower(), room_id))
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+"""
+Deadlines, retries and circuit breakers of the homeserver calls. A request
+thread gets a deadline budget which bounds every SDK call it makes, reads are
+retried with a jittered backoff within the budget and a circuit breaker per
+homeserver fails the calls fast while the homeserver is down.
+"""
+
+import random
+import threading
+import time
+from matrix_client.errors import MatrixHttpLibError, MatrixRequestError
+from requests.adapters import HTTPAdapter
+from metrics import REGISTRY, NOT_INSTRUMENTED
+
+__all__ = ["CircuitBreaker", "DeadlineAdapter", "HomeserverUnavailable", "protect_api",
+           "set_deadline", "clear_deadline", "remaining", "propagate_deadline"]
+
+RETRIES = REGISTRY.counter("transponder_matrix_call_retries_total",
+    "Retried Matrix.org SDK API calls.", ("call",))
+
+_local = threading.local()
+
+def set_deadline(seconds):
+    """
+    Gives the calling thread a budget of `seconds` for its homeserver calls.
+    """
+    _local.deadline = time.monotonic() + seconds
+
+def clear_deadline():
+    """
+    Removes the deadline of the calling thread.
+    """
+    _local.deadline = None
+
+def remaining():
+    """
+    Returns the seconds left in the budget of the calling thread, `None` if it
+    has no deadline.
+    """
+    deadline = getattr(_local, "deadline", None)
+    return None if deadline is None else deadline - time.monotonic()
+
+def propagate_deadline(function):
+    """
+    Binds a function to the deadline of the calling thread, for example to
+    run it on a thread pool within the budget of the request.
+
+    __Parameters__
+
+    - function: callable to run with the deadline
+
+    __Returns__
+
+    - call: callable which runs `function` with the deadline
+    """
+    deadline = getattr(_local, "deadline", None)
+
+    def call(*args, **kwargs):
+        previous = getattr(_local, "deadline", None)
+        _local.deadline = deadline
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return call
+
+class HomeserverUnavailable(MatrixRequestError):
+    """
+    Raised instead of calling a homeserver whose circuit breaker is open.
+    """
+    def __init__(self, content="The homeserver is unavailable, try again later"):
+        super().__init__(code=503, content=content)
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of a homeserver.
+
+    After `failures` consecutive failed calls the breaker opens and the calls
+    fail immediately. After `reset_timeout` seconds a single probe call is let
+    through, the breaker closes when it succeeds and opens again otherwise.
+    Connection errors, HTTP 429 and HTTP 5xx responses are failures.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures=5, reset_timeout=30):
+        """
+        __Parameters__
+
+        - failures: consecutive failures which open the breaker
+        - reset_timeout: seconds before a probe call is let through
+        """
+        self._threshold = failures
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened >= self._reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    @property
+    def open(self):
+        """
+        `True` while the calls fail immediately, the readers use their cached
+        data instead.
+        """
+        return self.state == self.OPEN
+
+    def allow(self):
+        """
+        Returns `True` if a call may be sent to the homeserver.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened < self._reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self._threshold:
+                self._state = self.OPEN
+                self._opened = time.monotonic()
+                self._probing = False
+
+class DeadlineAdapter(HTTPAdapter):
+    """
+    HTTP adapter which bounds the timeout of every request by the deadline of
+    the calling thread. The requests of threads without deadline, like the
+    sync listener and the thread pools, wait `default_timeout` seconds at
+    most.
+    """
+    def __init__(self, default_timeout=None, **kwargs):
+        super().__init__(**kwargs)
+        self.default_timeout = default_timeout
+
+    def send(self, request, timeout=None, **kwargs):
+        budget = remaining()
+        if budget is None:
+            if timeout is None:
+                timeout = self.default_timeout
+        else:
+            budget = max(budget, 0.001)
+            if timeout is None:
+                timeout = budget
+            elif isinstance(timeout, tuple):
+                timeout = tuple(budget if value is None else min(value, budget) for value in timeout)
+            else:
+                timeout = min(timeout, budget)
+        return super().send(request, timeout=timeout, **kwargs)
+
+def protect_api(api, breaker, retries=2, backoff=0.1):
+    """
+    Wraps the public methods of a Matrix.org SDK MatrixHttpApi object with the
+    deadline of the calling thread and the circuit breaker of its homeserver.
+    Reads (`get_*`) are retried with a full-jitter exponential backoff.
+    Connection errors are raised as HTTP 502 MatrixRequestErrors. Only the
+    given object is changed.
+
+    __Parameters__
+
+    - api: MatrixHttpApi object of a client
+    - breaker: CircuitBreaker of the homeserver
+    - retries: maximum number of retries of a read
+    - backoff: seconds of the first backoff, doubled on every retry
+    """
+    for name in dir(api):
+        if name.startswith("_") or name in NOT_INSTRUMENTED:
+            continue
+        method = getattr(api, name)
+        if callable(method):
+            setattr(api, name, _protected(name, method, breaker, retries if name.startswith("get_") else 0, backoff))
+
+def _protected(name, method, breaker, retries, backoff):
+    def call(*args, **kwargs):
+        attempt = 0
+        while True:
+            budget = remaining()
+            if budget is not None and budget <= 0:
+                raise MatrixRequestError(code=504, content="The deadline expired before the homeserver answered")
+            if not breaker.allow():
+                raise HomeserverUnavailable()
+
+            try:
+                result = method(*args, **kwargs)
+            except MatrixRequestError as e:
+                if e.code < 500 and e.code != 429:
+                    breaker.success() # the homeserver answered
+                    raise
+                breaker.failure()
+                error = e
+            except MatrixHttpLibError as e:
+                breaker.failure()
+                error = e
+            except BaseException:
+                breaker.failure() # for example a proxy page which isn't JSON, a probe is never left pending
+                raise
+            else:
+                breaker.success()
+                return result
+
+            delay = random.uniform(0, backoff * 2 ** attempt)
+            budget = remaining()
+            if attempt >= retries or (budget is not None and delay >= budget):
+                if budget is not None and budget <= 0:
+                    raise MatrixRequestError(code=504, content="The deadline expired before the homeserver answered")
+                if isinstance(error, MatrixHttpLibError):
+                    # Bad gateway, the endpoints report MatrixRequestErrors
+                    raise MatrixRequestError(code=502, content=str(error)) from error
+                raise error
+            RETRIES.inc(call=name)
+            time.sleep(delay)
+            attempt += 1
+    call.__name__ = name
+    call.__doc__ = method.__doc__
+    return call
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+"""
+The SearchIndex is a full-text index of the text messages of all the
+sessions, stored in SQLite FTS5 next to the StateStore and updated
+incrementally by the sync listener and the room histories. Every session
+only searches the messages it indexed itself.
+"""
+
+import collections
+import json
+import os
+import queue
+import sqlite3
+import threading
+from normalizer import Message
+
+__all__ = ["SearchIndex"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_messages (
+    id INTEGER PRIMARY KEY,
+    token TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    sender TEXT,
+    type TEXT NOT NULL,
+    timestamp INTEGER,
+    body TEXT NOT NULL,
+    UNIQUE (token, event_id)
+);
+CREATE INDEX IF NOT EXISTS search_messages_room ON search_messages (token, room_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    body, content='search_messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS search_messages_insert AFTER INSERT ON search_messages BEGIN
+    INSERT INTO search_index (rowid, body) VALUES (new.id, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS search_messages_delete AFTER DELETE ON search_messages BEGIN
+    INSERT INTO search_index (search_index, rowid, body) VALUES ('delete', old.id, old.body);
+END;
+"""
+
+# Indexes of a version without the token column, the messages are indexed again by the syncs
+OUTDATED = """
+DROP TRIGGER IF EXISTS search_messages_insert;
+DROP TRIGGER IF EXISTS search_messages_delete;
+DROP TABLE IF EXISTS search_index;
+DROP TABLE IF EXISTS search_messages;
+"""
+
+SEARCH = """
+SELECT m.room_id, m.event_id, m.sender, m.type, m.timestamp, m.body,
+       snippet(search_index, 0, '[', ']', '...', 12), bm25(search_index)
+FROM search_index JOIN search_messages m ON m.id = search_index.rowid
+WHERE search_index MATCH ? AND m.token = ? AND m.room_id IN (SELECT value FROM json_each(?))
+ORDER BY bm25(search_index), m.timestamp DESC
+LIMIT ? OFFSET ?
+"""
+
+class SearchIndex(object):
+    """
+    Full-text index with a write-behind thread, like the StateStore.
+
+    Messages are ranked with BM25, the most recent first among equally
+    relevant ones. The words of a query must all match, the last word
+    matches as a prefix to search while typing.
+    """
+    INDEXED_TYPES = ("text", "notice", "emote")
+    BATCH_SIZE = 500 # maximum number of queued writes per transaction
+    RECENT = 10000 # (token, event ID) remembered to skip the events indexed already
+
+    def __init__(self, path):
+        """
+        __Parameters__
+
+        - path: location of the SQLite database, created when missing
+
+        __Raises__
+
+        - sqlite3.OperationalError: SQLite is built without FTS5
+        """
+        self._path = path
+        self._queue = queue.Queue()
+        self._local = threading.local() # read connection of each thread
+        self._lock = threading.Lock()
+        self._recent = collections.OrderedDict()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._connection = self._connect()
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(search_messages)")]
+        if columns and "token" not in columns:
+            self._connection.executescript(OUTDATED)
+        self._connection.executescript(SCHEMA)
+
+        self._writer = threading.Thread(target=self._write_forever, name="SearchIndex")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def add(self, token, room_id, event_id, message):
+        """
+        Indexes a message for a session, messages without text and messages
+        indexed already are skipped.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - room_id: Matrix ID of the room
+        - event_id: Matrix ID of the event
+        - message: normalized Message
+        """
+        if message.type not in self.INDEXED_TYPES or not message.content:
+            return
+        with self._lock:
+            if (token, event_id) in self._recent:
+                return
+            self._recent[(token, event_id)] = None
+            if len(self._recent) > self.RECENT:
+                self._recent.popitem(last=False)
+        self._queue.put(("INSERT OR IGNORE INTO search_messages (token, event_id, room_id, sender, type, timestamp, body) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (token, event_id, room_id, message.sender, message.type, message.timestamp, message.content)))
+
+    def remove(self, token, event_id):
+        """
+        Removes a message of a session from the index, for example when it's
+        redacted.
+        """
+        with self._lock:
+            self._recent.pop((token, event_id), None)
+        self._queue.put(("DELETE FROM search_messages WHERE token = ? AND event_id = ?", (token, event_id)))
+
+    def remove_room(self, token, room_id):
+        """
+        Removes the messages of a room from the index of a session, for example
+        after leaving it.
+        """
+        with self._lock:
+            self._recent.clear() # the room may be joined and indexed again
+        self._queue.put(("DELETE FROM search_messages WHERE token = ? AND room_id = ?", (token, room_id)))
+
+    def remove_session(self, token):
+        """
+        Removes all the messages indexed by a session.
+        """
+        with self._lock:
+            self._recent.clear()
+        self._queue.put(("DELETE FROM search_messages WHERE token = ?", (token,)))
+
+    def search(self, token, query, room_ids, limit=20, offset=0):
+        """
+        Finds the messages of a session matching a query.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - query: words to search
+        - room_ids: IDs of the rooms to search in
+        - limit: maximum number of results
+        - offset: number of results to skip
+
+        __Returns__
+
+        - results: list of dictionaries, the most relevant first
+
+        ```json
+            {
+                "room_id": string
+                "event_id": string
+                "snippet": string, matched words between brackets
+                "rank": number, lower is more relevant
+                "message": message
+            }
+        ```
+        - more: `True` if there are more results
+        """
+        match = self._match(query)
+        if match is None or not room_ids:
+            return [], False
+
+        rows = self._reader().execute(SEARCH, (match, token, json.dumps(list(room_ids)), limit + 1, offset)).fetchall()
+        results = [{
+            "room_id": room_id,
+            "event_id": event_id,
+            "snippet": snippet,
+            "rank": round(rank, 4),
+            "message": Message(type, sender, body, timestamp)
+        } for room_id, event_id, sender, type, timestamp, body, snippet, rank in rows[:limit]]
+        return results, len(rows) > limit
+
+    def flush(self):
+        """
+        Blocks until all the queued writes are committed.
+        """
+        self._queue.join()
+
+    def _match(self, query):
+        # Every word is a quoted FTS5 string, the user can't inject operators
+        words = query.split()
+        if not words:
+            return None
+        terms = ['"{0}"'.format(word.replace('"', '""')) for word in words]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _reader(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self._path)
+        return connection
+
+    def _write_forever(self):
+        while True:
+            writes = [self._queue.get()]
+            while len(writes) < self.BATCH_SIZE:
+                try:
+                    writes.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self._connection:
+                    for sql, params in writes:
+                        self._connection.execute(sql, params)
+            except sqlite3.Error:
+                pass # the index is rebuilt by the next syncs and backfills
+            finally:
+                for _ in writes:
+                    self._queue.task_done()
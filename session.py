@@ -0,0 +1,975 @@
+#!/usr/bin/python3
+
+"""
+A Session holds the Matrix.org client and all the cached state of one
+authenticated user, the SessionPool keeps the sessions of all the users of the
+daemon.
+"""
+
+import concurrent.futures
+import json
+import re
+import threading
+import time
+import urllib.parse
+from matrix_client.errors import MatrixError, MatrixRequestError
+from eventstore import EventStore
+from history import RoomHistory
+from normalizer import EventNormalizer, Message
+from registry import RoomRegistry
+from resilience import DeadlineAdapter, HomeserverUnavailable, propagate_deadline, remaining
+from singleflight import KeyedLocks, SingleFlight
+from snapshot import ContactsSnapshot
+from stream import EventStream
+from unread import UnreadTracker
+
+__all__ = ["Session", "SessionPool"]
+
+class Session(object):
+    HISTORY_SIZE = 500 # maximum number of buffered messages per room
+    MATRIX_ID = re.compile("(^!)|(^#)|(:)") # starts with '#' or '!' or a ':' is in the string
+
+    def __init__(self, client, token, members, store=None, messages=None, media=None, events=None, search=None,
+                 breaker=None):
+        """
+        Starts the sync listener of an authenticated client and indexes the
+        rooms of its initial sync.
+
+        __Parameters__
+
+        - client: authenticated Matrix.org SDK client
+        - token: Matrix auth token of the client
+        - members: MemberCache of the session
+        - store: StateStore to persist the session in, optional
+        - messages: recent messages of a session restored from the store,
+        `{room_id: [(event_id, after_token, message)]}`
+        - media: MediaCache serving the images of the messages, optional
+        - events: EventStore of the room histories, shared by the sessions of
+        the Model, a private one is created when omitted
+        - search: SearchIndex of the messages, optional
+        - breaker: CircuitBreaker of the homeserver, the cached data is served
+        while it's open
+        """
+        self.client = client
+        self.token = token
+        self.last_used = time.monotonic()
+        self.closed = False
+        self._store = store
+        self._media = media
+        self._search = search
+        self._breaker = breaker
+        self._members = members
+        self._contacts = ContactsSnapshot(self._contact, self._members.resolve)
+        self._registry = RoomRegistry()
+        self._histories = {}
+        self._flights = SingleFlight() # identical concurrent reads share one call
+        self._room_locks = KeyedLocks() # changes of a room are serialized
+        self._events = events if events is not None else EventStore(self.HISTORY_SIZE)
+        self._stream = EventStream()
+        self._normalizer = EventNormalizer(self.decode_download_link)
+        self._unread = UnreadTracker(client.user_id)
+
+        # Index the rooms of the initial sync
+        for room in list(self.client.get_rooms().values()):
+            self._index_room(room)
+
+        # Warm the room histories with the stored messages
+        if messages is not None:
+            for room_id, entries in messages.items():
+                history = self._history(room_id, None)
+                for event_id, after_token, message in entries:
+                    message = Message.from_json(message)
+                    history.append(event_id, after_token, message)
+                    self._unread.backfill(room_id, event_id, message)
+        elif self._store is not None:
+            self._store.put_session(token, client.api.base_url, client.user_id)
+            for room in list(self.client.get_rooms().values()):
+                self._store.put_room(token, room)
+            self._store.set_sync_token(token, client.sync_token)
+
+        # Keep the contacts snapshot and room registry up to date with the sync listener
+        self.client.add_listener(self._on_event)
+        self.client.add_ephemeral_listener(self._on_receipt, "m.receipt")
+        self.client.add_leave_listener(self._on_leave)
+        self.client.start_listener_thread(exception_handler=self._on_sync_error)
+
+    def close(self):
+        """
+        Stops the sync listener and removes the session from the store.
+        Joining the thread would block until the long-poll of the homeserver
+        returns.
+        """
+        self.closed = True
+        self.client.should_listen = False
+        for room_id in list(self._histories):
+            self._drop_history(room_id)
+        if self._search is not None:
+            self._search.remove_session(self.token)
+        if self._store is not None:
+            self._store.remove_session(self.token)
+
+    @property
+    def rooms(self):
+        """
+        Retrieves the rooms from the user's address book as JSON.
+
+        __Returns__
+
+        - rooms: Python list of all rooms in dictionary format
+
+        ```json
+            {
+                "id": string
+                "name": string
+                "avatar": string
+                "last_seen": number, timestamp of the last message
+                "unread": number, messages the user didn't read
+                "last_message": message, `null` when unknown
+                "members": [
+                    {
+                        "id": string
+                        "name": string
+                        "last_seen": string
+                        "avatar": string
+                    },
+                    ...
+                ]
+            }
+        ```
+        """
+        return self._flights.do(("contacts",), lambda: self._contacts.refresh(self.client.get_rooms()))
+
+    @property
+    def contacts_etag(self):
+        """
+        ETag of the contacts list, `None` when the list has to be rebuilt.
+        """
+        return self._contacts.etag(self.client.get_rooms())
+
+    def find_rooms(self, member=None, name_prefix=None):
+        """
+        Retrieves the rooms matching all the given filters from the room
+        registry, see `rooms` for the format.
+
+        __Parameters__
+
+        - member: Matrix user ID which must be joined in the room
+        - name_prefix: case insensitive start of the room name
+
+        __Returns__
+
+        - rooms: Python list of the matching rooms in dictionary format
+        """
+        room_ids = None
+        if member is not None:
+            room_ids = self._registry.with_member(member)
+        if name_prefix is not None:
+            matches = self._registry.with_name_prefix(name_prefix)
+            room_ids = matches if room_ids is None else room_ids & matches
+
+        def select():
+            rooms = {}
+            for room_id in sorted(room_ids or []):
+                room = self._registry.get(room_id)
+                if room is not None:
+                    rooms[room_id] = room
+            return self._contacts.select(rooms)
+
+        return self._flights.do(("find_contacts", member, name_prefix), select)
+
+    def add_room(self, room_id):
+        """
+        Adds a room to the user address book if the `room_id` exists, if it doesn't
+        exists, the room will be created and added to the user address book.
+
+        __Returns__
+
+        - room_id: Matrix ID of the joined or created room
+
+        __Raises__
+
+        - MatrixRequestError: in case something goes wrong with the Matrix API,
+        this exception will be raised.
+        """
+        with self._room_locks(room_id):
+            # room_id is a full ID for joining
+            if self.MATRIX_ID.match(room_id):
+                room = self.client.join_room(room_id)
+            # new room since the room_id isn't a valid Matrix room ID but a room alias
+            else:
+                room = self.client.create_room(room_id)
+                room.set_room_name(room_id) # set the room name to the room alias
+
+        self._index_room(room)
+        self._contacts.invalidate(room.room_id)
+        if self._store is not None:
+            self._store.put_room(self.token, room)
+        return room.room_id
+
+    def add_rooms(self, room_ids, executor):
+        """
+        Joins or creates many rooms concurrently, see `add_room`. The contacts
+        of the added rooms are only built by the next `rooms` call. The joins
+        share the deadline of the request, the rooms which aren't added when it
+        expires fail with code 504.
+
+        __Parameters__
+
+        - room_ids: list of Matrix room IDs, aliases or names of new rooms
+        - executor: thread pool to join the rooms with
+
+        __Returns__
+
+        - results: list of dictionaries in the order of `room_ids`
+
+        ```json
+            {
+                "room_id": string, as requested
+                "added": boolean
+                "id": string, Matrix ID of the room, only when added
+                "error": {"code": number, "message": string}, only when not added
+            }
+        ```
+        """
+        add_room = propagate_deadline(self.add_room)
+        futures = [executor.submit(add_room, room_id) for room_id in room_ids]
+        concurrent.futures.wait(futures, timeout=remaining())
+
+        results = []
+        for room_id, future in zip(room_ids, futures):
+            result = {
+                "room_id": room_id
+            }
+            if not future.done():
+                future.cancel() # a running join can't be cancelled, the room may still be added
+                result["added"] = False
+                result["error"] = {"code": 504, "message": "The deadline expired before the room was added"}
+                results.append(result)
+                continue
+            try:
+                result["id"] = future.result()
+                result["added"] = True
+            except MatrixRequestError as e:
+                result["added"] = False
+                result["error"] = {"code": e.code, "message": e.content}
+            except MatrixError as e:
+                result["added"] = False
+                result["error"] = {"code": 502, "message": str(e)}
+            except Exception as e: # the other rooms were added already
+                result["added"] = False
+                result["error"] = {"code": 500, "message": str(e)}
+            results.append(result)
+        return results
+
+    def remove_room(self, room_id):
+        """
+        Let the user leave a room in his address book.
+
+        __Raises__
+
+        - MatrixRequestError: leaving an unjoined is not possible.
+        """
+        success = False
+        room = self._find_room(room_id)
+        if room is not None:
+            with self._room_locks(room.room_id):
+                success = room.leave()
+
+        if not success:
+            raise MatrixRequestError(code=404, content="You can't leave a room \
+            ({0}) if you haven't joined it yet.".format(room_id))
+
+        self._registry.remove(room.room_id)
+        self._contacts.discard(room.room_id)
+        self._unread.discard(room.room_id)
+        self._members.discard(room.room_id)
+        self._drop_history(room.room_id)
+        if self._search is not None:
+            self._search.remove_room(self.token, room.room_id)
+        if self._store is not None:
+            self._store.remove_room(self.token, room.room_id)
+
+    def messages(self, room_id, start=None, limit=10, direction="b"):
+        """
+        Returns a page of messages for a specific room_id. The latest messages
+        are kept in a bounded ring buffer, older messages are read from the
+        homeserver with Matrix pagination tokens.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        - start: cursor returned by a previous call, `None` starts at the
+        latest message
+        - limit: maximum number of messages
+        - direction: `b` pages back in time, `f` pages forward
+
+        __Raises__
+
+        - MatrixRequestError: the room isn't joined
+        - ValueError: the cursor is invalid
+
+        __Returns__
+
+        - page: dictionary with the `messages` list in chronological order,
+        the `start` cursor and the `end` cursor for the next page. `stale` is
+        `true` when the homeserver is unavailable and only the buffered
+        messages are served.
+        """
+        room = self._find_room(room_id)
+        if room is None:
+            raise MatrixRequestError(code=404, content="Room {0} isn't joined".format(room_id))
+
+        history = self._history(room.room_id, self.client.sync_token)
+        stale = self._breaker is not None and self._breaker.open
+        try:
+            if not stale:
+                messages, start, end = self._flights.do(("messages", room.room_id, start, limit, direction),
+                                                        lambda: history.page(start, limit, direction))
+        except HomeserverUnavailable:
+            stale = True
+        if stale:
+            messages, start, end = history.page(start, limit, direction, cached=True)
+        return {
+            "messages": [self._served(room.room_id, message) for message in messages],
+            "start": start,
+            "end": end,
+            "stale": stale
+        }
+
+    def mark_read(self, room_id, event_id=None):
+        """
+        Moves the read marker of a room and sends the read receipt to the
+        homeserver.
+
+        __Parameters__
+
+        - room_id: Matrix ID or alias of the room
+        - event_id: Matrix ID of the last read event, the last message of the
+        room when omitted
+
+        __Raises__
+
+        - MatrixRequestError: the room isn't joined or the homeserver refused
+        the receipt
+
+        __Returns__
+
+        - summary: dictionary with the `id` of the room and its read state,
+        see `UnreadTracker.summary`
+        """
+        room = self._find_room(room_id)
+        if room is None:
+            raise MatrixRequestError(code=404, content="Room {0} isn't joined".format(room_id))
+
+        with self._room_locks(room.room_id):
+            if event_id is None:
+                event_id = self._unread.last_event(room.room_id)
+            if event_id is not None:
+                # Not implemented by the Matrix.org Python SDK
+                self.client.api._send("POST", "/rooms/{0}/receipt/m.read/{1}".format(
+                    urllib.parse.quote(room.room_id, safe=""), urllib.parse.quote(event_id, safe="")
+                ), {})
+                if self._unread.read(room.room_id, event_id):
+                    self._contacts.invalidate(room.room_id)
+
+        summary = self._unread.summary(room.room_id)
+        summary["id"] = room.room_id
+        return summary
+
+    def search(self, query, room_id=None, limit=20, start=None):
+        """
+        Searches the text of the messages, the most relevant first.
+
+        __Parameters__
+
+        - query: words to search, the last one matches as a prefix
+        - room_id: Matrix ID or alias of the room to search in, all the
+        joined rooms when omitted
+        - limit: maximum number of results
+        - start: cursor returned by a previous call, `None` starts with the
+        most relevant result
+
+        __Raises__
+
+        - MatrixRequestError: the room isn't joined or searching isn't
+        supported by the SQLite library
+        - ValueError: the cursor is invalid
+
+        __Returns__
+
+        - page: dictionary with the `results` list (see `SearchIndex.search`),
+        the `start` cursor and the `end` cursor for the next page, `None` after
+        the last page
+        """
+        if self._search is None:
+            raise MatrixRequestError(code=501, content="Searching requires SQLite with FTS5")
+
+        if room_id is None:
+            room_ids = self._registry.room_ids()
+        else:
+            room = self._find_room(room_id)
+            if room is None:
+                raise MatrixRequestError(code=404, content="Room {0} isn't joined".format(room_id))
+            room_ids = [room.room_id]
+
+        offset = 0
+        if start is not None:
+            if not start.startswith("o") or not start[1:].isdigit():
+                raise ValueError("Invalid cursor: {0}".format(start))
+            offset = int(start[1:])
+
+        results, more = self._search.search(self.token, query, room_ids, limit, offset)
+        for result in results:
+            result["message"] = self._served(result["room_id"], result["message"])
+        return {
+            "results": results,
+            "start": start,
+            "end": "o{0}".format(offset + len(results)) if more else None
+        }
+
+    def sync(self, since=None):
+        """
+        Returns the contacts and the messages which changed since a previous
+        call, the work depends on the activity since then instead of the
+        number of rooms.
+
+        __Parameters__
+
+        - since: cursor returned by a previous call, all the contacts are
+        returned when `None`
+
+        __Raises__
+
+        - ValueError: the cursor is invalid
+
+        __Returns__
+
+        - delta: dictionary
+
+        ```json
+            {
+                "cursor": string, passed as `since` on the next call
+                "full": boolean, `true` if `contacts` lists all the contacts and
+                the messages of the cursor couldn't be replayed
+                "contacts": [contact, ...], new and changed contacts
+                "removed": [string, ...], IDs of the removed contacts
+                "messages": [
+                    {
+                        "cursor": number
+                        "room_id": string
+                        "message": message
+                    },
+                    ...
+                ]
+            }
+        ```
+        """
+        clock = seq = None
+        if since is not None:
+            try:
+                generation, clock, seq = since.split("_")
+                clock, seq = int(clock), int(seq)
+            except ValueError:
+                raise ValueError("Invalid cursor: {0}".format(since))
+            if generation != self._contacts.generation:
+                clock = seq = None # cursor of a previous session, start over
+
+        # Messages first, the contacts of their rooms changed too
+        events, cursor, complete = self._stream.since(seq if seq is not None else self._stream.cursor)
+        full = clock is None or not complete
+        contacts, removed, clock = self._contacts.changes(self.client.get_rooms(), None if full else clock)
+        if not complete:
+            events = []
+
+        messages = []
+        for event_seq, room_id, message in events:
+            messages.append({
+                "cursor": event_seq,
+                "room_id": room_id,
+                "message": self._served(room_id, message)
+            })
+
+        return {
+            "cursor": "{0}_{1}_{2}".format(self._contacts.generation, clock, cursor),
+            "full": full,
+            "contacts": contacts,
+            "removed": removed,
+            "messages": messages
+        }
+
+    @property
+    def events_cursor(self):
+        """
+        Cursor of the latest message received by the sync listener.
+        """
+        return self._stream.cursor
+
+    def wait_events(self, cursor, room_id=None, timeout=30):
+        """
+        Waits for new messages from the sync listener.
+
+        __Parameters__
+
+        - cursor: cursor of the last message seen by the caller
+        - room_id: Matrix ID of the room, all rooms when `None`
+        - timeout: maximum number of seconds to wait
+
+        __Returns__
+
+        - events: list of dictionaries with a `cursor`, `room_id` and `message`,
+        empty when the timeout expired
+        - cursor: cursor to wait after on the next call
+        """
+        if room_id is not None:
+            room = self._find_room(room_id)
+            room_id = room_id if room is None else room.room_id
+
+        events, cursor = self._stream.wait(cursor, room_id, timeout)
+        return [{
+            "cursor": seq,
+            "room_id": event_room_id,
+            "message": self._served(event_room_id, message)
+        } for seq, event_room_id, message in events], cursor
+
+    def send_text(self, room_id, text, txn_id=None):
+        """
+        Sends a basic text message to the given room.
+
+        __Parameters__
+
+        - room_id: Matrix ID or alias of the room
+        - text: text to send
+        - txn_id: transaction ID of the message, retrying with the same
+        transaction ID doesn't send the message twice. Generated by the
+        Matrix.org SDK when omitted.
+
+        __Raises__
+
+        - MatrixRequestError: when something goes wrong while sending the message
+        a MatrixRequestError is raised, 404 if the room isn't joined
+
+        __Returns__
+
+        - event_id: Matrix ID of the sent event
+        """
+        content = {
+            "msgtype": "m.text",
+            "body": text
+        }
+        room_id = self.resolve_room(room_id)
+        with self._room_locks(room_id): # messages of a room are sent in order
+            response = self.client.api.send_message_event(room_id, "m.room.message", content, txn_id=txn_id)
+        return response["event_id"]
+
+    def resolve_room(self, room_id):
+        """
+        Returns the Matrix ID of a joined room.
+
+        __Parameters__
+
+        - room_id: Matrix ID or alias of the room
+
+        __Raises__
+
+        - MatrixRequestError: 404 if the room isn't joined
+        """
+        room = self._find_room(room_id)
+        if room is None:
+            raise MatrixRequestError(404, "Room {0} isn't joined".format(room_id))
+        return room.room_id
+
+    def broadcast(self, messages, executor):
+        """
+        Sends many text messages concurrently. The transaction ID of each
+        message makes retries idempotent: the homeserver doesn't send a
+        message twice with the same transaction ID. The messages share the
+        deadline of the request, the messages which aren't sent when it
+        expires fail with code 504.
+
+        __Parameters__
+
+        - messages: list of `(room_id, text, txn_id)` tuples
+        - executor: thread pool to send the messages with
+
+        __Returns__
+
+        - results: list of dictionaries in the order of `messages`
+
+        ```json
+            {
+                "room_id": string
+                "txn_id": string
+                "sent": boolean
+                "event_id": string, only when sent
+                "error": {"code": number, "message": string}, only when not sent
+            }
+        ```
+        """
+        send_text = propagate_deadline(self.send_text)
+        futures = [executor.submit(send_text, room_id, text, txn_id)
+                   for room_id, text, txn_id in messages]
+        concurrent.futures.wait(futures, timeout=remaining())
+
+        results = []
+        for (room_id, text, txn_id), future in zip(messages, futures):
+            result = {
+                "room_id": room_id,
+                "txn_id": txn_id
+            }
+            if not future.done():
+                future.cancel() # a running send can't be cancelled, retry with the same txn_id
+                result["sent"] = False
+                result["error"] = {"code": 504, "message": "The deadline expired before the message was sent"}
+                results.append(result)
+                continue
+            try:
+                result["event_id"] = future.result()
+                result["sent"] = True
+            except MatrixRequestError as e:
+                result["sent"] = False
+                result["error"] = {"code": e.code, "message": e.content}
+            except MatrixError as e:
+                result["sent"] = False
+                result["error"] = {"code": 502, "message": str(e)}
+            except Exception as e: # the other messages were sent already
+                result["sent"] = False
+                result["error"] = {"code": 500, "message": str(e)}
+            results.append(result)
+        return results
+
+    def decode_download_link(self, link, prefetch=True):
+        """
+        Converts a Matrix MXC link to the URL of the local media cache and
+        prefetches its thumbnail if asked. Without media cache, the link
+        points to the homeserver.
+        """
+        if self._media is None:
+            return self.client.api.get_download_url(link)
+
+        url = self._media.local_url(link)
+        if url is not None and prefetch:
+            self._media.prefetch(self.client.api.base_url, link, self._breaker)
+        return url
+
+    def _served(self, room_id, message):
+        """
+        Returns the JSON of a message with the read state of the user. The
+        Message objects are shared by the caches, they're never changed.
+        """
+        return dict(message.to_json(), read=self._unread.is_read(room_id, message))
+
+    def _contact(self, room):
+        """
+        Builds the contact dictionary of a room, see `rooms`.
+        """
+        room_data = {
+            "id": room.room_id,
+            "name": room.name,
+            "avatar": None, # unsupported by the Matrix.org Python SDK
+            "members": []
+        }
+        room_data.update(self._unread.summary(room.room_id))
+        if room_data["last_message"] is not None:
+            room_data["last_message"] = self._served(room.room_id, room_data["last_message"])
+
+        # Resolved concurrently for all the rooms of a refresh, see MemberCache
+        members = self._members.get(room.room_id)
+        if members is None:
+            # Timed out, the members are resolved in the background for the next refresh
+            self._contacts.invalidate(room.room_id)
+            stale = self._breaker is not None and self._breaker.open
+            members = (self._members.get(room.room_id, stale=True) if stale else None) or []
+        else:
+            self._registry.set_members(room.room_id, [user_id for user_id, _ in members])
+
+        # Add each member of the room to the members property
+        for index, (user_id, displayname) in enumerate(members):
+            room_data["members"].append({
+                "id": index,
+                "name": displayname,
+                "avatar": None, #member.get_avatar_url(), # Broken in the Matrix.org Python SDK
+                "last_seen": None # unsupported by the Matrix.org Python SDK
+            })
+
+        return room_data
+
+    def _on_event(self, event):
+        """
+        Sync listener, indexes new rooms and invalidates the contact when the
+        room state changed.
+        """
+        room_id = event["room_id"]
+        if room_id not in self._registry:
+            room = self.client.get_rooms().get(room_id)
+            if room is not None:
+                self._index_room(room)
+
+        if "state_key" in event:
+            self._registry.update(event)
+            self._contacts.invalidate(room_id)
+            if event["type"] == "m.room.member":
+                self._members.invalidate(room_id)
+            if self._store is not None and room_id in self.client.get_rooms():
+                self._store.put_room(self.token, self.client.get_rooms()[room_id])
+
+        if event["type"] == "m.room.redaction" and event.get("redacts") is not None:
+            self._redact(room_id, event["redacts"])
+
+        message = self._normalizer.normalize(event)
+        if message is not None:
+            history = self._histories.get(room_id)
+            if history is not None:
+                history.append(event["event_id"], self.client.sync_token, message)
+            self._unread.message(room_id, event["event_id"], message)
+            self._contacts.invalidate(room_id)
+            self._stream.publish(room_id, message, event["event_id"])
+            if self._search is not None:
+                self._search.add(self.token, room_id, event["event_id"], message)
+            if self._store is not None:
+                self._store.put_message(self.token, room_id, event["event_id"], self.client.sync_token, message.to_json())
+
+        if self._store is not None:
+            self._store.set_sync_token(self.token, self.client.sync_token)
+
+    def _redact(self, room_id, event_id):
+        """
+        Replaces the buffered, stored and streamed copies of a redacted
+        message by the redacted placeholder.
+        """
+        self._normalizer.forget(event_id)
+        if self._search is not None:
+            self._search.remove(self.token, event_id)
+        history = self._histories.get(room_id)
+        if history is not None:
+            history.redact(event_id)
+        self._unread.redact(room_id, event_id)
+        self._stream.redact(event_id)
+        if self._store is not None:
+            self._store.redact_message(self.token, event_id)
+        self._contacts.invalidate(room_id)
+
+    def _on_receipt(self, event):
+        """
+        Sync listener, moves the read marker when a read receipt of the user
+        arrives, for example from another client of the user.
+        """
+        room_id = event["room_id"]
+        for event_id, receipts in event.get("content", {}).items():
+            receipt = receipts.get("m.read", {}).get(self.client.user_id)
+            if receipt is not None and self._unread.read(room_id, event_id, receipt.get("ts")):
+                self._contacts.invalidate(room_id)
+
+    def _on_leave(self, room_id, room):
+        """
+        Sync listener, removes the contact when the user left the room.
+        """
+        self._registry.remove(room_id)
+        self._contacts.discard(room_id)
+        self._unread.discard(room_id)
+        self._members.discard(room_id)
+        self._drop_history(room_id)
+        if self._search is not None:
+            self._search.remove_room(self.token, room_id)
+        if self._store is not None:
+            self._store.remove_room(self.token, room_id)
+
+    def _on_sync_error(self, e):
+        """
+        Keeps the sync listener alive on network errors and rate limits, stops
+        it when the homeserver refuses our token.
+        """
+        if isinstance(e, MatrixRequestError):
+            errcode, retry_after = self._error_details(e)
+            if e.code == 401 or (e.code == 403 and errcode == "M_UNKNOWN_TOKEN"):
+                self.close()
+                raise e # ends the sync thread
+            if e.code == 429 and retry_after is not None:
+                time.sleep(retry_after)
+                return
+        time.sleep(5)
+
+    @staticmethod
+    def _error_details(e):
+        """
+        Returns the `errcode` and the seconds of `retry_after_ms` of a Matrix
+        error response, `None` when missing.
+        """
+        try:
+            content = json.loads(e.content)
+        except (TypeError, ValueError):
+            return None, None
+        if not isinstance(content, dict):
+            return None, None
+        retry_after = content.get("retry_after_ms")
+        return content.get("errcode"), retry_after / 1000 if isinstance(retry_after, (int, float)) else None
+
+    def _history(self, room_id, token):
+        """
+        Returns the history of a room, the history is created when missing.
+        `token` is the Matrix pagination token a new history backfills from.
+        """
+        history = self._histories.get(room_id)
+        if history is None:
+            history = RoomHistory(
+                lambda token, direction, limit: self._fetch_messages(room_id, token, direction, limit),
+                lambda events: self._indexed(room_id, self._normalizer.messages(events)),
+                token,
+                self._events
+            )
+            history = self._histories.setdefault(room_id, history)
+        return history
+
+    def _indexed(self, room_id, messages):
+        """
+        Adds the messages read from the homeserver to the search index and the
+        unread tracker while they're consumed.
+        """
+        for event_id, message in messages:
+            if self._search is not None:
+                self._search.add(self.token, room_id, event_id, message)
+            if self._unread.backfill(room_id, event_id, message):
+                self._contacts.invalidate(room_id)
+            yield event_id, message
+
+    def _drop_history(self, room_id):
+        """
+        Removes the history of a room and releases its buffer.
+        """
+        history = self._histories.pop(room_id, None)
+        if history is not None:
+            self._events.remove(history)
+
+    def _index_room(self, room):
+        """
+        Adds a room to the registry. The room doesn't keep raw events, the
+        room history keeps the compact messages.
+        """
+        room.event_history_limit = 0
+        self._registry.add(room)
+
+    def _fetch_messages(self, room_id, token, direction, limit):
+        """
+        Reads a chunk of raw events from the homeserver for the room history.
+        """
+        response = self.client.api.get_room_messages(room_id, token, direction=direction, limit=limit)
+        return response["chunk"], response.get("end")
+
+    def _find_room(self, room_id):
+        """
+        Retrieve a Room object based on the room_id or one of its aliases.
+        """
+        return self._registry.get(room_id)
+
+class SessionPool(object):
+    """
+    Sessions of all the authenticated users keyed by their API token.
+
+    Sessions of the same homeserver share their HTTP connection pool, sessions
+    which weren't used for `max_idle` seconds are closed and evicted. Requests
+    without a token get no session, unless the pool is `single_user` and holds
+    exactly one session.
+    """
+    SWEEP_INTERVAL = 60 # seconds between two idle session sweeps
+
+    def __init__(self, max_idle=3600, pool_size=10, single_user=False, timeout=None):
+        self._max_idle = max_idle
+        self._pool_size = pool_size
+        self._timeout = timeout # seconds a homeserver call without deadline waits
+        self._single_user = single_user
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._adapters = {}
+        self._last_sweep = time.monotonic()
+
+    def share_connections(self, client, server):
+        """
+        Lets the client use the HTTP connection pool of its homeserver. Older
+        versions of the Matrix.org Python SDK don't use a HTTP session, their
+        connections can't be shared.
+
+        __Parameters__
+
+        - client: Matrix.org SDK client
+        - server: Matrix server URL
+        """
+        session = getattr(client.api, "session", None)
+        if session is None:
+            return
+
+        with self._lock:
+            adapter = self._adapters.get(server)
+            if adapter is None:
+                adapter = DeadlineAdapter(self._timeout, pool_connections=1, pool_maxsize=self._pool_size)
+                self._adapters[server] = adapter
+        session.mount(server, adapter)
+
+    def add(self, session):
+        """
+        Adds a session.
+
+        __Parameters__
+
+        - session: authenticated Session
+        """
+        with self._lock:
+            self._sessions[session.token] = session
+        self._sweep()
+
+    def get(self, token=None):
+        """
+        Returns the session of the given token. Without a token, the only
+        session of a single user pool is returned.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+
+        __Returns__
+
+        - session: Session or `None` if the token is missing, unknown or evicted
+        """
+        self._sweep()
+        with self._lock:
+            if token is None:
+                if not self._single_user or len(self._sessions) != 1:
+                    return None # another user's session
+                token = next(iter(self._sessions))
+            session = self._sessions.get(token)
+        if session is None:
+            return None
+        if session.closed: # the homeserver refused the token
+            self.remove(session.token)
+            return None
+        session.last_used = time.monotonic()
+        return session
+
+    def remove(self, token):
+        """
+        Closes and removes the session of the given token.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        """
+        with self._lock:
+            session = self._sessions.pop(token, None)
+        if session is not None:
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _sweep(self):
+        """
+        Evicts the idle sessions, at most once every `SWEEP_INTERVAL` seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < self.SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+            idle = [token for token, session in self._sessions.items()
+                    if now - session.last_used > self._max_idle]
+
+        for token in idle:
+            self.remove(token)
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+"""
+The SingleFlight coalesces identical concurrent reads of a session into one
+call, the KeyedLocks serialize the changes of a room without blocking the
+other rooms.
+"""
+
+import concurrent.futures
+import contextlib
+import threading
+from metrics import COALESCED_REQUESTS
+
+__all__ = ["SingleFlight", "KeyedLocks"]
+
+class SingleFlight(object):
+    """
+    Duplicate call suppression.
+
+    The first caller of a key runs the call, the callers arriving before it
+    returns wait for it and receive the same result or exception. The result
+    isn't cached, the next call after it returned runs again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {} # key: Future of the running call
+
+    def do(self, key, call):
+        """
+        Runs the call or waits for the running call of the same key.
+
+        __Parameters__
+
+        - key: hashable tuple, its first item names the call in the metrics
+        - call: callable without arguments
+
+        __Returns__
+
+        - result: return value of the call
+
+        __Raises__
+
+        - Exception: the exception raised by the call
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+
+        if not leader:
+            COALESCED_REQUESTS.inc(call=key[0])
+            return future.result()
+
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+class KeyedLocks(object):
+    """
+    One lock per key, created on demand and released when no thread holds or
+    waits for it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {} # key: [Lock, number of holders and waiters]
+
+    @contextlib.contextmanager
+    def __call__(self, key):
+        """
+        Context manager holding the lock of a key.
+        """
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+"""
+The ContactsSnapshot keeps the contacts list of the Model in memory and only
+rebuilds the rooms which were invalidated by the sync listener.
+"""
+
+import collections
+import threading
+import uuid
+from metrics import CACHE_REQUESTS
+
+__all__ = ["ContactsSnapshot"]
+
+class ContactsSnapshot(object):
+    """
+    Incrementally maintained list of contacts (rooms).
+
+    Every contact is built once by the `build` callable and kept until its room
+    is invalidated. The optional `prepare` callable receives all the rooms of a
+    refresh at once, to fetch their data concurrently before building them.
+    Each change bumps the snapshot version which is exposed as an ETag,
+    allowing the API to answer unchanged polls with HTTP 304.
+
+    Every build and removal also advances a change clock, `changes` returns
+    the contacts which changed after a given clock value.
+    """
+    def __init__(self, build, prepare=None):
+        self._build = build
+        self._prepare = prepare # called with the Room objects before a batch of builds
+        self._lock = threading.Lock()
+        self._generation = uuid.uuid4().hex[:8] # ETags of a previous snapshot never match
+        self._version = 0
+        self._built = None
+        self._contacts = {}
+        self._dirty = set()
+        self._clock = 0
+        self._changed = collections.OrderedDict() # room_id: clock of the last build, oldest first
+        self._removed = collections.OrderedDict() # room_id: clock of the removal, oldest first
+
+    def invalidate(self, room_id):
+        """
+        Marks a room as changed, the room is rebuilt on the next refresh.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        """
+        with self._lock:
+            self._dirty.add(room_id)
+            self._version += 1
+
+    def discard(self, room_id):
+        """
+        Removes a room from the snapshot, for example after leaving it.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        """
+        with self._lock:
+            if self._contacts.pop(room_id, None) is not None:
+                self._removed_at(room_id)
+            self._dirty.discard(room_id)
+            self._version += 1
+
+    @property
+    def generation(self):
+        """
+        Random ID of the snapshot, the change clocks of another snapshot
+        aren't comparable.
+        """
+        return self._generation
+
+    def etag(self, room_ids):
+        """
+        Returns the ETag of the snapshot if it's up to date with the given
+        joined rooms, otherwise `None` is returned.
+
+        __Parameters__
+
+        - room_ids: IDs of all the joined rooms
+
+        __Returns__
+
+        - etag: quoted ETag string or `None`
+        """
+        with self._lock:
+            if self._built != self._version or self._dirty:
+                return None
+            if set(room_ids) != set(self._contacts):
+                return None
+            return "\"{0}-{1}\"".format(self._generation, self._version)
+
+    def refresh(self, rooms):
+        """
+        Rebuilds the new and invalidated rooms and returns all the contacts.
+
+        __Parameters__
+
+        - rooms: dictionary of joined rooms `{room_id: Room}`
+
+        __Returns__
+
+        - contacts: Python list of all rooms in dictionary format
+        """
+        rooms = dict(rooms) # the sync thread may modify the rooms while building
+        with self._lock:
+            for room_id in [key for key in self._contacts if key not in rooms]:
+                del self._contacts[room_id]
+                self._removed_at(room_id)
+                self._version += 1
+            stale = [key for key in rooms if key not in self._contacts or key in self._dirty]
+            if any(key not in self._contacts for key in stale):
+                self._version += 1 # new rooms change the contacts list too
+            self._dirty.clear()
+            version = self._version
+
+        self._rebuild(rooms, stale)
+
+        with self._lock:
+            self._built = version
+            return [self._contacts[key] for key in rooms if key in self._contacts]
+
+    def select(self, rooms):
+        """
+        Returns the contacts of a subset of the joined rooms, only the new and
+        invalidated rooms of the subset are rebuilt.
+
+        __Parameters__
+
+        - rooms: dictionary of the selected rooms `{room_id: Room}`
+
+        __Returns__
+
+        - contacts: Python list of the selected rooms in dictionary format
+        """
+        with self._lock:
+            stale = [key for key in rooms if key not in self._contacts or key in self._dirty]
+            if any(key not in self._contacts for key in stale):
+                self._version += 1 # new rooms change the contacts list too
+            self._dirty.difference_update(stale)
+
+        self._rebuild(rooms, stale)
+
+        with self._lock:
+            return [self._contacts[key] for key in rooms if key in self._contacts]
+
+    def changes(self, rooms, since=None):
+        """
+        Rebuilds the new and invalidated rooms and returns the contacts which
+        changed after the given clock value.
+
+        __Parameters__
+
+        - rooms: dictionary of joined rooms `{room_id: Room}`
+        - since: clock value returned by a previous call, all the contacts are
+        returned when `None`
+
+        __Returns__
+
+        - contacts: Python list of the changed rooms in dictionary format
+        - removed: IDs of the rooms removed from the snapshot
+        - clock: clock value to pass on the next call
+        """
+        rooms = dict(rooms) # the sync thread may modify the rooms while building
+        self.refresh(rooms)
+
+        with self._lock:
+            if since is None:
+                return [self._contacts[key] for key in rooms if key in self._contacts], [], self._clock
+            changed = []
+            for room_id, clock in reversed(self._changed.items()):
+                if clock <= since:
+                    break
+                changed.append(room_id)
+            removed = []
+            for room_id, clock in reversed(self._removed.items()):
+                if clock <= since:
+                    break
+                removed.append(room_id)
+            return [self._contacts[key] for key in reversed(changed)], removed[::-1], self._clock
+
+    def _removed_at(self, room_id):
+        # Called with the lock held
+        self._clock += 1
+        self._changed.pop(room_id, None)
+        self._removed[room_id] = self._clock
+
+    def _rebuild(self, rooms, stale):
+        CACHE_REQUESTS.inc(len(rooms) - len(stale), cache="contacts", result="hit")
+        CACHE_REQUESTS.inc(len(stale), cache="contacts", result="miss")
+
+        # Build outside the lock, these calls may hit the homeserver
+        if stale and self._prepare is not None:
+            self._prepare([rooms[room_id] for room_id in stale])
+        for room_id in stale:
+            contact = self._build(rooms[room_id])
+            with self._lock:
+                self._contacts[room_id] = contact
+                self._clock += 1
+                self._removed.pop(room_id, None)
+                self._changed.pop(room_id, None)
+                self._changed[room_id] = self._clock
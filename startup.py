@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+"""
+The StartupTimer measures how long the daemon takes to start, from the first
+import until every endpoint is mounted, phase by phase.
+"""
+
+import threading
+import time
+
+__all__ = ["StartupTimer"]
+
+STARTED = time.monotonic() # imported first by the controller, the imports are part of the startup
+
+class StartupTimer(object):
+    """
+    Records consecutive startup phases, every phase ends when the next one is
+    marked.
+    """
+    def __init__(self, started=STARTED):
+        """
+        __Parameters__
+
+        - started: `time.monotonic()` timestamp the startup began at
+        """
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._started = started
+        self._last = started
+        self._phases = [] # (phase, seconds)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def mark(self, phase):
+        """
+        Ends a startup phase.
+
+        __Parameters__
+
+        - phase: name of the phase which just ended
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._phases.append((phase, now - self._last))
+            self._last = now
+
+    def done(self):
+        """
+        Marks the end of the startup, all the endpoints are served.
+        """
+        self._ready.set()
+
+    def report(self):
+        """
+        Returns the startup timings.
+
+        __Returns__
+
+        - report: dictionary
+
+        ```json
+            {
+                "ready": boolean, all the endpoints are served
+                "total": number, milliseconds since the startup began
+                "phases": [
+                    {
+                        "phase": string
+                        "duration": number, milliseconds
+                    },
+                    ...
+                ]
+            }
+        ```
+        """
+        with self._lock:
+            phases = list(self._phases)
+            end = self._last if self.ready else time.monotonic()
+        return {
+            "ready": self.ready,
+            "total": round((end - self._started) * 1000, 1),
+            "phases": [{"phase": phase, "duration": round(seconds * 1000, 1)} for phase, seconds in phases]
+        }
@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+
+"""
+The StateStore persists the sessions, rooms, members and recent messages in a
+SQLite database so the daemon can warm its caches from disk after a restart
+and resume with an incremental sync.
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+from matrix_client.user import User
+
+__all__ = ["StateStore"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    server TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    sync_token TEXT
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    token TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    name TEXT,
+    canonical_alias TEXT,
+    aliases TEXT,
+    prev_batch TEXT,
+    PRIMARY KEY (token, room_id)
+);
+CREATE TABLE IF NOT EXISTS members (
+    token TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    displayname TEXT,
+    PRIMARY KEY (token, room_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    token TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    after_token TEXT,
+    message TEXT NOT NULL,
+    UNIQUE (token, event_id)
+);
+CREATE INDEX IF NOT EXISTS messages_room ON messages (token, room_id, id);
+"""
+
+class StateStore(object):
+    """
+    SQLite store in WAL mode with a write-behind thread.
+
+    Writes are queued and committed in batches by a single writer thread so
+    the sync listener never waits for the disk. Reads only happen at startup.
+    """
+    BATCH_SIZE = 500 # maximum number of queued writes per transaction
+
+    def __init__(self, path, keep=50):
+        """
+        __Parameters__
+
+        - path: location of the SQLite database, created when missing
+        - keep: number of recent messages stored per room
+        """
+        self._path = path
+        self._keep = keep
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._sync_tokens = {} # pending sync token updates, only the latest counts
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._connection = self._connect()
+        os.chmod(path, 0o600) # the database contains access tokens
+        self._connection.executescript(SCHEMA)
+
+        self._writer = threading.Thread(target=self._write_forever, name="StateStore")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def load(self):
+        """
+        Reads all the stored sessions.
+
+        __Returns__
+
+        - sessions: list of dictionaries with the `token`, `server`, `user_id`,
+        `sync_token`, `rooms` and `messages` of each session. Each room is a
+        dictionary with the `room_id`, `name`, `canonical_alias`, `aliases`,
+        `prev_batch` and `members` (list of `(user_id, displayname)`).
+        `messages` maps a room ID to a chronological list of
+        `(event_id, after_token, message)`.
+        """
+        connection = self._connect()
+        try:
+            sessions = []
+            for token, server, user_id, sync_token in connection.execute(
+                    "SELECT token, server, user_id, sync_token FROM sessions ORDER BY rowid"):
+                rooms = {}
+                for room_id, name, canonical_alias, aliases, prev_batch in connection.execute(
+                        "SELECT room_id, name, canonical_alias, aliases, prev_batch FROM rooms WHERE token = ?", (token,)):
+                    rooms[room_id] = {
+                        "room_id": room_id,
+                        "name": name,
+                        "canonical_alias": canonical_alias,
+                        "aliases": json.loads(aliases or "[]"),
+                        "prev_batch": prev_batch,
+                        "members": []
+                    }
+                for room_id, member_id, displayname in connection.execute(
+                        "SELECT room_id, user_id, displayname FROM members WHERE token = ?", (token,)):
+                    if room_id in rooms:
+                        rooms[room_id]["members"].append((member_id, displayname))
+
+                messages = {}
+                for room_id, event_id, after_token, message in connection.execute(
+                        "SELECT room_id, event_id, after_token, message FROM messages WHERE token = ? ORDER BY id", (token,)):
+                    messages.setdefault(room_id, []).append((event_id, after_token, json.loads(message)))
+
+                sessions.append({
+                    "token": token,
+                    "server": server,
+                    "user_id": user_id,
+                    "sync_token": sync_token,
+                    "rooms": list(rooms.values()),
+                    "messages": messages
+                })
+            return sessions
+        finally:
+            connection.close()
+
+    def put_session(self, token, server, user_id):
+        """
+        Stores a new session.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - server: Matrix server URL
+        - user_id: Matrix ID of the user
+        """
+        self._queue.put(("INSERT OR IGNORE INTO sessions (token, server, user_id) VALUES (?, ?, ?)",
+                         (token, server, user_id)))
+
+    def remove_session(self, token):
+        """
+        Removes a session and all its rooms, members and messages.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        """
+        with self._lock:
+            self._sync_tokens.pop(token, None)
+        for table in ("sessions", "rooms", "members", "messages"):
+            self._queue.put(("DELETE FROM {0} WHERE token = ?".format(table), (token,)))
+
+    def set_sync_token(self, token, sync_token):
+        """
+        Stores the `next_batch` token to resume syncing from.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - sync_token: `next_batch` token of the latest sync
+        """
+        with self._lock:
+            self._sync_tokens[token] = sync_token
+        self._queue.put(None) # wake up the writer
+
+    def put_room(self, token, room):
+        """
+        Stores the state and the joined members of a room.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - room: Matrix.org SDK Room object
+        """
+        members = [(token, room.room_id, member.user_id, member.displayname)
+                   for member in room.get_joined_members() if isinstance(member, User)]
+        self._queue.put(("INSERT OR REPLACE INTO rooms VALUES (?, ?, ?, ?, ?, ?)",
+                         (token, room.room_id, room.name, room.canonical_alias,
+                          json.dumps(room.aliases or []), room.prev_batch)))
+        self._queue.put(("DELETE FROM members WHERE token = ? AND room_id = ?", (token, room.room_id)))
+        self._queue.put(("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?)", members))
+
+    def remove_room(self, token, room_id):
+        """
+        Removes a room with its members and messages, for example after leaving it.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - room_id: Matrix ID of the room
+        """
+        for table in ("rooms", "members", "messages"):
+            self._queue.put(("DELETE FROM {0} WHERE token = ? AND room_id = ?".format(table), (token, room_id)))
+
+    def put_message(self, token, room_id, event_id, after_token, message):
+        """
+        Stores a normalized message, only the most recent messages of each
+        room are kept.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - room_id: Matrix ID of the room
+        - event_id: Matrix ID of the event
+        - after_token: Matrix pagination token located after the event
+        - message: normalized message
+        """
+        self._queue.put(("INSERT OR IGNORE INTO messages (token, room_id, event_id, after_token, message) VALUES (?, ?, ?, ?, ?)",
+                         (token, room_id, event_id, after_token, json.dumps(message))))
+
+    def redact_message(self, token, event_id):
+        """
+        Replaces the content of a stored message by the redacted placeholder,
+        see `Message.redacted`.
+
+        __Parameters__
+
+        - token: Matrix auth token of the session
+        - event_id: Matrix ID of the redacted event
+        """
+        self._queue.put(("UPDATE messages SET message = json_set(message, '$.type', 'redacted', '$.content', NULL) "
+                         "WHERE token = ? AND event_id = ?", (token, event_id)))
+
+    def flush(self):
+        """
+        Blocks until all the queued writes are committed.
+        """
+        self._queue.join()
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _write_forever(self):
+        while True:
+            writes = [self._queue.get()]
+            while len(writes) < self.BATCH_SIZE:
+                try:
+                    writes.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._commit([write for write in writes if write is not None])
+            except sqlite3.Error:
+                pass # the store is a cache, losing a batch only costs a longer sync
+            finally:
+                for _ in writes:
+                    self._queue.task_done()
+
+    def _commit(self, writes):
+        with self._lock:
+            sync_tokens = self._sync_tokens
+            self._sync_tokens = {}
+
+        rooms = set()
+        with self._connection:
+            for sql, params in writes:
+                if isinstance(params, list):
+                    self._connection.executemany(sql, params)
+                else:
+                    self._connection.execute(sql, params)
+                if sql.startswith("INSERT OR IGNORE INTO messages"):
+                    rooms.add(params[:2])
+
+            # Keep the most recent messages of the updated rooms
+            for token, room_id in rooms:
+                self._connection.execute(
+                    "DELETE FROM messages WHERE token = ? AND room_id = ? AND id NOT IN "
+                    "(SELECT id FROM messages WHERE token = ? AND room_id = ? ORDER BY id DESC LIMIT ?)",
+                    (token, room_id, token, room_id, self._keep))
+
+            for token, sync_token in sync_tokens.items():
+                self._connection.execute("UPDATE sessions SET sync_token = ? WHERE token = ?",
+                                         (sync_token, token))
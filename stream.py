@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+"""
+The EventStream hands the normalized messages of the sync listener to the
+streaming endpoints as soon as they arrive.
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+__all__ = ["EventStream"]
+
+class EventStream(object):
+    """
+    Publish/subscribe channel for new messages.
+
+    Every published message gets a sequence number. Subscribers remember the
+    last sequence number they have seen and wait for newer messages, a small
+    backlog lets them catch up after reconnecting.
+    """
+    def __init__(self, backlog=1000):
+        self._condition = threading.Condition()
+        self._events = collections.deque(maxlen=backlog) # (seq, room_id, message, event_id)
+        self._seq = 0
+
+    @property
+    def cursor(self):
+        """
+        Sequence number of the latest published message.
+        """
+        with self._condition:
+            return self._seq
+
+    def publish(self, room_id, message, event_id=None):
+        """
+        Publishes a new message and wakes up all the waiting subscribers.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        - message: normalized message
+        - event_id: Matrix ID of the event, needed to redact the message
+        """
+        with self._condition:
+            self._seq += 1
+            self._events.append((self._seq, room_id, message, event_id))
+            self._condition.notify_all()
+
+    def redact(self, event_id):
+        """
+        Replaces a message of the backlog by its redacted placeholder, the
+        subscribers catching up don't receive the redacted content.
+
+        __Parameters__
+
+        - event_id: Matrix ID of the redacted event
+        """
+        with self._condition:
+            for index, (seq, room_id, message, published_id) in enumerate(self._events):
+                if published_id == event_id:
+                    self._events[index] = (seq, room_id, message.redacted(), event_id)
+
+    def wait(self, after, room_id=None, timeout=30):
+        """
+        Returns the messages published after the given sequence number, blocks
+        until a message arrives or the timeout expires.
+
+        __Parameters__
+
+        - after: last sequence number seen by the subscriber
+        - room_id: only return messages of this room, all rooms if `None`
+        - timeout: maximum number of seconds to wait
+
+        __Returns__
+
+        - events: list of `(seq, room_id, message)` tuples, empty on timeout
+        - cursor: sequence number to wait after on the next call
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                events = self._since(after, room_id)
+                cursor = self._seq
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events, cursor
+                after = cursor # skip messages of other rooms
+                self._condition.wait(remaining)
+
+    def since(self, after):
+        """
+        Returns the messages published after the given sequence number
+        without waiting.
+
+        __Parameters__
+
+        - after: last sequence number seen by the subscriber
+
+        __Returns__
+
+        - events: list of `(seq, room_id, message)` tuples
+        - cursor: sequence number to read after on the next call
+        - complete: `False` if messages after `after` left the backlog already
+        """
+        with self._condition:
+            complete = after <= self._seq and (not self._events or after >= self._events[0][0] - 1)
+            return self._since(after, None), self._seq, complete
+
+    def _since(self, after, room_id):
+        if not self._events or after >= self._seq:
+            return []
+
+        # Sequence numbers in the backlog are contiguous
+        first = self._events[0][0]
+        offset = max(0, after - first + 1)
+        return [(seq, event_room_id, message) for seq, event_room_id, message, _ in
+                itertools.islice(self._events, offset, None) if room_id is None or event_room_id == room_id]
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from capture import TrafficRecorder
+
+class TrafficRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "capture.jsonl")
+        self.recorder = TrafficRecorder(self.path)
+
+    def tearDown(self):
+        self.recorder.close()
+        self.directory.cleanup()
+
+    def lines(self):
+        self.recorder.close()
+        with open(self.path, encoding="utf-8") as capture:
+            return capture.read()
+
+    def test_personal_data_is_not_captured(self):
+        self.recorder.record(0, "GET", "/contacts", "member=%40alice%3Aexample.org&name_prefix=Secret+Project",
+                             None, 200, 0.01, 10)
+        self.recorder.record(0, "POST", "/contacts/Divorce lawyer chat", "access_token=abc", None, 200, 0.01, 10)
+        self.recorder.record(0, "GET", "/contacts/!room:example.org/messages", "q=Dinner&limit=10",
+                             None, 200, 0.01, 10)
+        self.recorder.record(0, "POST", "/auth", "", {"username": "alice", "password": "hunter2"}, 200, 0.01, 10)
+
+        lines = self.lines()
+        for value in ("alice", "example.org", "Secret", "Project", "Divorce", "lawyer", "Dinner", "abc", "hunter2"):
+            self.assertNotIn(value, lines)
+
+    def test_routes_and_pseudonyms(self):
+        self.recorder.record(0, "POST", "/contacts/Divorce lawyer chat", "", None, 200, 0.01, 10)
+        self.recorder.record(0, "GET", "/contacts/!room:example.org/messages", "member=@bob:example.org&limit=10",
+                             None, 200, 0.01, 10)
+
+        first, second = [json.loads(line) for line in self.lines().splitlines()]
+        self.assertEqual(first["route"], "/contacts/{id}")
+        self.assertEqual(first["path"], "/contacts/" + "x" * len("Divorce lawyer chat"))
+        self.assertEqual(second["route"], "/contacts/{room_id}/messages")
+        self.assertRegex(second["path"], r"^/contacts/!room\d+:capture/messages$")
+        self.assertRegex(second["query"][0][1], r"^@user\d+:capture$")
+        self.assertEqual(second["query"][1], ["limit", "10"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+"""
+The UnreadTracker maintains the unread count, the last message and the read
+marker of every room from the sync events and the read receipts, so the
+contacts list shows them without reading the room histories.
+"""
+
+import collections
+import threading
+
+__all__ = ["UnreadTracker"]
+
+class RoomState(object):
+    """
+    Read state of a room.
+    """
+    __slots__ = ("pending", "unread", "last_event_id", "last_message", "read_timestamp")
+
+    def __init__(self, pending_size):
+        self.pending = collections.deque(maxlen=pending_size) # (event_id, timestamp) of the unread messages
+        self.unread = 0
+        self.last_event_id = None
+        self.last_message = None
+        self.read_timestamp = None # timestamp of the last read message, `None` when unknown
+
+class UnreadTracker(object):
+    """
+    Read state of the rooms of a session.
+
+    A message of another user is unread until a read receipt of the user
+    points at it or at a later event. A message sent by the user marks the
+    room as read, like the homeserver does. Messages read from the history
+    only update the last message, they were sent before the tracking started.
+    """
+    PENDING_SIZE = 1000 # unread event IDs remembered per room, older ones are only counted
+
+    def __init__(self, user_id, pending_size=PENDING_SIZE):
+        """
+        __Parameters__
+
+        - user_id: Matrix ID of the user of the session
+        - pending_size: unread event IDs remembered per room
+        """
+        self._user_id = user_id
+        self._pending_size = pending_size
+        self._lock = threading.Lock()
+        self._rooms = {} # room_id: RoomState
+
+    def message(self, room_id, event_id, message):
+        """
+        Records a new message received by the sync listener.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        - event_id: Matrix ID of the event
+        - message: normalized Message
+        """
+        with self._lock:
+            state = self._state(room_id)
+            state.last_event_id = event_id
+            state.last_message = message
+            if message.sender == self._user_id:
+                state.pending.clear()
+                state.unread = 0
+                state.read_timestamp = message.timestamp
+            else:
+                state.pending.append((event_id, message.timestamp))
+                state.unread += 1
+
+    def backfill(self, room_id, event_id, message):
+        """
+        Records a message read from the history, it becomes the last message
+        of the room if it's more recent.
+
+        __Returns__
+
+        - changed: `True` if the message is the new last message
+        """
+        if message.timestamp is None:
+            return False
+        with self._lock:
+            state = self._state(room_id)
+            last = state.last_message
+            if last is None or (last.timestamp is not None and last.timestamp < message.timestamp):
+                state.last_event_id = event_id
+                state.last_message = message
+                return True
+            return False
+
+    def redact(self, room_id, event_id):
+        """
+        Replaces the last message of a room by its redacted placeholder if
+        the given event is the last message.
+
+        __Returns__
+
+        - changed: `True` if the last message was redacted
+        """
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None or state.last_event_id != event_id or state.last_message is None:
+                return False
+            state.last_message = state.last_message.redacted()
+            return True
+
+    def read(self, room_id, event_id, timestamp=None):
+        """
+        Moves the read marker of the user to an event, the messages up to this
+        event are read.
+
+        __Parameters__
+
+        - room_id: Matrix ID of the room
+        - event_id: Matrix ID of the last read event
+        - timestamp: time of the receipt in milliseconds, used as the read
+        marker when the event isn't an unread message. The messages after it
+        stay unread, an older receipt can't clear newer messages.
+
+        __Returns__
+
+        - changed: `True` if the read state of the room changed
+        """
+        with self._lock:
+            state = self._state(room_id)
+            previous = (state.unread, state.read_timestamp)
+            position = next((index for index, (pending_id, _) in enumerate(state.pending)
+                             if pending_id == event_id), None)
+            if position is None:
+                # An event which isn't an unread message, the messages up to its time are read
+                if event_id == state.last_event_id and state.last_message is not None:
+                    timestamp = state.last_message.timestamp
+                if timestamp is not None:
+                    while state.pending and (state.pending[0][1] is None or state.pending[0][1] <= timestamp):
+                        state.pending.popleft()
+                    state.read_timestamp = max(timestamp, state.read_timestamp or timestamp)
+            else:
+                for _ in range(position + 1):
+                    _, read_timestamp = state.pending.popleft()
+                if read_timestamp is not None:
+                    state.read_timestamp = read_timestamp
+            state.unread = len(state.pending)
+            return previous != (state.unread, state.read_timestamp)
+
+    def is_read(self, room_id, message):
+        """
+        Returns `True` if the user read a message, `False` if it's unread and
+        `None` when it's unknown.
+        """
+        if message.sender == self._user_id:
+            return True
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None or state.read_timestamp is None or message.timestamp is None:
+                return None
+            return message.timestamp <= state.read_timestamp
+
+    def last_event(self, room_id):
+        """
+        Returns the ID of the last message of a room, `None` if it's unknown.
+        """
+        with self._lock:
+            state = self._rooms.get(room_id)
+            return state.last_event_id if state is not None else None
+
+    def summary(self, room_id):
+        """
+        Returns the read state of a room.
+
+        __Returns__
+
+        - summary: dictionary
+
+        ```json
+            {
+                "unread": number, unread messages
+                "last_message": message, `null` when unknown
+                "last_seen": number, timestamp of the last message
+            }
+        ```
+        """
+        with self._lock:
+            state = self._rooms.get(room_id)
+            if state is None:
+                return {"unread": 0, "last_message": None, "last_seen": None}
+            last = state.last_message
+            return {
+                "unread": state.unread,
+                "last_message": last,
+                "last_seen": last.timestamp if last is not None else None
+            }
+
+    def discard(self, room_id):
+        """
+        Forgets the read state of a room, for example after leaving it.
+        """
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+    def _state(self, room_id):
+        state = self._rooms.get(room_id)
+        if state is None:
+            state = self._rooms[room_id] = RoomState(self._pending_size)
+        return state